@@ -0,0 +1,167 @@
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+import urllib.parse
+
+# verified downloads, entries/<sha256>/<name>
+ENTRIES_DIR = 'entries'
+LOCKS_DIR = 'locks'
+TMP_DIR = 'tmp'
+EVICT_LOCK = '.evict.lock'
+SHA256_HEX = re.compile(r'[0-9a-fA-F]{64}')
+
+
+def parse_checksum(url: str) -> str:
+    """
+    Returns the sha256 from the ?checksum=sha256:<hex> query of a URL, or None if
+    the URL has no checksum. A checksum that cannot be verified raises ValueError
+    rather than letting the download through unverified.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query, keep_blank_values=True)
+    checksums = query.get('checksum', [])
+    if not checksums:
+        return None
+    digests = set()
+    for checksum in checksums:
+        algorithm, _, digest = checksum.partition(':')
+        if algorithm != 'sha256':
+            raise ValueError(f"Unsupported checksum {checksum!r} in {url}, expected sha256:<hex>")
+        if not SHA256_HEX.fullmatch(digest):
+            raise ValueError(f"Malformed checksum {checksum!r} in {url}, expected 64 hex digits")
+        digests.add(digest.lower())
+    if len(digests) > 1:
+        raise ValueError(f"Conflicting checksums in {url}")
+    return digests.pop()
+
+
+class HashingReader:
+    """
+    File-like wrapper hashing everything read through it.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def drain(self, chunk_size: int = 1024 * 1024) -> None:
+        """Reads and hashes whatever is left, e.g. the padding after the last tar member."""
+        while self.read(chunk_size):
+            pass
+
+
+def verify(url: str, digest: str) -> None:
+    """
+    Raises IOError if the URL carries a checksum that does not match digest.
+    """
+    expected = parse_checksum(url)
+    if expected and expected != digest:
+        raise IOError(f"Checksum mismatch for {url}: expected {expected}, got {digest}")
+
+
+@contextlib.contextmanager
+def locked(path: str, blocking: bool = True):
+    """
+    Holds an exclusive flock on path, shared by every pod mounting the cache.
+    Yields False when blocking is off and the lock is taken.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hardlinks src to dst, copying it when the cache is on another filesystem or
+    links to files of other users are not allowed.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        tmp_path = f'{dst}.{os.getpid()}.tmp'
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+
+def entry_size(entry_dir: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file(follow_symlinks=False))
+
+
+def fetch(url: str, file: str, download, cache_dir: str, max_bytes: int = 0) -> None:
+    """
+    Places the artifact of a checksummed URL at file, downloading it into the
+    cache only if no pod on this host did so before.
+
+    :param url: URL with a ?checksum=sha256:<hex> query.
+    :param file: Path to create, hardlinked to the cache entry.
+    :param download: Callable downloading the URL to the path it is given, verifying its checksum.
+    :param cache_dir: Directory of the cache, e.g. a hostPath volume.
+    :param max_bytes: Maximum size of the cache, least recently used entries are evicted, 0 to disable.
+    """
+    digest = parse_checksum(url)
+    name = os.path.basename(file)
+    entry_dir = os.path.join(cache_dir, ENTRIES_DIR, digest)
+    entry_file = os.path.join(entry_dir, name)
+    with locked(os.path.join(cache_dir, LOCKS_DIR, f'{digest}.lock')):
+        if os.path.lexists(entry_file):
+            logging.info(f"Using cached {name} for {url}")
+        else:
+            os.makedirs(os.path.join(cache_dir, TMP_DIR), exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=os.path.join(cache_dir, TMP_DIR)) as tmpdir:
+                download(os.path.join(tmpdir, name))
+                if not os.path.lexists(os.path.join(tmpdir, name)):
+                    # nothing matched in the archive, let the caller report it
+                    return
+                os.makedirs(entry_dir, exist_ok=True)
+                os.replace(os.path.join(tmpdir, name), entry_file)
+            logging.info(f"Cached {name} for {url} in {entry_dir}")
+        link_or_copy(entry_file, file)
+        # the mtime of the entry is its last use
+        os.utime(entry_dir)
+    if max_bytes:
+        evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir: str, max_bytes: int) -> int:
+    """
+    Removes the least recently used entries until the cache fits in max_bytes.
+    Entries in use by another pod are skipped, files already linked from an entry
+    stay valid after it is evicted.
+
+    :return: Number of bytes freed.
+    """
+    entries_dir = os.path.join(cache_dir, ENTRIES_DIR)
+    freed = 0
+    with locked(os.path.join(cache_dir, EVICT_LOCK)):
+        entries = [(entry.stat().st_mtime, entry.name, entry_size(entry.path))
+                   for entry in os.scandir(entries_dir) if entry.is_dir()]
+        total = sum(size for _, _, size in entries)
+        # never evict the most recently used entry
+        for _, digest, size in sorted(entries)[:-1]:
+            if total <= max_bytes:
+                break
+            with locked(os.path.join(cache_dir, LOCKS_DIR, f'{digest}.lock'), blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(os.path.join(entries_dir, digest), ignore_errors=True)
+            logging.info(f"Evicted {digest} ({size} bytes) from {cache_dir}")
+            total -= size
+            freed += size
+    return freed
@@ -0,0 +1,291 @@
+import os
+import json
+import stat
+import time
+import fcntl
+import hashlib
+import logging
+import requests
+import httpclient
+import lz4.frame
+import snaparchive
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# maximum uncompressed bytes per chunk, chunks never span two files
+CHUNK_SIZE = 4 * 1024 * 1024
+
+CHUNKS_DIR = 'chunks'
+MANIFESTS_DIR = 'manifests'
+# held shared while a snapshot is stored and exclusively while chunks are collected
+LOCK_FILE = '.chunks.lock'
+
+
+def chunk_path(chunks_dir: str, digest: str) -> str:
+    return os.path.join(chunks_dir, digest[:2], digest)
+
+
+def is_manifest(path: str) -> bool:
+    parts = path.split('?')[0].split('/')
+    return len(parts) > 1 and parts[-2] == MANIFESTS_DIR and parts[-1].endswith('.json')
+
+
+@contextlib.contextmanager
+def locked(snapshots_dir: str, exclusive: bool = False):
+    """
+    Stores write their chunks before their manifest exists, gc must not run
+    until they are done.
+    """
+    os.makedirs(snapshots_dir, exist_ok=True)
+    with open(os.path.join(snapshots_dir, LOCK_FILE), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def iter_chunks(file_path: str):
+    """
+    Splits a file into chunks. Boundaries are aligned to the start of every file,
+    so an immutable file (leveldb/rocksdb tables, wasm blobs) always produces the
+    same chunks no matter where it sits in the tree or which snapshot it is part of.
+    """
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def bounded_map(executor: ThreadPoolExecutor, fn, iterable, window: int):
+    """
+    Like executor.map, but keeps at most `window` items in flight so large files
+    are never held in memory as a whole.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def put_chunk(chunks_dir: str, data: bytes) -> tuple:
+    """
+    Stores a chunk unless an identical chunk is already present.
+
+    :return: Tuple of (digest, bytes written to the store).
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = chunk_path(chunks_dir, digest)
+    if os.path.exists(path):
+        return digest, 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    compressed = lz4.frame.compress(data)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(tmp_path, path)
+    return digest, len(compressed)
+
+
+def store(snapshots_dir: str, name: str, directories: list, exclude_patterns: list, workers: int = 1) -> str:
+    """
+    Adds the given directories to the chunk store and writes a manifest for them.
+
+    :param snapshots_dir: Directory holding the chunk store.
+    :param name: Name of the snapshot, e.g. snapshot-<height>.
+    :param directories: List of directories to include.
+    :param exclude_patterns: List of patterns to exclude.
+    :param workers: Number of threads hashing and compressing chunks.
+    :return: Path of the written manifest.
+    """
+    chunks_dir = os.path.join(snapshots_dir, CHUNKS_DIR)
+    manifests_dir = os.path.join(snapshots_dir, MANIFESTS_DIR)
+    os.makedirs(manifests_dir, exist_ok=True)
+    with locked(snapshots_dir):
+        return store_locked(chunks_dir, manifests_dir, name, directories, exclude_patterns, workers)
+
+
+def store_locked(chunks_dir: str, manifests_dir: str, name: str, directories: list, exclude_patterns: list, workers: int) -> str:
+    entries = []
+    total_bytes = 0
+    written_bytes = 0
+    workers = max(workers, 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_path, arcname, st in snaparchive.iter_files(directories, exclude_patterns, include_dirs=True):
+            entry = {'path': arcname, 'mode': st.st_mode & 0o7777, 'mtime': st.st_mtime}
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'dir'
+            elif stat.S_ISLNK(st.st_mode):
+                entry.update(type='symlink', target=os.readlink(file_path))
+            elif stat.S_ISREG(st.st_mode):
+                results = list(bounded_map(executor, lambda data: put_chunk(chunks_dir, data), iter_chunks(file_path), workers * 2))
+                entry.update(size=st.st_size, chunks=[digest for digest, _ in results])
+                total_bytes += st.st_size
+                written_bytes += sum(written for _, written in results)
+            else:
+                logging.warning(f"Skipping {file_path}, not a regular file, directory or symlink")
+                continue
+            entries.append(entry)
+
+    manifest_file = os.path.join(manifests_dir, f'{name}.json')
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        json.dump({
+            'name': name,
+            'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'size': total_bytes,
+            'entries': entries,
+        }, f)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+    logging.info(f"Stored {total_bytes} bytes as {manifest_file}, {written_bytes} new compressed bytes written")
+    return manifest_file
+
+
+def read_chunk(source: str, digest: str, session: requests.Session = None) -> bytes:
+    """
+    Reads and verifies a chunk from a local chunk directory or an HTTP base URL.
+    """
+    if source.startswith(('http://', 'https://')):
+        response = session.get(f'{source}/{digest[:2]}/{digest}', timeout=60)
+        response.raise_for_status()
+        compressed = response.content
+    else:
+        with open(chunk_path(source, digest), 'rb') as f:
+            compressed = f.read()
+    data = lz4.frame.decompress(compressed)
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise IOError(f"Chunk {digest} is corrupt")
+    return data
+
+
+def has_chunk(source: str, digest: str, session: requests.Session = None) -> bool:
+    if source.startswith(('http://', 'https://')):
+        response = session.head(f'{source}/{digest[:2]}/{digest}', timeout=30)
+        if response.status_code in (403, 404):
+            return False
+        response.raise_for_status()
+        return True
+    return os.path.exists(chunk_path(source, digest))
+
+
+def missing_chunks(manifest: dict, source: str, workers: int = 1, session: requests.Session = None) -> list:
+    """
+    Returns the chunks of a manifest that are not in the store, without fetching them.
+    """
+    digests = sorted({digest for entry in manifest['entries'] for digest in entry.get('chunks', [])})
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        found = executor.map(lambda digest: has_chunk(source, digest, session), digests)
+        return [digest for digest, present in zip(digests, found) if not present]
+
+
+def restore(manifest_url: str, extract_to: str, workers: int = 1, owner: tuple = None, reset=None) -> bool:
+    """
+    Reassembles a snapshot from its manifest.
+
+    :param manifest_url: Path or URL of the manifest, chunks are expected in ../chunks.
+    :param extract_to: Directory to restore the files to.
+    :param workers: Number of chunks fetched and decompressed in parallel.
+    :param owner: Optional (uid, gid) every restored path is given.
+    :param reset: Optional callable clearing the existing data, called once the manifest
+                  is loaded and every chunk it references is known to be in the store.
+    :return: True if the snapshot was successfully restored, False otherwise.
+    """
+    session = None
+    try:
+        if manifest_url.startswith(('http://', 'https://')):
+            session = httpclient.session()
+            response = session.get(manifest_url, timeout=60)
+            response.raise_for_status()
+            manifest = response.json()
+            source = f"{manifest_url.split('?')[0].rsplit('/', 2)[0]}/{CHUNKS_DIR}"
+        else:
+            manifest_file = manifest_url[7:] if manifest_url.startswith('file://') else manifest_url
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            source = os.path.join(os.path.dirname(os.path.dirname(manifest_file)), CHUNKS_DIR)
+        missing = missing_chunks(manifest, source, workers, session)
+    except (IOError, ValueError, requests.RequestException) as e:
+        logging.error(f"Failed to load manifest {manifest_url}: {e}")
+        return False
+    if missing:
+        logging.error(f"{len(missing)} chunks of {manifest['name']} are missing from {source}, e.g. {missing[0]}")
+        return False
+    if reset:
+        reset()
+
+    logging.info(f"Restoring {manifest['name']} ({manifest['size']} bytes) from {source}")
+    workers = max(workers, 1)
+    created_dirs = set()
+    directories = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for entry in manifest['entries']:
+                target = os.path.join(extract_to, entry['path'])
+                kind = entry.get('type', 'file')
+                if kind == 'dir':
+                    snaparchive.make_parents(target, owner, created_dirs)
+                    directories.append((target, entry))
+                    continue
+                snaparchive.make_parents(os.path.dirname(target), owner, created_dirs)
+                if os.path.lexists(target) and (kind == 'symlink' or os.path.islink(target)):
+                    os.remove(target)
+                if kind == 'symlink':
+                    os.symlink(entry['target'], target)
+                    snaparchive.set_owner(target, owner)
+                    continue
+                with open(target, 'wb') as f:
+                    chunks = bounded_map(executor, lambda digest: read_chunk(source, digest, session), entry['chunks'], workers * 2)
+                    for data in chunks:
+                        f.write(data)
+                snaparchive.set_owner(target, owner)
+                os.chmod(target, entry['mode'])
+                os.utime(target, (entry['mtime'], entry['mtime']))
+        # like the files, directories get their mode and mtime once their contents are written
+        for target, entry in reversed(directories):
+            snaparchive.set_owner(target, owner)
+            os.chmod(target, entry['mode'])
+            os.utime(target, (entry['mtime'], entry['mtime']))
+    except (IOError, requests.RequestException) as e:
+        logging.error(f"Failed to restore {manifest['name']}: {e}")
+        return False
+    return True
+
+
+def gc(snapshots_dir: str) -> int:
+    """
+    Deletes chunks that are no longer referenced by any manifest.
+
+    :param snapshots_dir: Directory holding the chunk store.
+    :return: Number of bytes freed.
+    """
+    chunks_dir = os.path.join(snapshots_dir, CHUNKS_DIR)
+    manifests_dir = os.path.join(snapshots_dir, MANIFESTS_DIR)
+    if not os.path.isdir(chunks_dir):
+        return 0
+    with locked(snapshots_dir, exclusive=True):
+        return gc_locked(chunks_dir, manifests_dir)
+
+
+def gc_locked(chunks_dir: str, manifests_dir: str) -> int:
+    referenced = set()
+    for fn in os.listdir(manifests_dir):
+        if fn.endswith('.json'):
+            with open(os.path.join(manifests_dir, fn), 'r') as f:
+                for entry in json.load(f)['entries']:
+                    referenced.update(entry.get('chunks', []))
+
+    freed = 0
+    for prefix in os.listdir(chunks_dir):
+        for digest in os.listdir(os.path.join(chunks_dir, prefix)):
+            # skip chunks that are still being written
+            if digest not in referenced and not digest.endswith('.tmp'):
+                path = os.path.join(chunks_dir, prefix, digest)
+                freed += os.path.getsize(path)
+                os.remove(path)
+    logging.info(f"Freed {freed} bytes of unreferenced chunks in {chunks_dir}")
+    return freed
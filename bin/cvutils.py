@@ -4,11 +4,19 @@ import zipfile
 import json
 import requests
 import logging
-import subprocess
 import platform
 import shutil
 import tempfile
+import hashlib
 import argparse
+import bincache
+import httpclient
+import ociimage
+import time
+import random
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(
@@ -16,6 +24,11 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s",
 )
 
+# connect and read timeouts of binary and library downloads
+DOWNLOAD_TIMEOUT = (30, 300)
+# size of the pieces downloads are streamed to disk in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 # modiffication of getattr to return default value if attribute is empty
 def agetattr(obj, name, default=None):
     value = getattr(obj, name, default)
@@ -66,6 +79,32 @@ def get_ctx(args: argparse.Namespace = {}):
     snapshot_url = agetattr(args, "snapshot_url", os.environ.get("SNAPSHOT_URL", ""))
     restore_snapshot = agetattr(args, "restore_snapshot", os.environ.get("RESTORE_SNAPSHOT", "false").lower() in ["true", "1", "yes"])
     cosmprund_enabled = agetattr(args, "cosmprund_enabled", os.environ.get("COSMPRUND_ENABLED", "false").lower() in ["true", "1", "yes"])
+    snapshot_parallel = agetattr(args, "snapshot_parallel", os.environ.get("SNAPSHOT_PARALLEL", "false").lower() in ["true", "1", "yes"])
+    snapshot_workers = agetattr(args, "snapshot_workers", os.environ.get("SNAPSHOT_WORKERS", os.cpu_count()))
+    snapshot_incremental = agetattr(args, "snapshot_incremental", os.environ.get("SNAPSHOT_INCREMENTAL", "false").lower() in ["true", "1", "yes"])
+    snapshot_full_every = agetattr(args, "snapshot_full_every", os.environ.get("SNAPSHOT_FULL_EVERY", 12))
+    snapshot_chunkstore = agetattr(args, "snapshot_chunkstore", os.environ.get("SNAPSHOT_CHUNKSTORE", "false").lower() in ["true", "1", "yes"])
+    snapshot_indexed = agetattr(args, "snapshot_indexed", os.environ.get("SNAPSHOT_INDEXED", "false").lower() in ["true", "1", "yes"])
+    snapshot_codec = agetattr(args, "snapshot_codec", os.environ.get("SNAPSHOT_CODEC", "lz4"))
+    snapshot_level = agetattr(args, "snapshot_level", os.environ.get("SNAPSHOT_LEVEL", None))
+    snapshot_window_log = agetattr(args, "snapshot_window_log", os.environ.get("SNAPSHOT_WINDOW_LOG", 27))
+    snapshot_live = agetattr(args, "snapshot_live", os.environ.get("SNAPSHOT_LIVE", "false").lower() in ["true", "1", "yes"])
+    snapshot_staging_dir = agetattr(args, "snapshot_staging_dir", os.environ.get("SNAPSHOT_STAGING_DIR", os.path.join(chain_home, "tmp", "snapshot-staging")))
+    snapshot_height = agetattr(args, "snapshot_height", os.environ.get("SNAPSHOT_HEIGHT", None))
+    snapshot_keep_last = agetattr(args, "snapshot_keep_last", os.environ.get("SNAPSHOT_KEEP_LAST", 0))
+    snapshot_keep_every = agetattr(args, "snapshot_keep_every", os.environ.get("SNAPSHOT_KEEP_EVERY", 0))
+    snapshot_max_bytes = agetattr(args, "snapshot_max_bytes", os.environ.get("SNAPSHOT_MAX_BYTES", 0))
+    snapshot_metrics_file = agetattr(args, "snapshot_metrics_file", os.environ.get("SNAPSHOT_METRICS_FILE", None))
+    snapshot_stream = agetattr(args, "snapshot_stream", os.environ.get("SNAPSHOT_STREAM", "false").lower() in ["true", "1", "yes"])
+    snapshot_connections = agetattr(args, "snapshot_connections", os.environ.get("SNAPSHOT_CONNECTIONS", 16))
+
+    download_workers = agetattr(args, "download_workers", os.environ.get("DOWNLOAD_WORKERS", 8))
+    download_per_host = agetattr(args, "download_per_host", os.environ.get("DOWNLOAD_PER_HOST", 4))
+    download_retries = agetattr(args, "download_retries", os.environ.get("DOWNLOAD_RETRIES", 3))
+    binary_cache_dir = agetattr(args, "binary_cache_dir", os.environ.get("BINARY_CACHE_DIR", None))
+    binary_cache_max_bytes = agetattr(args, "binary_cache_max_bytes", os.environ.get("BINARY_CACHE_MAX_BYTES", 0))
+    provision_distance = agetattr(args, "provision_distance", os.environ.get("PROVISION_DISTANCE", 1000))
+    provision_interval = agetattr(args, "provision_interval", os.environ.get("PROVISION_INTERVAL", 60))
 
     p2p_port = agetattr(args, "p2p_port", os.environ.get("P2P_PORT", 26656))
     rpc_port = agetattr(args, "rpc_port", os.environ.get("RPC_PORT", 26657))
@@ -73,6 +112,12 @@ def get_ctx(args: argparse.Namespace = {}):
     statesync_enabled = agetattr(args, "statesync_enabled", os.environ.get("STATE_SYNC_ENABLED", "false").lower() in ["true", "1", "yes"])
     statesync_snapshot = agetattr(args, "statesync_snapshot", os.environ.get("STATESYNC_SNAPSHOT", "false").lower() in ["true", "1", "yes"])
     statesync_rpc = agetattr(args, "statesync_rpc", os.environ.get("STATE_SYNC_RPC", f"{chain_name}-sync.{domain}:{rpc_port}"))
+
+    discovery_workers = agetattr(args, "discovery_workers", os.environ.get("DISCOVERY_WORKERS", 32))
+    discovery_deadline = agetattr(args, "discovery_deadline", os.environ.get("DISCOVERY_DEADLINE", 15))
+    peer_limit = agetattr(args, "peer_limit", os.environ.get("PEER_LIMIT", 10))
+    peer_max_lag = agetattr(args, "peer_max_lag", os.environ.get("PEER_MAX_LAG", 100))
+    peers_state_file = agetattr(args, "peers_state_file", os.environ.get("PEERS_STATE_FILE", os.path.join(config_dir, "k8s-peers.json")))
     
     
     return set_cosmovisor_dir(locals(), cosmovisor_dir)
@@ -137,6 +182,19 @@ def get_arch_version(ctx, codebase, version):
     }
 
 
+def cv_upgrade_files(ctx, version):
+    """
+    Lists the binary and libraries of an upgrade as (url, file) tuples.
+    """
+    upgrade_path = os.path.join(ctx["cv_upgrades_dir"], version.get("name", ""))
+    files = []
+    if version.get("binary_url", None):
+        files.append((version["binary_url"], os.path.join(upgrade_path, "bin", ctx.get("daemon_name"))))
+    for key, library_url in version.get("libraries", {}).items():
+        files.append((library_url, os.path.join(upgrade_path, "lib", key)))
+    return files
+
+
 def create_cv_upgrade(ctx, version, linkCurrent=True):
     os.makedirs(ctx["cv_upgrades_dir"], exist_ok=True)
     daemon_name = ctx.get("daemon_name")
@@ -151,9 +209,12 @@ def create_cv_upgrade(ctx, version, linkCurrent=True):
 
     os.makedirs(upgrade_path, exist_ok=True)
 
+    cache_dir = ctx.get("binary_cache_dir")
+    cache_max_bytes = int(ctx.get("binary_cache_max_bytes") or 0)
+
     # add binary
     if binary_url:
-        download_file(binary_url, binary_file)
+        download_file(binary_url, binary_file, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)
         os.chmod(binary_file, 0o755)
     
     # add libraries
@@ -161,7 +222,7 @@ def create_cv_upgrade(ctx, version, linkCurrent=True):
     for key, library_url in library_urls.items():
         logging.info(f"Downloading library: {library_url}...")
         library_file = os.path.join(upgrade_path, "lib", key)
-        download_file(library_url, library_file)
+        download_file(library_url, library_file, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)
         os.chmod(library_file, 0o755)
         
     # link if binary exists
@@ -221,49 +282,123 @@ def link_cv_genesis(ctx, upgrade_path):
     os.symlink(upgrade_path, cv_genesis_dir)
 
 
-def download_file(url, file):
+def download_files(downloads, max_workers=8, max_per_host=4, retries=3, backoff=1.0, cache_dir=None, cache_max_bytes=0):
+    """
+    Downloads files concurrently over a shared connection pool.
+
+    :param downloads: List of (url, file) tuples, files that already exist are skipped.
+    :param max_workers: Maximum number of downloads in flight.
+    :param max_per_host: Maximum number of concurrent downloads from the same host.
+    :param retries: Number of retries of a failed download, waiting backoff * 2^attempt seconds plus jitter in between.
+    :param backoff: Delay before the first retry, in seconds.
+    :param cache_dir: Optional host-level cache of checksummed artifacts, see download_file.
+    :param cache_max_bytes: Maximum size of the cache, 0 to disable eviction.
+    """
+    downloads = [(url, file) for url, file in downloads if not os.path.exists(file)]
+    if not downloads:
+        return
+    host_limits = {urllib.parse.urlsplit(url).netloc: threading.Semaphore(max_per_host) for url, _ in downloads}
+    # retries are done here, around the whole download, rather than by the session
+    session = httpclient.new_session(retries=0, pool_size=max_per_host)
+
+    def fetch(url, file):
+        for attempt in range(retries + 1):
+            try:
+                with host_limits[urllib.parse.urlsplit(url).netloc]:
+                    download_file(url, file, session, cache_dir, cache_max_bytes)
+                return
+            except (requests.RequestException, OSError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                # client errors other than rate limiting will not go away
+                if attempt == retries or (status and 400 <= status < 500 and status != 429):
+                    raise
+                delay = round(backoff * 2 ** attempt + random.uniform(0, backoff), 2)
+                logging.warning(f"Download of {url} failed: {e}, retrying in {delay}s...")
+                time.sleep(delay)
+
+    start = time.monotonic()
+    logging.info(f"Downloading {len(downloads)} files with up to {max_workers} concurrent downloads...")
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, url, file) for url, file in downloads]
+            errors = [future.exception() for future in futures if future.exception()]
+    finally:
+        session.close()
+    if errors:
+        raise errors[0]
+    logging.info(f"Downloaded {len(downloads)} files in {time.monotonic() - start:.1f}s")
+
+
+def download_file(url, file, session=None, cache_dir=None, cache_max_bytes=0):
+    """
+    Downloads a binary or library, extracting it from .tar.gz and .zip archives.
+
+    The response is streamed in DOWNLOAD_CHUNK_SIZE pieces so memory stays flat
+    whatever the size of the artifact, tarballs are extracted straight from the
+    stream. The result is written next to file and only moved into place once
+    it is complete, a failed download never leaves a partial file behind.
+
+    URLs with a ?checksum=sha256:<hex> query are verified against it. With a
+    cache_dir they are also kept there, keyed by checksum, and hardlinked to
+    file, so pods sharing the cache download every release only once.
+    """
     path = os.path.dirname(file)
     name = os.path.basename(file)
     
     if not os.path.exists(file):
         os.makedirs(path, exist_ok=True)
-        if url.startswith("docker://"):
+        if url.startswith(("docker://", "oci:")):
             download_and_extract_image(url, file)
             return
+        # a malformed checksum fails before anything is downloaded
+        checksum = bincache.parse_checksum(url)
+        if cache_dir and checksum:
+            bincache.fetch(url, file, lambda target: download_file(url, target, session), cache_dir, cache_max_bytes)
+            return
 
         logging.info(f"Downloading {url} to {file}...")
-        with tempfile.TemporaryDirectory() as tmpdir:
+        with tempfile.TemporaryDirectory(dir=path) as tmpdir:
             url_split = url.split('?')
             url_fname = os.path.basename(url_split[0])
-            response = requests.get(url)
-            response.raise_for_status()
-            tmp_path = os.path.join(tmpdir, url_fname)
-            logging.info(f"Downloading {url} to {tmp_path}...")
-            with open(tmp_path, 'wb') as f:
-                f.write(response.content)
-
-            if url_fname.endswith(".tar.gz"):
-                with tarfile.open(tmp_path ,mode='r:gz') as tar:
-                    for member in tar.getmembers():
-                        member_basename = os.path.basename(member.name)
-                        if member.name.endswith(name) or member_basename.startswith(name):
-                            logging.info(f"Extracting: {member.name} to {file}")
-                            member.name = name
-                            tar.extract(member, path=path)
-            elif url_fname.endswith(".zip"):
-                # this code does not work consistently
-                with zipfile.ZipFile(tmp_path, 'r') as zip_ref:
-                    for zip_info in zip_ref.infolist():
-                        zip_name = zip_info.filename
-                        if zip_name.endswith('/'):
-                            continue
-                        file_content = zip_ref.read(zip_name)
-                        logging.info(f"Extract: {zip_name} to {file}")
-                        with open(file, 'wb') as file_handle:
-                            file_handle.write(file_content)
-                            break
-            else:
-                shutil.copy(tmp_path, file)
+            tmp_file = os.path.join(tmpdir, name)
+            with (session or httpclient.session()).get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                if url_fname.endswith(".tar.gz"):
+                    response.raw.decode_content = True
+                    reader = bincache.HashingReader(response.raw)
+                    with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                        for member in tar:
+                            member_basename = os.path.basename(member.name)
+                            if member.name.endswith(name) or member_basename.startswith(name):
+                                logging.info(f"Extracting: {member.name} to {file}")
+                                member.name = name
+                                tar.extract(member, path=tmpdir)
+                    reader.drain(DOWNLOAD_CHUNK_SIZE)
+                    bincache.verify(url, reader.hash.hexdigest())
+                else:
+                    tmp_path = os.path.join(tmpdir, f"download-{url_fname}")
+                    logging.info(f"Downloading {url} to {tmp_path}...")
+                    sha256 = hashlib.sha256()
+                    with open(tmp_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            sha256.update(chunk)
+                            f.write(chunk)
+                    bincache.verify(url, sha256.hexdigest())
+                    if url_fname.endswith(".zip"):
+                        # this code does not work consistently
+                        with zipfile.ZipFile(tmp_path, 'r') as zip_ref:
+                            for zip_info in zip_ref.infolist():
+                                zip_name = zip_info.filename
+                                if zip_name.endswith('/'):
+                                    continue
+                                logging.info(f"Extract: {zip_name} to {file}")
+                                with zip_ref.open(zip_info) as src, open(tmp_file, 'wb') as file_handle:
+                                    shutil.copyfileobj(src, file_handle, DOWNLOAD_CHUNK_SIZE)
+                                break
+                    else:
+                        os.replace(tmp_path, tmp_file)
+            if os.path.lexists(tmp_file):
+                os.replace(tmp_file, file)
 
 
     # with open(binary_file, 'r') as f_json:
@@ -277,87 +412,20 @@ def download_file(url, file):
 
 
 def download_and_extract_image(image_url: str, file_path: str):
+    """
+    Extracts a binary from a container image, streaming only the layers up to the
+    one holding it. Local OCI layouts are accepted as oci:<dir>[:tag].
+    """
     file_to_extract = os.path.basename(file_path)
     destination = os.path.dirname(file_path)
-    image = os.path.basename(image_url)
-    image_name = image.split('[:@]', 1)[0]
-
-
-    logging.info(f"Extracting {file_to_extract} from {image}...")
-    # Check if the image exists on Docker Hub
+    logging.info(f"Extracting {file_to_extract} from {image_url}...")
     try:
-        logging.info(f"Checking for {image_url}...")
-        subprocess.run([
-            "skopeo", "inspect",
-            "--override-os=linux",
-            "--override-arch=amd64",
-            image_url,
-        ], stdout=subprocess.PIPE, check=True)
-    except subprocess.CalledProcessError:
-        logging.info(f"The image {image_url} could not be found.")
-        return
-
-    # Create a temporary directory
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # check if the image exists on Docker Hub
-        try:
-            logging.info(f"Downloading {image_url}...")
-            # Run the subprocess command within the temporary directory
-            subprocess.run([
-                "skopeo", "inspect",
-                "--override-os=linux",
-                "--override-arch=amd64",
-                image_url,
-            ], stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.info(f"Failed to download {image_url}. Error: {e}")
-
-        # Download the Docker image using skopeo
-        tar_file_name = f"{tmpdir}/{image_name.replace(':', '_')}.tar"
-        try:
-            subprocess.run([
-                "skopeo", "copy",
-                "--override-os=linux",
-                "--override-arch=amd64",
-                image_url, 
-                f"docker-archive:{tar_file_name}",
-            ], stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.info(f"Failed to download the image {image}. Error: {e}")
-            return
-        
-        # Extract blobs to a temporary directory
-        blob_directory = f"{tmpdir}/blobs"
-        try:
-            logging.info(f"Extracting {tar_file_name} to {blob_directory}...")
-            # Open the tar file in read mode
-            with tarfile.open(tar_file_name, 'r') as tar:
-                # Extract the specified file to the temporary directory
-                tar.extractall(blob_directory)
-        except Exception as e:
-            logging.info(f"Failed to extract {tar_file_name}. Error: {e}")
-
-        # iterate over the files in the blob directory
-        for filename in os.listdir(blob_directory):
-            if filename.endswith('.tar'):
-                logging.info(f"Checking {filename} for {file_to_extract}...")
-                # Construct the full file path
-                blob_file_path = os.path.join(blob_directory, filename)
-                # Open the tar file in read mode
-                with tarfile.open(blob_file_path, 'r') as blobtar:
-                    for member in blobtar.getmembers():
-                        if member.name.split('/')[-1] == file_to_extract:
-                            member_name = os.path.basename(member.name) # save target name
-                            if member.issym():
-                                dirname = os.path.dirname(member.name) + os.path.sep # tar symlinks are relative
-                                member = blobtar.getmember(dirname + member.linkname)
-                            if member.isfile():
-                                member.name = member_name # modify output name
-                                logging.info(f"Found {file_to_extract} as /{member.name} in {filename}...")
-                                # If no KeyError is raised, extract the specific file
-                                blobtar.extract(member, path=destination)
-                                logging.info(f"Successfully extracted {file_to_extract} to {destination}")
-                                break
+        if ociimage.extract(image_url, file_to_extract, destination, get_system_arch() or "linux/amd64"):
+            logging.info(f"Successfully extracted {file_to_extract} to {destination}")
+        else:
+            logging.info(f"{file_to_extract} not found in {image_url}")
+    except (requests.RequestException, OSError, ValueError, KeyError, tarfile.TarError) as e:
+        logging.error(f"Failed to extract {file_to_extract} from {image_url}. Error: {e}")
 
 
 def unsafe_reset_all(ctx):
@@ -368,8 +436,15 @@ def unsafe_reset_all(ctx):
     if os.path.exists(addrbook_json):
         os.remove(addrbook_json)
     
-    # remove data_dir and recreate
+    # remove data_dir and recreate it with the same owner, restores no longer chown -R afterwards
+    stat_info = os.stat(data_dir if os.path.isdir(data_dir) else os.path.dirname(data_dir))
     shutil.rmtree(data_dir, ignore_errors=True)
     os.makedirs(data_dir, exist_ok=True)
-    with open(os.path.join(data_dir, 'priv_validator_state.json'), 'w') as file:
-        file.write('{"height": "0", "round": 0, "step": 0}')
\ No newline at end of file
+    priv_validator_state = os.path.join(data_dir, 'priv_validator_state.json')
+    with open(priv_validator_state, 'w') as file:
+        file.write('{"height": "0", "round": 0, "step": 0}')
+    for path in [data_dir, priv_validator_state]:
+        try:
+            os.chown(path, stat_info.st_uid, stat_info.st_gid)
+        except PermissionError:
+            pass
\ No newline at end of file
@@ -3,7 +3,7 @@
 import os
 import json
 import yaml
-import requests
+import httpclient
 import logging
 import cvutils
 import argparse
@@ -32,7 +32,7 @@ def get_chain_json(ctx):
     print(f"Retrieving chain information from {chain_json_url}...")
     
     chain_json_path = ctx.get('chain_json_path')
-    response = requests.get(chain_json_url)
+    response = httpclient.get(chain_json_url)
     with open(chain_json_path, 'wb') as f:
         f.write(response.content)
 
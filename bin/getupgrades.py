@@ -16,8 +16,14 @@ logging.basicConfig(
 def download_versions(ctx):
     codebase_data = getchaininfo.get_codebase_data(ctx)
     ctx['daemon_name'] = codebase_data.get("daemon_name", ctx["daemon_name"])
-    for version in codebase_data["versions"]:
-        v = cvutils.get_arch_version(ctx, codebase_data, version)
+    versions = [cvutils.get_arch_version(ctx, codebase_data, version) for version in codebase_data["versions"]]
+
+    # fetch every binary and library at once, the upgrades are then set up in order from the local files
+    downloads = [download for v in versions for download in cvutils.cv_upgrade_files(ctx, v)]
+    cvutils.download_files(downloads, int(ctx["download_workers"]), int(ctx["download_per_host"]),
+                           int(ctx["download_retries"]), cache_dir=ctx["binary_cache_dir"],
+                           cache_max_bytes=int(ctx["binary_cache_max_bytes"]))
+    for v in versions:
         cvutils.create_cv_upgrade(ctx, v, False)
 
 
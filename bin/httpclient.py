@@ -0,0 +1,88 @@
+import os
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout used when a caller does not pass one
+DEFAULT_TIMEOUT = (10, 60)
+# retries of idempotent requests on connection errors and retryable statuses
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = (429, 502, 503, 504)
+# hosts kept in the pool and keep-alive connections kept per host
+POOL_HOSTS = 32
+POOL_SIZE = 16
+
+_lock = threading.Lock()
+# shared sessions keyed by their number of retries
+_sessions = {}
+_sessions_pid = None
+
+
+class JitteredRetry(Retry):
+    """
+    Exponential backoff plus up to backoff_factor seconds of jitter, so pods
+    retrying the same endpoint do not do so in lockstep. Unlike the backoff_jitter
+    argument of urllib3 2, this also works with urllib3 1.x.
+    """
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, self.backoff_factor) if backoff else backoff
+
+
+def new_session(retries: int = None, backoff: float = None, pool_size: int = None) -> requests.Session:
+    """
+    Creates a session keeping connections alive per host and retrying idempotent
+    requests with a jittered exponential backoff.
+
+    :param retries: Number of retries, RETRIES if None.
+    :param backoff: Delay before the first retry in seconds, BACKOFF if None.
+    :param pool_size: Connections kept alive per host, POOL_SIZE if None.
+    """
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+    pool_size = POOL_SIZE if pool_size is None else pool_size
+    retry = JitteredRetry(total=retries, connect=retries, read=retries, status=retries, status_forcelist=RETRY_STATUSES,
+                          backoff_factor=backoff, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def session(retries: int = None) -> requests.Session:
+    """
+    Returns a session shared by the whole process, polling loops and concurrent
+    probes reuse its connections. A forked child gets sessions of its own.
+
+    :param retries: Number of retries, RETRIES if None. Probes that must fail fast,
+                    like /status checks, use a session without retries.
+    """
+    global _sessions_pid
+    retries = RETRIES if retries is None else retries
+    with _lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if retries not in _sessions:
+            _sessions[retries] = new_session(retries)
+        return _sessions[retries]
+
+
+def get(url: str, timeout=DEFAULT_TIMEOUT, retries: int = None, **kwargs) -> requests.Response:
+    return session(retries).get(url, timeout=timeout, **kwargs)
+
+
+def head(url: str, timeout=DEFAULT_TIMEOUT, retries: int = None, **kwargs) -> requests.Response:
+    return session(retries).head(url, timeout=timeout, **kwargs)
+
+
+def close() -> None:
+    with _lock:
+        for shared in _sessions.values():
+            shared.close()
+        _sessions.clear()
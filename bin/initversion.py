@@ -3,7 +3,7 @@
 import os
 import json
 import logging
-import requests
+import httpclient
 import argparse
 import subprocess
 from rpcstatus import RpcStatus
@@ -69,7 +69,7 @@ def get_upgrade_info_version(ctx):
         logging.info(f"upgrade info is {info}")
         if isinstance(info, str):
             if info.endswith('.json'):
-                response = requests.get(info)
+                response = httpclient.get(info)
                 info = response.json()
             elif 'binaries' in info:
                 info = json.loads(info)
@@ -1,69 +1,361 @@
 import os
+import json
 import dns.resolver
 import rpcstatus 
 import tomlkit
 import logging
+import time
+import fcntl
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DISCOVERY_TYPES = ["sync", "read", "write", "snap", "archive"]
+# concurrent dns lookups and status probes, and the overall discovery deadline in seconds
+DISCOVERY_WORKERS = 32
+DISCOVERY_DEADLINE = 15
+# persistent peers picked from discovery, peers further behind the best height are dropped
+PEER_LIMIT = 10
+PEER_MAX_LAG = 100
+# milliseconds of round trip one block of lag is worth when ranking peers
+PEER_LAG_PENALTY_MS = 10
+# seconds the cluster height is reused before the services are probed again
+CLUSTER_HEIGHT_TTL = float(os.environ.get("CLUSTER_HEIGHT_TTL", 30))
 
 def is_running_in_k8s():
     return "KUBERNETES_SERVICE_HOST" in os.environ
 
-def get_service_peers(chain, domain):
-    for hostport in get_service_rpc_addresses(chain, domain):
-        try:
-            status = rpcstatus.RpcStatus(f"http://{hostport}/status")
-            ip = hostport.split(":")[0]
-            id = status.node_info.id
-            port = status.node_info.listen_addr.split(":")[2]
-            yield f"{id}@{ip}:{port}"
-        except Exception as e:
-            logging.error(f"Could not retrieve status for {hostport}: {e}")
-            pass
+def get_service_peers(chain, domain, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE):
+    for hostport, status, rtt in discover(chain, domain, True, max_workers, deadline):
+        peer = peer_address(hostport, status)
+        if peer:
+            yield peer
+
+
+def peer_address(hostport, status):
+    try:
+        ip = hostport.split(":")[0]
+        id = status.node_info.id
+        port = status.node_info.listen_addr.split(":")[2]
+        return f"{id}@{ip}:{port}"
+    except Exception as e:
+        logging.error(f"Could not retrieve status for {hostport}: {e}")
+        return None
+
+
+def get_service_rpc_status(chain, domain, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE):
+    for hostport, status, rtt in discover(chain, domain, True, max_workers, deadline):
+        yield status
+
+
+def get_service_rpc_addresses(chain, domain, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE):
+    for hostport, status, rtt in discover(chain, domain, False, max_workers, deadline):
+        yield hostport
+
+
+def resolve_srv(chain, domain, type, lifetime):
+    serviceName = f'_rpc._tcp.discover-{chain}-{type}.{domain}'
+    return [(rdata.target, rdata.port) for rdata in dns.resolver.resolve(serviceName, 'SRV', lifetime=lifetime)]
+
+
+def resolve_a(target, lifetime):
+    return [ip for ip in dns.resolver.resolve(target, 'A', lifetime=lifetime) if ip is not None]
+
+
+def probe_status(hostport):
+    return rpcstatus.RpcStatus(f"http://{hostport}/status")
+
+
+def timed_probe(hostport):
+    start = time.monotonic()
+    status = probe_status(hostport)
+    return status, time.monotonic() - start
+
+
+def discover(chain, domain, probe=True, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE):
+    """
+    Resolves the rpc endpoints of every discovery service of a chain and probes their
+    /status, all lookups and probes running concurrently on a bounded pool. Whatever
+    has not answered when the deadline passes is left out, so dead endpoints cost at
+    most the deadline instead of a timeout each.
+
+    :param chain: Chain name, services are discover-<chain>-<type>.
+    :param domain: Cluster domain of the services.
+    :param probe: Query /status of every endpoint, only endpoints that answered are returned.
+    :param max_workers: Maximum number of concurrent lookups and probes.
+    :param deadline: Seconds after which discovery returns what it has.
+    :return: List of (host:port, RpcStatus or None, round trip seconds or None) tuples in service type order.
+    """
+    stop = time.monotonic() + float(deadline)
+    remaining = lambda: max(stop - time.monotonic(), 0.1)
+    executor = ThreadPoolExecutor(max_workers=int(max_workers))
+    pending = {}
+    for i, type in enumerate(DISCOVERY_TYPES):
+        pending[executor.submit(resolve_srv, chain, domain, type, remaining())] = ('srv', (i,), type)
+
+    results = []
+    orders = {}
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=stop - time.monotonic(), return_when=FIRST_COMPLETED)
+            if not done:
+                logging.warning(f"Peer discovery for {chain} hit its {deadline}s deadline, {len(pending)} lookups or probes unanswered")
+                break
+            for future in done:
+                kind, order, subject = pending.pop(future)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    if kind == 'srv':
+                        logging.warning(f"Could not retrieve dns for _rpc._tcp.discover-{chain}-{subject}.{domain}")
+                    else:
+                        logging.error(f"Could not retrieve {'dns' if kind == 'a' else 'status'} for {subject}: {e}")
+                    continue
+                if kind == 'srv':
+                    for j, (target, port) in enumerate(value):
+                        pending[executor.submit(resolve_a, target, remaining())] = ('a', order + (j,), (target, port))
+                elif kind == 'a':
+                    for j, ip in enumerate(value):
+                        hostport = f"{ip}:{subject[1]}"
+                        if hostport in orders:
+                            # listed by several services, it is probed once and sorted by its first listing
+                            orders[hostport] = min(orders[hostport], order + (j,))
+                            continue
+                        orders[hostport] = order + (j,)
+                        if probe:
+                            pending[executor.submit(timed_probe, hostport)] = ('status', None, hostport)
+                        else:
+                            results.append((hostport, None, None))
+                else:
+                    results.append((subject,) + value)
+    finally:
+        # probes still waiting for a dead endpoint are abandoned
+        executor.shutdown(wait=False, cancel_futures=True)
+    return sorted(results, key=lambda r: orders[r[0]])
 
 
-def get_service_rpc_status(chain, domain):
-    for hostport in get_service_rpc_addresses(chain, domain):
+class ClusterHeight:
+    """
+    Highest block height among the healthy nodes of a chain, cached for ttl seconds
+    in the process and in a small state file shared by the processes of a pod, so
+    frequent probes cost a file read instead of a scan of every service. One
+    process refreshes an expired view while the others keep using the previous
+    height, and long running processes can refresh it in the background.
+    """
+
+    def __init__(self, chain, domain, ttl=CLUSTER_HEIGHT_TTL, state_file=None,
+                 max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE):
+        self.chain = chain
+        self.domain = domain
+        self.ttl = float(ttl)
+        self.state_file = state_file or os.path.join(tempfile.gettempdir(), f"cluster-height-{chain}.json")
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._height = None
+        self._updated = 0
+        self._thread = None
+
+    def _fresh(self):
+        return self._height is not None and time.time() - self._updated < self.ttl
+
+    def _set(self, height, updated):
+        with self._lock:
+            if updated > self._updated:
+                self._height, self._updated = height, updated
+
+    def _load(self):
         try:
-            yield rpcstatus.RpcStatus(f"http://{hostport}/status")
-        except Exception as e:
-            logging.error(f"Could not retrieve status for {hostport}: {e}")
+            with open(self.state_file, "r") as file:
+                state = json.load(file)
+            self._set(state.get("height"), state.get("updated", 0))
+        except (OSError, ValueError, KeyError):
             pass
 
+    def _save(self):
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as file:
+            json.dump({"height": self._height, "updated": self._updated}, file)
+        os.replace(tmp_file, self.state_file)
+
+    def scan(self):
+        """
+        Probes every service concurrently and returns the highest height of the
+        nodes that are not catching up, or None if none answered.
+        """
+        heights = []
+        for hostport, status, rtt in discover(self.chain, self.domain, True, self.max_workers, self.deadline):
+            try:
+                if not status.is_catching_up():
+                    heights.append(int(status.sync_info.latest_block_height))
+            except Exception as e:
+                logging.error(f"Could not retrieve height for {hostport}: {e}")
+        return max(heights) if heights else None
+
+    def refresh(self, blocking=True):
+        """
+        Scans the cluster unless another process or thread is already doing so, in
+        which case the previous height is kept, or waited for if there is none.
+        """
+        with open(f"{self.state_file}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return self._height
+            try:
+                # another process may have refreshed it while this one waited
+                self._load()
+                if self._fresh():
+                    return self._height
+                # the scan runs without the view lock, reads keep the previous height meanwhile
+                height = self.scan()
+                if height is not None:
+                    self._set(height, time.time())
+                    self._save()
+                return self._height
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def height(self):
+        """
+        :return: The cached cluster height, refreshed if it is older than ttl, or None if unknown.
+        """
+        if self._fresh():
+            return self._height
+        self._load()
+        if self._fresh():
+            return self._height
+        return self.refresh(blocking=self._height is None)
+
+    def start(self):
+        """
+        Keeps the view fresh from a daemon thread, so reads never wait for a scan.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"cluster-height-{self.chain}", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                if not self._fresh():
+                    self.refresh()
+            except Exception as e:
+                logging.error(f"Failed to refresh the height of {self.chain}: {e}")
+            time.sleep(max(self.ttl / 2, 1))
+
+
+_cluster_heights = {}
+_cluster_heights_lock = threading.Lock()
+
 
-def get_service_rpc_addresses(chain, domain):
-    for type in ["sync", "read", "write", "snap", "archive"]:
-        for result in get_service_rpc_addresses_type(chain, domain, type):
-            yield result
+def cluster_height(chain, domain, ttl=None, state_file=None, background=False):
+    """
+    Returns the ClusterHeight view of a chain shared by the whole process.
 
+    :param ttl: Seconds the height is reused, CLUSTER_HEIGHT_TTL if None.
+    :param background: Keep the view fresh from a daemon thread, for long running
+                       callers whose reads should only wait while there is no height at all.
+    """
+    with _cluster_heights_lock:
+        view = _cluster_heights.get((chain, domain))
+        if view is None:
+            view = ClusterHeight(chain, domain, CLUSTER_HEIGHT_TTL if ttl is None else ttl, state_file)
+            _cluster_heights[(chain, domain)] = view
+    return view.start() if background else view
 
-def get_service_rpc_addresses_type(chain, domain, type):
+
+def rank_peers(candidates, limit=PEER_LIMIT, max_lag=PEER_MAX_LAG):
+    """
+    Scores probed peers by round trip time and height lag and returns the best ones.
+    Peers that are catching up or more than max_lag blocks behind the highest peer are
+    dropped. The round trip of the /status probe is the only locality signal a peer
+    exposes, so it also ranks peers in the same zone first.
+
+    :param candidates: List of (host:port, RpcStatus, round trip seconds) tuples as returned by discover.
+    :param limit: Maximum number of peers to return.
+    :param max_lag: Maximum number of blocks a peer may be behind.
+    :return: List of id@ip:port peer addresses, best first.
+    """
+    probed = []
+    for hostport, status, rtt in candidates:
+        peer = peer_address(hostport, status)
+        if peer is None:
+            continue
         try:
-            serviceName = f'_rpc._tcp.discover-{chain}-{type}.{domain}'  # Replace with your service and protocol
-            answers = dns.resolver.resolve(serviceName, 'SRV')
-            for rdata in answers:
-                ips = dns.resolver.resolve(rdata.target, 'A')
-                for ip in (ip for ip in ips if ip is not None):
-                    yield f"{ip}:{rdata.port}"
+            height = int(status.sync_info.latest_block_height)
         except Exception as e:
-            logging.warn(f"Could not retrieve dns for {serviceName}")
-            pass
+            logging.error(f"Could not retrieve height for {hostport}: {e}")
+            continue
+        if status.is_catching_up():
+            logging.info(f"Skipping peer {peer}, it is catching up")
+            continue
+        probed.append((peer, height, rtt))
+    if not probed:
+        return []
+
+    best_height = max(height for _, height, _ in probed)
+    scored = {}
+    for peer, height, rtt in probed:
+        lag = best_height - height
+        if lag > int(max_lag):
+            logging.info(f"Skipping peer {peer}, it is {lag} blocks behind")
+            continue
+        score = rtt * 1000 + lag * PEER_LAG_PENALTY_MS
+        # a node reachable through several services is kept once, at its best score
+        node_id = peer.split("@")[0]
+        if node_id not in scored or score < scored[node_id][0]:
+            scored[node_id] = (score, peer)
+    ranked = [peer for _, peer in sorted(scored.values())]
+    for peer in ranked[int(limit):]:
+        logging.info(f"Skipping peer {peer}, over the limit of {limit} peers")
+    return ranked[:int(limit)]
+
+
+def load_managed_peers(state_file):
+    try:
+        with open(state_file, "r") as file:
+            return json.load(file).get("peers", [])
+    except (OSError, ValueError):
+        return []
+
+
+def save_managed_peers(state_file, peers):
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump({"peers": peers, "updated": int(time.time())}, file, indent=2)
+    os.replace(tmp_file, state_file)
+
 
 # Function to add node IDs as persistent peers in config.toml
 def add_persistent_peers(ctx):
+    """
+    Replaces the discovered peers in persistent_peers with the best ranked ones. The
+    peers picked by the previous run are remembered in a state file so they can be
+    replaced when they go stale, peers configured by other means are left untouched.
+    """
     try:
         config_file = ctx["config_toml"]
-        peers = get_service_peers(ctx["chain_name"], ctx["domain"])
+        state_file = ctx.get("peers_state_file", os.path.join(os.path.dirname(config_file), "k8s-peers.json"))
+        candidates = discover(ctx["chain_name"], ctx["domain"], True, int(ctx.get("discovery_workers", DISCOVERY_WORKERS)),
+                              float(ctx.get("discovery_deadline", DISCOVERY_DEADLINE)))
+        peers = rank_peers(candidates, int(ctx.get("peer_limit", PEER_LIMIT)), int(ctx.get("peer_max_lag", PEER_MAX_LAG)))
+        managed_peers = load_managed_peers(state_file)
+        if not peers:
+            # keep the previous peers rather than none while discovery is failing
+            logging.warning("No healthy peers discovered, keeping the current persistent peers")
+            peers = managed_peers
+
         with open(config_file, "r") as file:
             config = tomlkit.parse(file.read())
 
         existing_peers = config.get("p2p", {}).get("persistent_peers", "")
-        existing_peers_set = set(existing_peers.split(',')) if existing_peers else set()
-
-        # Convert the nodes to a set to remove duplicates and then merge with existing
-        peers_set = set(peers)
-        updated_peers_set = existing_peers_set.union(peers_set)
+        existing_peers = [peer for peer in existing_peers.split(',') if peer] if existing_peers else []
 
-        # Convert back to a comma-separated string
-        updated_peers = ",".join(updated_peers_set)
+        # peers not picked by a previous run were configured by hand and are kept first
+        static_peers = [peer for peer in existing_peers if peer not in managed_peers and peer not in peers]
+        updated_peers = ",".join(static_peers + peers)
 
         print(f"Updated persistent peers: {updated_peers}")
 
@@ -71,6 +363,7 @@ def add_persistent_peers(ctx):
 
         with open(config_file, "w") as file:
             file.write(tomlkit.dumps(config))
+        save_managed_peers(state_file, peers)
 
     except Exception as e:
-        print(f"Error updating config file: {e}")
\ No newline at end of file
+        print(f"Error updating config file: {e}")
@@ -0,0 +1,335 @@
+import os
+import re
+import json
+import base64
+import shutil
+import tarfile
+import logging
+import requests
+import contextlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+)
+MANIFEST_TYPES = INDEX_TYPES + (
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+)
+
+# hops through symlinks and hard links before giving up
+MAX_LINKS = 8
+COPY_CHUNK_SIZE = 1024 * 1024
+REGISTRY_TIMEOUT = (30, 300)
+
+# Docker Hub credentials are stored under any of these names
+DOCKER_HUB_NAMES = ('docker.io', 'index.docker.io', 'registry-1.docker.io')
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+
+def auth_files() -> list:
+    """
+    Registry auth files in the order skopeo and podman look them up, see containers-auth.json(5).
+    """
+    if os.environ.get('REGISTRY_AUTH_FILE'):
+        return [os.environ['REGISTRY_AUTH_FILE']]
+    home = os.path.expanduser('~')
+    files = [os.path.join(home, '.config', 'containers', 'auth.json'), os.path.join(home, '.docker', 'config.json')]
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        files.insert(0, os.path.join(os.environ['XDG_RUNTIME_DIR'], 'containers', 'auth.json'))
+    if os.environ.get('DOCKER_CONFIG'):
+        files.append(os.path.join(os.environ['DOCKER_CONFIG'], 'config.json'))
+    return files
+
+
+def registry_credentials(registry: str, repository: str) -> tuple:
+    """
+    Looks up the credentials of a repository in the registry auth files. Entries of
+    a namespace, e.g. ghcr.io/org, take precedence over those of the whole registry.
+
+    :return: Tuple of (username, password), or None if there are none.
+    """
+    hosts = DOCKER_HUB_NAMES if registry in DOCKER_HUB_NAMES else (registry,)
+    parts = repository.split('/')
+    keys = [f"{host}/{'/'.join(parts[:i])}" for host in hosts for i in range(len(parts), 0, -1)] + list(hosts)
+    for auth_file in auth_files():
+        try:
+            with open(auth_file, 'r') as f:
+                auths = json.load(f).get('auths', {})
+        except (OSError, ValueError):
+            continue
+        # docker writes keys like https://index.docker.io/v1/
+        auths = {re.sub(r'^https?://|/v1/?$|/$', '', key): value for key, value in auths.items()}
+        for key in keys:
+            if auths.get(key, {}).get('auth'):
+                username, _, password = base64.b64decode(auths[key]['auth']).decode().partition(':')
+                logging.info(f"Using credentials of {key} from {auth_file}")
+                return username, password
+    return None
+
+
+def parse_reference(image: str) -> tuple:
+    """
+    Splits docker://[registry/]repository[:tag|@digest] into its parts, using the
+    same defaults as docker for Docker Hub images.
+
+    :return: Tuple of (registry, repository, reference).
+    """
+    name = image[len('docker://'):] if image.startswith('docker://') else image
+    registry = 'docker.io'
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, name = first, rest
+    if '@' in name:
+        name, reference = name.split('@', 1)
+    elif ':' in name.rsplit('/', 1)[-1]:
+        name, reference = name.rsplit(':', 1)
+    else:
+        reference = 'latest'
+    if registry == 'docker.io':
+        registry = 'registry-1.docker.io'
+        if '/' not in name:
+            name = f'library/{name}'
+    return registry, name, reference
+
+
+class Registry:
+    """
+    Minimal client of the registry HTTP API, enough to read manifests and stream
+    blobs. On the first 401 a bearer token is requested, with the credentials of
+    the registry auth file skopeo uses if there are any, anonymously otherwise.
+    Registries asking for basic authentication get the credentials directly.
+    """
+
+    def __init__(self, registry: str, repository: str):
+        self.base_url = f'https://{registry}/v2/{repository}'
+        self.session = requests.Session()
+        self.credentials = registry_credentials(registry, repository)
+        self.token = None
+
+    def _get(self, url: str, headers: dict = None, stream: bool = False) -> requests.Response:
+        headers = dict(headers or {})
+        authenticated = False
+        while True:
+            if self.token:
+                headers['Authorization'] = f'Bearer {self.token}'
+            response = self.session.get(url, headers=headers, stream=stream, timeout=REGISTRY_TIMEOUT)
+            if response.status_code == 401 and not authenticated:
+                # a token of an earlier request may have expired
+                self._authenticate(response.headers.get('WWW-Authenticate', ''))
+                authenticated = True
+                response.close()
+                continue
+            response.raise_for_status()
+            return response
+
+    def _authenticate(self, challenge: str) -> None:
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        if challenge.lower().startswith('basic') and self.credentials:
+            self.session.auth = self.credentials
+            return
+        if not challenge.lower().startswith('bearer') or not realm:
+            raise requests.HTTPError(f"Unsupported registry authentication: {challenge}")
+        response = self.session.get(realm, params=params, auth=self.credentials, timeout=REGISTRY_TIMEOUT)
+        response.raise_for_status()
+        self.token = response.json().get('token') or response.json().get('access_token')
+
+    def manifest(self, reference: str) -> dict:
+        return self._get(f'{self.base_url}/manifests/{reference}', {'Accept': ', '.join(MANIFEST_TYPES)}).json()
+
+    @contextlib.contextmanager
+    def open_blob(self, digest: str):
+        with self._get(f'{self.base_url}/blobs/{digest}', stream=True) as response:
+            response.raw.decode_content = True
+            yield response.raw
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class OciLayout:
+    """
+    Local OCI image layout directory, e.g. written by `skopeo copy docker://... oci:<dir>`.
+    """
+
+    def __init__(self, path: str, tag: str = None):
+        self.path = path
+        self.tag = tag
+
+    def _blob_path(self, digest: str) -> str:
+        algorithm, _, encoded = digest.partition(':')
+        return os.path.join(self.path, 'blobs', algorithm, encoded)
+
+    def manifest(self, reference: str) -> dict:
+        if reference is None:
+            with open(os.path.join(self.path, 'index.json'), 'r') as f:
+                index = json.load(f)
+            if self.tag:
+                index['manifests'] = [m for m in index['manifests']
+                                      if m.get('annotations', {}).get('org.opencontainers.image.ref.name') == self.tag]
+            return index
+        with open(self._blob_path(reference), 'r') as f:
+            return json.load(f)
+
+    def open_blob(self, digest: str):
+        return open(self._blob_path(digest), 'rb')
+
+    def close(self) -> None:
+        pass
+
+
+def open_source(image: str) -> tuple:
+    """
+    :return: Tuple of (source, reference) for a docker:// URL or an oci:<dir>[:tag] layout.
+    """
+    if image.startswith('oci:'):
+        path = image[len('oci:'):]
+        tag = None
+        if ':' in os.path.basename(path):
+            path, tag = path.rsplit(':', 1)
+        return OciLayout(path, tag), None
+    registry, repository, reference = parse_reference(image)
+    return Registry(registry, repository), reference
+
+
+def resolve_manifest(source, reference: str, platform: str) -> dict:
+    """
+    Follows image indexes down to the image manifest of the given os/arch platform.
+    """
+    manifest = source.manifest(reference)
+    while manifest.get('mediaType') in INDEX_TYPES or 'manifests' in manifest:
+        candidates = [m for m in manifest['manifests']
+                      if f"{m.get('platform', {}).get('os')}/{m.get('platform', {}).get('architecture')}" == platform]
+        candidates = candidates or [m for m in manifest['manifests'] if 'platform' not in m]
+        if not candidates:
+            raise FileNotFoundError(f"No {platform} image found")
+        manifest = source.manifest(candidates[0]['digest'])
+    return manifest
+
+
+@contextlib.contextmanager
+def open_layer(blob, media_type: str):
+    """
+    Opens a layer blob as a tar stream, gzip and zstd compressed layers are decompressed on the fly.
+    """
+    if media_type.endswith('zstd'):
+        if zstandard is None:
+            raise ImportError("zstd compressed layers require the zstandard package")
+        with zstandard.ZstdDecompressor().stream_reader(blob, read_across_frames=True, closefd=False) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar_ref:
+                yield tar_ref
+    elif media_type.endswith(('gzip', 'tar.gz')):
+        with tarfile.open(fileobj=blob, mode='r|gz') as tar_ref:
+            yield tar_ref
+    else:
+        with tarfile.open(fileobj=blob, mode='r|') as tar_ref:
+            yield tar_ref
+
+
+def normalize(name: str) -> str:
+    return os.path.normpath(os.path.join('/', name)).lstrip('/')
+
+
+def is_hidden(path: str, whiteouts: set, opaques: set) -> bool:
+    """
+    Checks whether upper layers deleted a path, a directory holding it, or replaced
+    such a directory with an opaque one.
+    """
+    if path in whiteouts:
+        return True
+    while path:
+        path = os.path.dirname(path)
+        if path in whiteouts or path in opaques:
+            return True
+    return False
+
+
+def scan_layers(source, layers: list, name: str, path: str, target: str):
+    """
+    Streams the layers from the top, stopping at the first member that is either
+    the path or, while path is None, any file named name. Files, directories and
+    directory contents whited out by an upper layer are skipped.
+
+    :return: True once the file was written to target, the path to look up next
+             when the member is a link, or None if the file does not exist.
+    """
+    whiteouts, opaques = set(), set()
+    for layer in layers:
+        if path and is_hidden(path, whiteouts, opaques):
+            # deleted in an upper layer, lower layers do not count
+            return None
+        # whiteouts only apply to the layers below the one holding them
+        layer_whiteouts, layer_opaques = set(), set()
+        logging.info(f"Searching layer {layer['digest']} for {path or name}...")
+        with source.open_blob(layer['digest']) as blob, open_layer(blob, layer.get('mediaType', '')) as tar_ref:
+            for member in tar_ref:
+                member_path = normalize(member.name)
+                directory, basename = os.path.split(member_path)
+                if basename == OPAQUE_WHITEOUT:
+                    layer_opaques.add(directory)
+                    continue
+                if basename.startswith(WHITEOUT_PREFIX):
+                    layer_whiteouts.add(os.path.join(directory, basename[len(WHITEOUT_PREFIX):]))
+                    continue
+                if path:
+                    if member_path != path:
+                        continue
+                elif basename != name:
+                    continue
+                if is_hidden(member_path, whiteouts, opaques):
+                    continue
+
+                if member.issym():
+                    link = member.linkname if member.linkname.startswith('/') else os.path.join(os.path.dirname(member_path), member.linkname)
+                    return normalize(link)
+                if member.islnk():
+                    return normalize(member.linkname)
+                if member.isfile():
+                    logging.info(f"Found {name} as /{member_path} in layer {layer['digest']}")
+                    tmp_path = f'{target}.tmp'
+                    with tar_ref.extractfile(member) as src, open(tmp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                    os.chmod(tmp_path, member.mode)
+                    os.replace(tmp_path, target)
+                    return True
+        whiteouts |= layer_whiteouts
+        opaques |= layer_opaques
+    return None
+
+
+def extract(image: str, file_to_extract: str, destination: str, platform: str = 'linux/amd64') -> bool:
+    """
+    Extracts a single file from a container image without pulling or unpacking the
+    whole image. Layers are streamed from the top one down and the search stops at
+    the first match, symlinks and hard links are followed across layers.
+
+    :param image: docker://[registry/]repository[:tag|@digest] or oci:<layout dir>[:tag].
+    :param file_to_extract: Name of the file, matched against the last path component.
+    :param destination: Directory to write the file to, under the same name.
+    :param platform: os/arch of the image to use from a multi-platform index.
+    :return: True if the file was extracted, False if the image does not contain it.
+    """
+    source, reference = open_source(image)
+    try:
+        manifest = resolve_manifest(source, reference, platform)
+        layers = list(reversed(manifest['layers']))
+        os.makedirs(destination, exist_ok=True)
+        target = os.path.join(destination, file_to_extract)
+        path = None
+        for _ in range(MAX_LINKS + 1):
+            result = scan_layers(source, layers, file_to_extract, path, target)
+            if result is None or result is True:
+                return bool(result)
+            logging.info(f"/{path or file_to_extract} links to /{result}")
+            path = result
+        logging.error(f"Too many links resolving {file_to_extract} in {image}")
+        return False
+    finally:
+        source.close()
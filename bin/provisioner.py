@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import argparse
+import cvutils
+from rpcstatus import RpcStatus
+from getchaininfo import get_codebase_data
+
+
+def next_upgrade(ctx: dict, height: int) -> dict:
+    """
+    Returns the first upgrade in upgrades.yml above the given height, or None.
+
+    :param ctx: Context dictionary.
+    :param height: Current block height of the node.
+    :return: Version dictionary as returned by cvutils.get_arch_version, with its height.
+    """
+    codebase_data = get_codebase_data(ctx)
+    ctx['daemon_name'] = codebase_data.get("daemon_name", ctx["daemon_name"])
+    upcoming = [v for v in codebase_data.get('versions', []) if v.get('height') and int(v['height']) > height]
+    if not upcoming:
+        return None
+    version = min(upcoming, key=lambda v: int(v['height']))
+    return cvutils.get_arch_version(ctx, codebase_data, version)
+
+
+def is_staged(ctx: dict, version: dict) -> bool:
+    return all(os.path.exists(file) for _, file in cvutils.cv_upgrade_files(ctx, version))
+
+
+def provision(ctx: dict, height: int) -> dict:
+    """
+    Downloads, verifies and stages the binary of the next upgrade once the chain is
+    within provision_distance blocks of it, so cosmovisor finds it in place at the
+    upgrade height instead of fetching it while the node is halted.
+
+    :param ctx: Context dictionary.
+    :param height: Current block height of the node.
+    :return: The staged version, or None if nothing had to be staged.
+    """
+    version = next_upgrade(ctx, height)
+    if version is None:
+        return None
+    distance = int(version['height']) - height
+    if distance > int(ctx["provision_distance"]) or is_staged(ctx, version):
+        return None
+    if not version.get("binary_url"):
+        logging.warning(f"No {ctx['arch']} binary for upgrade {version['name']} at height {version['height']}")
+        return None
+    logging.info(f"Upgrade {version['name']} is {distance} blocks away, staging its binary...")
+    cvutils.create_cv_upgrade(ctx, version, False)
+    return version
+
+
+def main(ctx: dict, once: bool = False) -> int:
+    interval = int(ctx["provision_interval"])
+    while True:
+        try:
+            rpcstatus = RpcStatus(ctx["status_url"])
+            provision(ctx, int(rpcstatus.sync_info.latest_block_height))
+        except Exception as e:
+            logging.error(f"Failed to provision the next upgrade: {e}")
+        if once:
+            return 0
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stage the binary of the next upgrade ahead of its height.')
+    parser.add_argument('--once', action='store_true', help='Check once and exit')
+    args = parser.parse_args()
+    ctx = cvutils.get_ctx(args)
+    exit(main(ctx, args.once))
@@ -1,59 +1,143 @@
 #!/usr/bin/env python3
 
+import os
 import json
-import requests
 import argparse
+import httpclient
 import k8sutils
 import logging
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# blocks a node may be behind the cluster before is_behind reports it
+BEHIND_LAG = 100
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 
 class DictToObject:
+    """
+    Attribute view of a parsed JSON object. Nested objects are only wrapped when
+    they are read, so a probe reading two fields does not build the whole tree.
+    """
+    __slots__ = ('_dict',)
+
     def __init__(self, dictionary):
-        for key, value in dictionary.items():
-            if isinstance(value, dict):
-                value = DictToObject(value)
-            setattr(self, key, value)
+        self._dict = dictionary
+
+    def _get(self, name):
+        try:
+            return self._dict[name]
+        except KeyError:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'") from None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = self._get(name)
+        return DictToObject(value) if isinstance(value, dict) else value
+
+    def __dir__(self):
+        return list(self._dict)
 
     def to_dict(self):
-        return self.__dict__
+        return self._dict
+
+
+class NodeInfo(DictToObject):
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return self._get('id')
+
+    @property
+    def listen_addr(self):
+        return self._get('listen_addr')
+
+
+class SyncInfo(DictToObject):
+    __slots__ = ()
+
+    @property
+    def latest_block_height(self):
+        return self._get('latest_block_height')
+
+    @property
+    def earliest_block_height(self):
+        return self._get('earliest_block_height')
+
+    @property
+    def catching_up(self):
+        return self._get('catching_up')
 
 
 class RpcStatus:
+    __slots__ = ('_data', '_result', '_node_info', '_sync_info')
+
     def __init__(self, rpc_url):
         if rpc_url.startswith('file://'):
-            with open(rpc_url[7:], 'r') as f:
-                self._data = json.load(f)
+            with open(rpc_url[7:], 'rb') as f:
+                self._data = loads(f.read())
         else:
-            response = requests.get(rpc_url, timeout=3)
+            # a probe fails fast, callers poll again or move on to other nodes
+            response = httpclient.get(rpc_url, timeout=3, retries=0)
             response.raise_for_status()
-            self._data = response.json()
-            
-        result = self._data.get('result', self._data)
-        for key, value in result.items():
-            if isinstance(value, dict):
-                value = DictToObject(value)
-            setattr(self, key, value)
+            self._data = loads(response.content)
+
+        self._result = self._data.get('result', self._data)
+        self._node_info = None
+        self._sync_info = None
+
+    @property
+    def node_info(self):
+        if self._node_info is None:
+            self._node_info = NodeInfo(self._field('node_info'))
+        return self._node_info
+
+    @property
+    def sync_info(self):
+        if self._sync_info is None:
+            self._sync_info = SyncInfo(self._field('sync_info'))
+        return self._sync_info
+
+    def _field(self, name):
+        try:
+            return self._result[name]
+        except KeyError:
+            raise AttributeError(f"'RpcStatus' object has no attribute '{name}'") from None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = self._field(name)
+        return DictToObject(value) if isinstance(value, dict) else value
 
     def is_catching_up(self):
         catching_up = str(self.sync_info.catching_up)
         return catching_up.lower() == 'true' or catching_up == '1'
     
 
-    def is_behind(self, chain, domain):
+    def is_behind(self, chain, domain, lag=BEHIND_LAG, ttl=None):
         """
         This function checks for the condition where the block height is behind other nodes
-        but the chains software itself does not know it is behind
+        but the chains software itself does not know it is behind. The height of the other
+        nodes comes from the cached cluster height view, see k8sutils.ClusterHeight.
+
+        :param lag: Number of blocks this node may be behind the cluster.
+        :param ttl: Seconds the cluster height is reused, k8sutils.CLUSTER_HEIGHT_TTL if None.
         """
         # if the chain knows it is catching up return false 
         if self.is_catching_up():
             return False
-        
-        for remote in k8sutils.get_service_rpc_status(chain, domain):
-            if not remote.is_catching_up():
-                if int(remote.sync_info.latest_block_height) > (int(self.sync_info.latest_block_height) + int(100)):
-                    return True
-                
-        return False
+
+        cluster_height = k8sutils.cluster_height(chain, domain, ttl).height()
+        return cluster_height is not None and cluster_height > int(self.sync_info.latest_block_height) + int(lag)
         
     def to_dict(self):
         return self._data
@@ -78,6 +162,8 @@ def main(args):
             print(status.sync_info.earliest_block_height)
         elif args.catching_up:
             print(status.sync_info.catching_up)
+        elif args.behind:
+            print(status.is_behind(args.chain_name, args.domain, args.lag, args.ttl))
         else:
             print(status.json())
 
@@ -95,6 +181,11 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--latest-block-height', dest='latest_block_height', action='store_true', help='Get the Latest Block Height')
     parser.add_argument('-e', '--earliest-block-height', dest='earliest_block_height', action='store_true', help='Get the Earliest Block Height')
     parser.add_argument('-c', '--catching-up', dest='catching_up', action='store_true', help='Get Catching Up')
+    parser.add_argument('-b', '--behind', dest='behind', action='store_true', help='Get whether the node is behind the other nodes of the chain')
+    parser.add_argument('--chain-name', dest='chain_name', default=os.environ.get("CHAIN_NAME"), help='Chain name')
+    parser.add_argument('--domain', dest='domain', default="chains.svc.cluster.local", help='Domain name')
+    parser.add_argument('--ttl', dest='ttl', type=float, default=None, help='Seconds the cluster height is cached, defaults to CLUSTER_HEIGHT_TTL')
+    parser.add_argument('--lag', dest='lag', type=int, default=int(os.environ.get("BEHIND_LAG", BEHIND_LAG)), help='Blocks the node may be behind')
 
     args = parser.parse_args()
 
@@ -0,0 +1,1318 @@
+import os
+import time
+import zipfile
+import tarfile
+import gzip
+import lz4.frame
+import logging
+import json
+import struct
+import contextlib
+import hashlib
+import requests
+import httpclient
+import snapmetrics
+import bisect
+import collections
+import re
+import fnmatch
+import functools
+import stat
+import pwd
+import grp
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# uncompressed bytes per independent lz4 frame in parallel mode
+LZ4_BLOCK_SIZE = 4 * 1024 * 1024
+
+# bytes fetched per ranged request when streaming a snapshot
+STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+
+# indexed archives end with a skippable lz4 frame (ignored by lz4 decoders) holding
+# a json member index followed by a fixed footer of (index length, magic)
+LZ4_SKIPPABLE_MAGIC = 0x184D2A5E
+INDEX_MAGIC = b'CVSNAPIX'
+INDEX_FOOTER = struct.Struct('<Q8s')
+
+LZ4_FRAME_MAGIC = 0x184D2204
+# frames larger than this were not written by ParallelLz4Writer, decode them sequentially
+MAX_PARALLEL_FRAME = 64 * 1024 * 1024
+
+# magic bytes of the supported archive formats
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+# zstd long distance matching window, 2^27 = 128 MiB
+ZSTD_WINDOW_LOG = 27
+ARCHIVE_EXTENSIONS = ('.tar.lz4', '.tar.zst', '.tar.gz')
+
+# exclude patterns containing these are globs, others are prefixes
+GLOB_CHARS = re.compile(r'[*?[]')
+
+# granularity of the checksums in the sidecar written next to every archive
+CHECKSUM_CHUNK_SIZE = 64 * 1024 * 1024
+SIDECAR_SUFFIX = '.sha256.json'
+
+# extracted bytes between two checkpoints of the restore journal
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+
+# members up to this size are buffered and written on the extraction thread pool
+MAX_BUFFERED_MEMBER = 64 * 1024 * 1024
+MAX_PENDING_BYTES = 256 * 1024 * 1024
+
+
+class OrderedChunkReader:
+    """
+    Base for read-only file-like objects whose data is produced in chunks on a
+    thread pool. Subclasses submit chunk tasks from _submit_next, chunks are handed
+    out in submission order with at most `workers` of them in flight.
+    """
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = collections.deque()
+        self._max_pending = workers
+        self._current = memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def readable(self) -> bool:
+        return True
+
+    def _submit_next(self):
+        """
+        Returns the future of the next chunk, or None when there are no more chunks.
+        """
+        raise NotImplementedError
+
+    def _next_chunk(self):
+        while len(self._pending) < self._max_pending:
+            future = self._submit_next()
+            if future is None:
+                break
+            self._pending.append(future)
+        if not self._pending:
+            return None
+        return self._pending.popleft().result()
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while size != 0:
+            if not self._current:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._current = memoryview(chunk)
+            take = len(self._current) if size < 0 else min(size, len(self._current))
+            chunks.append(self._current[:take])
+            self._current = self._current[take:]
+            if size > 0:
+                size -= take
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def probe_url(session: requests.Session, url: str) -> tuple:
+    """
+    Finds the size of a remote archive and whether it can be fetched in ranges.
+    Presigned URLs and some CDNs reject HEAD, a one byte ranged GET is tried then.
+
+    :return: Tuple of (url after redirects, size or 0 if unknown, ranged).
+    """
+    try:
+        response = session.head(url, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length', 0))
+        return response.url, size, response.headers.get('Accept-Ranges') == 'bytes' and size > 0
+    except requests.RequestException as e:
+        logging.warning(f"HEAD {url} failed: {e}, probing with a ranged GET")
+    try:
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            # e.g. bytes 0-0/1234
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if response.status_code == 206 and total.isdigit():
+                return response.url, int(total), int(total) > 0
+    except requests.RequestException as e:
+        logging.warning(f"Ranged GET {url} failed: {e}")
+    return url, 0, False
+
+
+class RangeReader(OrderedChunkReader):
+    """
+    Read-only file-like object over an HTTP URL. Fixed-size byte ranges are fetched
+    on parallel connections and handed out in order, so a snapshot can be piped
+    straight into the decompressor without touching the disk.
+    """
+
+    def __init__(self, url: str, connections: int = 16, chunk_size: int = STREAM_CHUNK_SIZE, retries: int = 3, start: int = 0,
+                 end: int = None):
+        super().__init__(connections)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.url, self.size, self.ranged = probe_url(self._session, url)
+        # nothing past end is fetched, e.g. when only a few members of an indexed archive are read
+        self._end = min(self.size, end) if end is not None else self.size
+        self._chunk_size = chunk_size
+        self._retries = retries
+        self._next_offset = start
+        self._response = None
+        if not self.ranged:
+            if start:
+                raise IOError(f"{url} does not support range requests")
+            logging.warning(f"{url} does not support range requests, streaming on one connection")
+            self._response = self._session.get(self.url, stream=True, timeout=30)
+            self._response.raise_for_status()
+            self._response.raw.decode_content = True
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        for attempt in range(1, self._retries + 1):
+            try:
+                response = self._session.get(self.url, headers={'Range': f'bytes={start}-{end}'}, timeout=60)
+                response.raise_for_status()
+                if response.status_code != 206 or len(response.content) != end - start + 1:
+                    raise IOError(f"Unexpected response for range {start}-{end}")
+                snapmetrics.add('downloaded_bytes', len(response.content))
+                return response.content
+            except (requests.RequestException, IOError) as e:
+                if attempt == self._retries:
+                    raise
+                logging.warning(f"Retrying range {start}-{end} ({attempt}/{self._retries}): {e}")
+                time.sleep(attempt)
+
+    def _submit_next(self):
+        if self._next_offset >= self._end:
+            return None
+        start = self._next_offset
+        end = min(start + self._chunk_size, self._end) - 1
+        self._next_offset = end + 1
+        return self._executor.submit(self._fetch, start, end)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._response is not None:
+            return self._response.raw.read(None if size < 0 else size)
+        return super().read(size)
+
+    def close(self) -> None:
+        if self._response is not None:
+            self._response.close()
+        super().close()
+        self._session.close()
+
+
+class ParallelFrameReader(OrderedChunkReader):
+    """
+    Read-only file-like object that decompresses the independent frames of a
+    multi-frame lz4 archive on a thread pool and returns the data in order.
+    """
+
+    def __init__(self, filepath: str, frames: list, workers: int):
+        super().__init__(workers)
+        self._file = open(filepath, 'rb')
+        self._frames = iter(frames)
+        # uncompressed offset at which each decoded frame starts
+        self.starts = []
+        self._produced = 0
+
+    def _next_chunk(self):
+        chunk = super()._next_chunk()
+        if chunk is not None:
+            self.starts.append(self._produced)
+            self._produced += len(chunk)
+        return chunk
+
+    def _submit_next(self):
+        frame = next(self._frames, None)
+        if frame is None:
+            return None
+        offset, length = frame
+        self._file.seek(offset)
+        snapmetrics.add('archive_bytes', length)
+        return self._executor.submit(lz4.frame.decompress, self._file.read(length))
+
+    def close(self) -> None:
+        super().close()
+        self._file.close()
+
+
+def compile_excludes(exclude_patterns: list):
+    """
+    Compiles exclude patterns into a single matcher. Patterns without glob characters
+    exclude every arcname starting with them, e.g. 'wasm/wasm/cache', glob patterns
+    must match the whole arcname, e.g. '*.log' or 'data/*/LOCK'.
+
+    :param exclude_patterns: List of patterns to exclude.
+    :return: Callable returning True if an arcname is excluded.
+    """
+    prefixes = tuple(pattern for pattern in exclude_patterns if not GLOB_CHARS.search(pattern))
+    globs = [fnmatch.translate(pattern) for pattern in exclude_patterns if GLOB_CHARS.search(pattern)]
+    regex = re.compile('|'.join(globs)) if globs else None
+
+    def excluded(arcname: str) -> bool:
+        if prefixes and arcname.startswith(prefixes):
+            return True
+        return regex is not None and regex.match(arcname) is not None
+    return excluded
+
+
+@functools.lru_cache(maxsize=32)
+def cached_excludes(exclude_patterns: tuple):
+    """
+    Returns the matcher of compile_excludes, compiled once per set of patterns.
+    """
+    return compile_excludes(exclude_patterns)
+
+
+def exclude_function(tarinfo: tarfile.TarInfo, exclude_patterns: list) -> tarfile.TarInfo:
+    """
+    Checks if a file should be excluded from a tarball.
+
+    :param tarinfo: TarInfo object representing the file to check.
+    :param exclude_patterns: List of patterns to exclude.
+    :return: The TarInfo object if it should not be excluded, otherwise None.
+    """
+    if cached_excludes(tuple(exclude_patterns))(tarinfo.name):
+        return None
+    return tarinfo
+
+
+class ParallelLz4Writer:
+    """
+    File-like writer that splits the stream into fixed-size blocks and compresses
+    each block as an independent LZ4 frame on a thread pool.
+
+    Concatenated LZ4 frames are a valid LZ4 stream, so the output can be read back
+    with `lz4 -d` or `lz4.frame.open` like a single-frame archive.
+    """
+
+    def __init__(self, fileobj, workers: int, block_size: int = LZ4_BLOCK_SIZE, compression_level: int = 0):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._compression_level = compression_level
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = collections.deque()
+        self._max_pending = workers * 2
+        self.frame_sizes = []
+
+    @property
+    def block_size(self) -> int:
+        return self._block_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _write_frame(self) -> None:
+        frame = self._pending.popleft().result()
+        self._fileobj.write(frame)
+        self.frame_sizes.append(len(frame))
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._executor.submit(lz4.frame.compress, block, compression_level=self._compression_level))
+        # keep memory bounded by writing finished frames in order
+        while len(self._pending) > self._max_pending:
+            self._write_frame()
+
+    def close(self) -> None:
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_frame()
+        self._executor.shutdown()
+
+
+class Codec:
+    """
+    Compression format of a tarball. Snapshots are written with the codec selected
+    by SNAPSHOT_CODEC and read back with the codec detected from their magic bytes.
+    """
+    name = None
+    extension = None
+    default_level = None
+
+    def __init__(self, level: int = None):
+        self.level = self.default_level if level is None else level
+
+    def writer(self, fileobj, workers: int = 1, framed: bool = False):
+        """
+        Returns a file-like context manager compressing into fileobj.
+
+        :param fileobj: Raw output file, left open when the writer is closed.
+        :param workers: Number of compression threads.
+        :param framed: Write independent lz4 frames that can be indexed.
+        """
+        raise NotImplementedError
+
+    def reader(self, fileobj):
+        """
+        Returns a file-like object decompressing fileobj.
+        """
+        raise NotImplementedError
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    extension = '.tar.lz4'
+    default_level = 0
+
+    def writer(self, fileobj, workers: int = 1, framed: bool = False):
+        if workers > 1 or framed:
+            return ParallelLz4Writer(fileobj, workers, compression_level=self.level)
+        return lz4.frame.open(fileobj, mode='wb', compression_level=self.level)
+
+    def reader(self, fileobj):
+        return lz4.frame.open(fileobj, 'rb')
+
+
+class Lz4HcCodec(Lz4Codec):
+    name = 'lz4-hc'
+    default_level = 9
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = '.tar.zst'
+    default_level = 3
+
+    def __init__(self, level: int = None, window_log: int = ZSTD_WINDOW_LOG):
+        if zstandard is None:
+            raise ImportError("The zstd codec requires the zstandard package")
+        super().__init__(level)
+        self.window_log = window_log
+
+    def writer(self, fileobj, workers: int = 1, framed: bool = False):
+        # long distance matching finds the repeats between leveldb tables that are
+        # further apart than the default window
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.level, threads=workers if workers > 1 else 0,
+            enable_ldm=bool(self.window_log), window_log=self.window_log or 0)
+        return zstandard.ZstdCompressor(compression_params=params).stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj):
+        dctx = zstandard.ZstdDecompressor(max_window_size=1 << 31)
+        return dctx.stream_reader(fileobj, read_across_frames=True, closefd=False)
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.tar.gz'
+    default_level = 6
+
+    def writer(self, fileobj, workers: int = 1, framed: bool = False):
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=self.level)
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+CODECS = {codec.name: codec for codec in [Lz4Codec, Lz4HcCodec, ZstdCodec, GzipCodec]}
+
+
+def get_codec(name: str = 'lz4', level: int = None, window_log: int = ZSTD_WINDOW_LOG) -> Codec:
+    """
+    Returns the codec with the given name.
+
+    :param name: One of lz4, lz4-hc, zstd or gzip.
+    :param level: Compression level, the codec default if None.
+    :param window_log: Long distance matching window of zstd as a power of two, 0 to disable.
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unsupported snapshot codec: {name}")
+    if name == 'zstd':
+        return ZstdCodec(level, window_log)
+    return CODECS[name](level)
+
+
+def detect_format(header: bytes) -> str:
+    """
+    Identifies an archive from its first bytes, skippable frames are stepped over.
+
+    :param header: The first bytes of the archive, at least 512 for plain tarballs.
+    :return: One of lz4, zstd, gzip, zip, tar, or None if the format is unknown.
+    """
+    offset = 0
+    while len(header) >= offset + 8:
+        magic, length = struct.unpack_from('<II', header, offset)
+        if magic & 0xFFFFFFF0 != 0x184D2A50:
+            break
+        offset += 8 + length
+    magic = header[offset:offset + 4]
+    if magic == struct.pack('<I', LZ4_FRAME_MAGIC):
+        return 'lz4'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZIP_MAGIC:
+        return 'zip'
+    if header[257:262] == b'ustar':
+        return 'tar'
+    return None
+
+
+def format_from_name(path: str) -> str:
+    """
+    Guesses the format from the file extension, for streams whose first bytes cannot be peeked at.
+    """
+    path = path.split('?')[0]
+    for codec in [Lz4Codec, ZstdCodec, GzipCodec]:
+        if path.endswith(codec.extension):
+            return codec.name
+    return None
+
+
+def file_format(filepath: str) -> str:
+    try:
+        with open(filepath, 'rb') as f:
+            return detect_format(f.read(512))
+    except OSError:
+        return None
+
+
+def open_tar_reader(fileobj, fmt: str):
+    """
+    Returns a file-like object yielding the uncompressed tar stream of fileobj.
+    """
+    if fmt == 'tar':
+        return fileobj
+    return get_codec(fmt).reader(fileobj)
+
+
+class HashingReader:
+    """
+    Wraps a file object and feeds everything read from it into a hash.
+    """
+
+    def __init__(self, fileobj, hash_obj):
+        self._fileobj = fileobj
+        self.hash = hash_obj
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class HashingWriter:
+    """
+    Wraps a file object and computes the sidecar checksums of everything written
+    to it, the whole-file sha256 and one sha256 per CHECKSUM_CHUNK_SIZE bytes.
+    """
+
+    def __init__(self, fileobj, chunk_size: int = CHECKSUM_CHUNK_SIZE):
+        self._fileobj = fileobj
+        self._total = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        self._chunk_len = 0
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        self._fileobj.write(view)
+        self._total.update(view)
+        self.size += len(view)
+        while view:
+            take = min(len(view), self.chunk_size - self._chunk_len)
+            self._chunk.update(view[:take])
+            self._chunk_len += take
+            view = view[take:]
+            if self._chunk_len == self.chunk_size:
+                self.chunks.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+                self._chunk_len = 0
+        return len(data)
+
+    def flush(self) -> None:
+        self._fileobj.flush()
+
+    def sidecar(self) -> dict:
+        chunks = self.chunks + ([self._chunk.hexdigest()] if self._chunk_len else [])
+        return {
+            'version': 1,
+            'algorithm': 'sha256',
+            'size': self.size,
+            'sha256': self._total.hexdigest(),
+            'chunk_size': self.chunk_size,
+            'chunks': chunks,
+        }
+
+
+class VerifyingReader:
+    """
+    Wraps a file object and checks everything read from it against a sidecar,
+    raising IOError as soon as a chunk does not match.
+    """
+
+    def __init__(self, fileobj, sidecar: dict):
+        self._fileobj = fileobj
+        self._sidecar = sidecar
+        self._total = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        self._chunk_len = 0
+        self._index = 0
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _check_chunk(self) -> None:
+        chunks = self._sidecar['chunks']
+        if self._index >= len(chunks) or self._chunk.hexdigest() != chunks[self._index]:
+            raise IOError(f"Checksum mismatch in chunk {self._index} (bytes {self._index * self._sidecar['chunk_size']}+)")
+        self._index += 1
+        self._chunk = hashlib.sha256()
+        self._chunk_len = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        if not data and size != 0:
+            self._check_end()
+            return data
+        view = memoryview(data)
+        self._total.update(view)
+        self.size += len(view)
+        chunk_size = self._sidecar['chunk_size']
+        while view:
+            take = min(len(view), chunk_size - self._chunk_len)
+            self._chunk.update(view[:take])
+            self._chunk_len += take
+            view = view[take:]
+            if self._chunk_len == chunk_size:
+                self._check_chunk()
+        return data
+
+    def _check_end(self) -> None:
+        if self._chunk_len:
+            self._check_chunk()
+        if self.size != self._sidecar['size'] or self._total.hexdigest() != self._sidecar['sha256']:
+            raise IOError(f"Checksum mismatch, read {self.size} of {self._sidecar['size']} bytes")
+
+    def finish(self) -> None:
+        """
+        Reads and verifies whatever the consumer left unread, e.g. the trailing
+        index frame or padding after the end of the tar stream.
+        """
+        while self.read(CHECKSUM_CHUNK_SIZE):
+            pass
+
+
+def sidecar_path(archive: str) -> str:
+    return f'{archive}{SIDECAR_SUFFIX}'
+
+
+def write_sidecar(archive: str, sidecar: dict) -> None:
+    tmp_path = f'{sidecar_path(archive)}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmp_path, sidecar_path(archive))
+
+
+def load_sidecar(source: str) -> dict:
+    """
+    Loads the sidecar of a local or remote archive.
+
+    :param source: Path or URL of the archive.
+    :return: Sidecar dictionary, or None if the archive has none.
+    """
+    source = source[7:] if source.startswith('file://') else source
+    if source.startswith(('http://', 'https://')):
+        # the query of a presigned archive URL is signed for the archive only
+        url = sidecar_path(source.split('?')[0])
+        response = httpclient.get(url, timeout=30)
+        if response.status_code in (401, 403, 404):
+            # object stores answer 403 for missing keys
+            logging.warning(f"No sidecar at {url} ({response.status_code})")
+            return None
+        response.raise_for_status()
+        return response.json()
+    if not os.path.exists(sidecar_path(source)):
+        return None
+    with open(sidecar_path(source), 'r') as f:
+        return json.load(f)
+
+
+def verify_file(filepath: str, sidecar: dict) -> bool:
+    """
+    Verifies a local archive against its sidecar, stopping at the first bad chunk.
+
+    :param filepath: Path of the archive.
+    :param sidecar: Sidecar dictionary, verification is skipped when None.
+    :return: True if the archive matches or there is nothing to verify against, False otherwise.
+    """
+    if not sidecar:
+        logging.warning(f"No checksums for {filepath}, skipping verification")
+        return True
+    try:
+        with open(filepath, 'rb') as f:
+            reader = VerifyingReader(f, sidecar)
+            reader.finish()
+    except IOError as e:
+        logging.error(f"{filepath} is corrupt or incomplete: {e}")
+        return False
+    logging.info(f"Verified {filepath} ({sidecar['size']} bytes)")
+    return True
+
+
+def iter_files(directories_to_tar: list, exclude_patterns: list, include_dirs: bool = False):
+    """
+    Scans the given directories and yields the files to include in a tarball.
+
+    Excluded directories are skipped without being listed. The stat of every file
+    comes from the directory scan and is passed on, and the entries of a directory
+    are visited in inode order, which mostly follows their placement on disk.
+
+    :param directories_to_tar: List of directories to scan.
+    :param exclude_patterns: List of patterns to exclude.
+    :param include_dirs: Also yield every directory, before its contents.
+    :return: Generator of (file_path, arcname, stat_result) tuples.
+    """
+    excluded = compile_excludes(exclude_patterns)
+    for directory in directories_to_tar:
+        directory = os.path.normpath(directory)
+        # arcnames are relative to the parent, e.g. data/... and wasm/... for chain_home
+        stack = [(directory, os.path.basename(directory))]
+        if include_dirs:
+            yield directory, stack[0][1], os.lstat(directory)
+        while stack:
+            path, arcdir = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda entry: entry.inode())
+            except OSError as e:
+                logging.warning(f"Skipping {path}: {e}")
+                continue
+            subdirs = []
+            for entry in entries:
+                arcname = f'{arcdir}/{entry.name}'
+                if excluded(arcname):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if not excluded(f'{arcname}/'):
+                        subdirs.append((entry.path, arcname))
+                        if include_dirs:
+                            yield entry.path, arcname, entry.stat(follow_symlinks=False)
+                elif include_dirs or not entry.is_dir():
+                    # like os.walk, symlinked directories are not followed, and only
+                    # listed as links when directories are listed too
+                    yield entry.path, arcname, entry.stat(follow_symlinks=False)
+            stack.extend(reversed(subdirs))
+
+
+@functools.lru_cache(maxsize=None)
+def user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ''
+
+
+@functools.lru_cache(maxsize=None)
+def group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+
+def make_tarinfo(tar: tarfile.TarFile, file_path: str, arcname: str, st: os.stat_result = None) -> tarfile.TarInfo:
+    """
+    Builds the header of a regular file from a stat result already taken, saving
+    the lstat and the user and group lookups of tar.gettarinfo for every file.
+    Anything else, including hard links within the tarball, goes through gettarinfo.
+    """
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return tar.gettarinfo(file_path, arcname=arcname)
+    if st.st_nlink > 1:
+        inode = (st.st_ino, st.st_dev)
+        if inode in tar.inodes and tar.inodes[inode] != arcname:
+            return tar.gettarinfo(file_path, arcname=arcname)
+        tar.inodes[inode] = arcname
+    tar_info = tarfile.TarInfo(arcname)
+    tar_info.mode = st.st_mode
+    tar_info.uid = st.st_uid
+    tar_info.gid = st.st_gid
+    tar_info.size = st.st_size
+    tar_info.mtime = st.st_mtime
+    tar_info.uname = user_name(st.st_uid)
+    tar_info.gname = group_name(st.st_gid)
+    tar_info.tarfile = tar
+    return tar_info
+
+
+def add_files(tar: tarfile.TarFile, files, digests: dict = None, members: dict = None) -> None:
+    """
+    Adds files to an open tarball.
+
+    :param tar: Tarfile opened for writing.
+    :param files: Iterable of (file_path, arcname, stat_result) tuples, the stat may be None.
+    :param digests: Optional dict filled with the sha256 of each added file, keyed by arcname.
+    :param members: Optional dict filled with the [offset, size] of each member in the tar stream.
+    """
+    for file_path, arcname, st in files:
+        tar_info = make_tarinfo(tar, file_path, arcname, st)
+        if members is not None:
+            members[arcname] = [tar.offset, tar_info.size]
+        with open(file_path, 'rb') as raw, snapmetrics.MeteredFile(raw, 'source') as file_obj:
+            if digests is None:
+                tar.addfile(tar_info, file_obj)
+            else:
+                reader = HashingReader(file_obj, hashlib.sha256())
+                tar.addfile(tar_info, reader)
+                digests[arcname] = reader.hash.hexdigest()
+        snapmetrics.add('files')
+
+
+def write_index(fileobj, writer: ParallelLz4Writer, members: dict) -> None:
+    """
+    Appends the member index of a multi-frame archive as a skippable lz4 frame.
+
+    :param fileobj: Raw archive file, positioned after the last lz4 frame.
+    :param writer: Writer that produced the frames.
+    :param members: Dictionary of arcname to [offset, size] in the uncompressed tar stream.
+    """
+    frames = [0]
+    for size in writer.frame_sizes:
+        frames.append(frames[-1] + size)
+    payload = json.dumps({
+        'version': 1,
+        'block_size': writer.block_size,
+        'frames': frames,
+        'members': members,
+    }).encode()
+    payload += INDEX_FOOTER.pack(len(payload), INDEX_MAGIC)
+    fileobj.write(struct.pack('<II', LZ4_SKIPPABLE_MAGIC, len(payload)))
+    fileobj.write(payload)
+
+
+def compress_files(filename: str, files, workers: int = 1, digests: dict = None, indexed: bool = False,
+                   sidecar: bool = False, codec: Codec = None) -> bool:
+    """
+    Creates a tarball of the given files and compresses it, using LZ4 by default.
+
+    :param filename: Name of the file to create.
+    :param files: Iterable of (file_path, arcname, stat_result) tuples.
+    :param workers: Number of compression threads, more than 1 writes a multi-frame archive.
+    :param digests: Optional dict filled with the sha256 of each added file, keyed by arcname.
+    :param indexed: Write a multi-frame archive with a trailing member index, lz4 codecs only.
+    :param sidecar: Hash the archive while it is written and save the checksums next to it.
+    :param codec: Codec to compress with, defaults to lz4.
+    :return: True if the archive was written with a member index, False otherwise.
+    """
+    if codec is None and not (sidecar or workers > 1 or indexed):
+        with lz4.frame.open(filename, mode='wb') as lz4_file:
+            with tarfile.open(fileobj=lz4_file, mode='w|') as tar:
+                add_files(tar, files, digests)
+        return False
+
+    codec = codec or Lz4Codec()
+    if indexed and not isinstance(codec, Lz4Codec):
+        logging.warning(f"The {codec.name} codec cannot be indexed, writing {filename} without an index")
+        indexed = False
+
+    with open(filename, 'wb') as raw, snapmetrics.MeteredFile(raw, 'archive') as raw_file:
+        out_file = HashingWriter(raw_file) if sidecar else raw_file
+        members = {} if indexed else None
+        with codec.writer(out_file, workers, framed=indexed) as compressed_file:
+            with tarfile.open(fileobj=compressed_file, mode='w|') as tar:
+                add_files(tar, files, digests, members)
+        if indexed:
+            write_index(out_file, compressed_file, members)
+
+    if sidecar:
+        write_sidecar(filename, out_file.sidecar())
+    return indexed
+
+
+def read_range(source: str, offset: int, length: int) -> bytes:
+    """
+    Reads a byte range of a local file or URL, a negative offset counts from the end.
+    """
+    if source.startswith(('http://', 'https://')):
+        byte_range = f'bytes=-{-offset}' if offset < 0 else f'bytes={offset}-{offset + length - 1}'
+        response = httpclient.get(source, headers={'Range': byte_range}, timeout=30)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"{source} does not support range requests")
+        return response.content[:length]
+    path = source[7:] if source.startswith('file://') else source
+    with open(path, 'rb') as f:
+        f.seek(offset, os.SEEK_END if offset < 0 else os.SEEK_SET)
+        return f.read(length)
+
+
+def read_index(source: str) -> dict:
+    """
+    Reads the member index of a seekable archive.
+
+    :param source: Path or URL of the archive.
+    :return: The index, or None if the archive has no index.
+    """
+    try:
+        length, magic = INDEX_FOOTER.unpack(read_range(source, -INDEX_FOOTER.size, INDEX_FOOTER.size))
+        if magic != INDEX_MAGIC:
+            return None
+        return json.loads(read_range(source, -(INDEX_FOOTER.size + length), length))
+    except (OSError, struct.error, ValueError, requests.RequestException):
+        return None
+
+
+def skip_bytes(reader, count: int) -> None:
+    """
+    Reads and discards count bytes, raising IOError if the stream ends first.
+    """
+    while count > 0:
+        data = reader.read(min(count, STREAM_CHUNK_SIZE))
+        if not data:
+            raise IOError(f"Unexpected end of stream, {count} bytes short")
+        count -= len(data)
+
+
+def open_at(source: str, offset: int, connections: int = 16, end: int = None):
+    """
+    Opens a local file or URL positioned at the given compressed offset. Remote
+    sources are not read past end.
+    """
+    if source.startswith(('http://', 'https://')):
+        return RangeReader(source, connections, start=offset, end=end)
+    path = source[7:] if source.startswith('file://') else source
+    raw = open(path, 'rb')
+    raw.seek(offset)
+    return raw
+
+
+def extract_members(source: str, extract_to: str, include: list, connections: int = 16, owner: tuple = None) -> bool:
+    """
+    Extracts the members matching the include prefixes from a seekable archive,
+    decompressing only the frames that hold them.
+
+    :param source: Path or URL of the archive.
+    :param extract_to: Directory to extract the members to.
+    :param include: List of path prefixes to extract, e.g. ['wasm/'].
+    :param connections: Number of parallel range requests for remote archives.
+    :param owner: Optional (uid, gid) every extracted path is given.
+    :return: True if the members were extracted, False if the archive is not indexed.
+    """
+    index = read_index(source)
+    if index is None:
+        return False
+
+    block_size = index['block_size']
+    members = sorted((offset, name) for name, (offset, size) in index['members'].items())
+    wanted = [name.startswith(tuple(include)) for offset, name in members]
+    logging.info(f"Extracting {sum(wanted)} of {len(members)} members from {source}")
+
+    created_dirs = set()
+    i = 0
+    while i < len(members):
+        if not wanted[i]:
+            i += 1
+            continue
+        # extract the contiguous run of wanted members starting at i
+        j = i
+        while j < len(members) and wanted[j]:
+            j += 1
+        offset = members[i][0]
+        frame = offset // block_size
+        # the run ends where the header of the next member starts
+        last_frame = (members[j][0] - 1) // block_size if j < len(members) else len(index['frames']) - 2
+        end = index['frames'][min(last_frame + 1, len(index['frames']) - 1)]
+        with open_at(source, index['frames'][frame], connections, end) as raw:
+            with lz4.frame.open(raw, 'rb') as lz4_ref:
+                skip_bytes(lz4_ref, offset - frame * block_size)
+                with tarfile.open(fileobj=lz4_ref, mode='r|') as tar_ref:
+                    for count, member in enumerate(tar_ref, 1):
+                        extract_owned(tar_ref, member, extract_to, owner, created_dirs)
+                        if count == j - i:
+                            break
+        i = j
+    return True
+
+
+def lz4_frames(filepath: str) -> list:
+    """
+    Locates the independent frames of an lz4 archive from its index, or by walking
+    the frame and block headers without decompressing anything.
+
+    :param filepath: Path to the .tar.lz4 archive.
+    :return: List of (offset, length) tuples, or None if the archive cannot be decoded in parallel.
+    """
+    index = read_index(filepath)
+    if index is not None:
+        offsets = index['frames']
+        return [(start, end - start) for start, end in zip(offsets, offsets[1:])]
+
+    frames = []
+    try:
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                magic, = struct.unpack('<I', f.read(4))
+                if magic & 0xFFFFFFF0 == 0x184D2A50:
+                    length, = struct.unpack('<I', f.read(4))
+                    offset += 8 + length
+                    continue
+                if magic != LZ4_FRAME_MAGIC:
+                    return None
+                flg = f.read(2)[0]
+                block_checksum = 4 if flg & 0x10 else 0
+                pos = offset + 7 + (8 if flg & 0x08 else 0) + (4 if flg & 0x01 else 0)
+                while True:
+                    f.seek(pos)
+                    block, = struct.unpack('<I', f.read(4))
+                    pos += 4
+                    if block == 0:
+                        break
+                    pos += (block & 0x7FFFFFFF) + block_checksum
+                    if pos - offset > MAX_PARALLEL_FRAME:
+                        return None
+                pos += 4 if flg & 0x04 else 0
+                frames.append((offset, pos - offset))
+                offset = pos
+    except (struct.error, IndexError):
+        return None
+    return frames if len(frames) > 1 else None
+
+
+def set_owner(path: str, owner: tuple) -> None:
+    """
+    Gives an extracted path to owner without following symlinks. Paths on shared
+    volumes the process may not change are left as they are.
+    """
+    if owner:
+        with contextlib.suppress(PermissionError):
+            os.lchown(path, *owner)
+
+
+def make_parents(directory: str, owner: tuple, created_dirs: set) -> None:
+    """
+    Creates a directory and its missing parents, giving the new ones to owner.
+    """
+    if directory in created_dirs:
+        return
+    missing = []
+    path = directory
+    while owner and not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    for path in missing:
+        set_owner(path, owner)
+    created_dirs.add(directory)
+
+
+def extract_owned(tar_ref: tarfile.TarFile, member: tarfile.TarInfo, extract_to: str, owner: tuple, created_dirs: set,
+                  set_attrs: bool = True) -> None:
+    """
+    Extracts a single member with tarfile, giving it and the directories created for it to owner.
+    """
+    target = os.path.join(extract_to, member.name)
+    if owner:
+        make_parents(os.path.dirname(target), owner, created_dirs)
+    tar_ref.extract(member, extract_to, set_attrs=set_attrs)
+    set_owner(target, owner)
+
+
+def set_directory_attrs(tar_ref: tarfile.TarFile, directories: list, extract_to: str, owner: tuple) -> None:
+    """
+    Applies the mode and mtime of extracted directories once everything inside them
+    is written, deepest first like tarfile.extractall, so a read-only directory does
+    not block its own files and writing them does not change its mtime.
+    """
+    for member in sorted(directories, key=lambda member: member.name, reverse=True):
+        path = os.path.join(extract_to, member.name)
+        if not owner:
+            tar_ref.chown(member, path, False)
+        tar_ref.utime(member, path)
+        tar_ref.chmod(member, path)
+
+
+def write_member(path: str, data: bytes, mode: int, mtime: float, owner: tuple = None) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+        if owner:
+            # before chmod, changing the owner clears setuid bits
+            with contextlib.suppress(PermissionError):
+                os.fchown(f.fileno(), *owner)
+    os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+
+def extract_tar_stream(tar_ref: tarfile.TarFile, extract_to: str, workers: int, include: list = None,
+                       checkpoint=None, skip_to: int = 0, owner: tuple = None) -> None:
+    """
+    Extracts a tarball, writing regular files on a thread pool while the next
+    members are being read and decompressed.
+
+    :param tar_ref: Tarfile opened for reading, may be a stream.
+    :param extract_to: Directory to extract the tarball to.
+    :param workers: Number of writer threads.
+    :param include: Optional list of path prefixes, only matching members are extracted.
+    :param checkpoint: Optional callable, called every CHECKPOINT_BYTES with the tar offset
+                       of the next member once every member before it has been written.
+    :param skip_to: Skip the members before this tar offset, they were already extracted.
+    :param owner: Optional (uid, gid) given to every path as it is created, so no
+                  recursive chown is needed afterwards.
+    """
+    root = os.path.realpath(extract_to)
+    created_dirs = set()
+    directories = []
+    pending = collections.deque()
+    pending_bytes = 0
+    since_checkpoint = 0
+
+    def drain() -> None:
+        nonlocal pending_bytes
+        while pending:
+            pending.popleft()[0].result()
+        pending_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for member in tar_ref:
+            included = not include or member.name.startswith(tuple(include))
+            if member.offset < skip_to:
+                # created before the interruption, their attributes are still set at the end
+                if member.isdir() and included:
+                    directories.append(member)
+                continue
+            if checkpoint and since_checkpoint >= CHECKPOINT_BYTES:
+                drain()
+                checkpoint(member.offset)
+                since_checkpoint = 0
+            since_checkpoint += member.size
+            if not included:
+                continue
+            snapmetrics.add('extracted_files')
+            snapmetrics.add('extracted_bytes', member.size)
+            if member.isdir():
+                extract_owned(tar_ref, member, extract_to, owner, created_dirs, set_attrs=False)
+                directories.append(member)
+                continue
+            if not member.isreg() or member.size > MAX_BUFFERED_MEMBER:
+                if member.islnk():
+                    # the link target may still be queued on the pool
+                    drain()
+                extract_owned(tar_ref, member, extract_to, owner, created_dirs)
+                continue
+
+            target = os.path.realpath(os.path.join(root, member.name))
+            if not target.startswith(root + os.sep):
+                raise ValueError(f"Refusing to extract {member.name} outside of {extract_to}")
+            make_parents(os.path.dirname(target), owner, created_dirs)
+
+            data = tar_ref.extractfile(member).read()
+            pending.append((executor.submit(write_member, target, data, member.mode, member.mtime, owner), len(data)))
+            pending_bytes += len(data)
+            while pending_bytes > MAX_PENDING_BYTES:
+                future, size = pending.popleft()
+                future.result()
+                pending_bytes -= size
+        drain()
+    set_directory_attrs(tar_ref, directories, extract_to, owner)
+
+
+def extract_zip_parallel(filepath: str, extract_to: str, workers: int, names: list = None, owner: tuple = None) -> None:
+    """
+    Extracts a zip file, every worker inflates its own share of the members.
+    """
+    if names is None:
+        with zipfile.ZipFile(filepath, 'r') as zip_ref:
+            names = zip_ref.namelist()
+    created_dirs = set()
+
+    def extract_names(batch):
+        with zipfile.ZipFile(filepath, 'r') as zip_ref:
+            for name in batch:
+                if owner:
+                    make_parents(os.path.dirname(os.path.join(extract_to, name)), owner, created_dirs)
+                set_owner(zip_ref.extract(name, extract_to), owner)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(extract_names, [names[i::workers] for i in range(workers)]))
+
+
+class RestoreJournal:
+    """
+    Progress of a restore, kept outside the data directory. When a restore of the
+    same snapshot is interrupted, the next one skips the reset and continues after
+    the last checkpoint instead of extracting everything again.
+    """
+
+    def __init__(self, path: str, source: str):
+        """
+        :param path: Path of the journal file.
+        :param source: Identity of the snapshot being restored, a journal left by a
+                       different snapshot is discarded.
+        """
+        self.path = path
+        self.state = {'source': source, 'completed': [], 'archives': {}}
+        self.resumable = False
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+            except ValueError:
+                state = None
+            if state and state.get('source') == source:
+                self.state = state
+                self.resumable = True
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def begin(self) -> None:
+        self._save()
+
+    @staticmethod
+    def _key(archive: str) -> str:
+        # a presigned URL may be signed again between two attempts
+        return os.path.basename(archive.split('?')[0])
+
+    def completed(self, archive: str) -> bool:
+        return self._key(archive) in self.state['completed']
+
+    def checkpoint(self, archive: str) -> dict:
+        return self.state['archives'].get(self._key(archive))
+
+    def update(self, archive: str, state: dict) -> None:
+        self.state['archives'][self._key(archive)] = state
+        self._save()
+
+    def finish(self, archive: str) -> None:
+        self.state['completed'].append(self._key(archive))
+        self.state['archives'].pop(self._key(archive), None)
+        self._save()
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def extract_tar_resumable(filepath: str, fmt: str, extract_to: str, workers: int, include: list,
+                          journal: RestoreJournal, owner: tuple = None) -> None:
+    """
+    Extracts a tarball, checkpointing its progress in the journal.
+
+    Multi-frame lz4 archives resume decompression at the frame holding the next
+    member, other formats are decompressed from the start again but the members
+    extracted before the checkpoint are not rewritten.
+    """
+    state = journal.checkpoint(filepath) or {'tar_offset': 0}
+    frames = lz4_frames(filepath) if fmt == 'lz4' else None
+    with contextlib.ExitStack() as stack:
+        if frames:
+            first = state.get('frame', 0)
+            reader_base = state.get('frame_start', 0)
+            snapmetrics.expect('archive_bytes', sum(length for offset, length in frames[first:]))
+            reader = stack.enter_context(ParallelFrameReader(filepath, frames[first:], max(workers, 1)))
+            skip_bytes(reader, state['tar_offset'] - reader_base)
+            tar_base, skip_to = state['tar_offset'], 0
+        else:
+            snapmetrics.expect('archive_bytes', os.path.getsize(filepath))
+            raw = stack.enter_context(open(filepath, 'rb'))
+            metered = stack.enter_context(snapmetrics.MeteredFile(raw, 'archive'))
+            reader = stack.enter_context(open_tar_reader(metered, fmt))
+            tar_base, skip_to = 0, state['tar_offset']
+        if state['tar_offset']:
+            logging.info(f"Resuming {filepath} at member offset {state['tar_offset']}")
+
+        def checkpoint(offset: int) -> None:
+            position = tar_base + offset
+            update = {'tar_offset': position}
+            if frames:
+                i = bisect.bisect_right(reader.starts, position - reader_base) - 1
+                update.update(frame=first + i, frame_start=reader_base + reader.starts[i])
+            journal.update(filepath, update)
+
+        with tarfile.open(fileobj=reader, mode='r|') as tar_ref:
+            extract_tar_stream(tar_ref, extract_to, workers, include, checkpoint, skip_to, owner)
+
+
+def extract_file(filepath: str, extract_to: str, include: list = None, workers: int = 1, journal: RestoreJournal = None,
+                 owner: tuple = None) -> bool:
+    """
+    Extracts a file to a given directory, the format is detected from its magic bytes.
+
+    :param filepath: Path to the file to extract.
+    :param extract_to: Directory to extract the file to.
+    :param include: Optional list of path prefixes, only matching members are extracted.
+    :param workers: Number of threads decompressing frames and writing files.
+    :param journal: Optional RestoreJournal recording the progress, tarballs then
+                    continue from the last checkpoint of an interrupted restore.
+    :param owner: Optional (uid, gid) every extracted path is given.
+    :return: True if the file was successfully extracted, False otherwise.
+    """
+    fmt = file_format(filepath)
+    if fmt is None:
+        logging.error("Unsupported file format")
+        return False
+
+    if journal and fmt != 'zip':
+        if journal.completed(filepath):
+            logging.info(f"{filepath} was already extracted")
+        else:
+            extract_tar_resumable(filepath, fmt, extract_to, workers, include, journal, owner)
+            journal.finish(filepath)
+        return True
+
+    if include and fmt == 'lz4' and extract_members(filepath, extract_to, include, owner=owner):
+        return True
+
+    if fmt == 'zip':
+        with zipfile.ZipFile(filepath, 'r') as zip_ref:
+            names = [name for name in zip_ref.namelist() if name.startswith(tuple(include))] if include else None
+            if workers <= 1 and not owner:
+                zip_ref.extractall(extract_to, members=names)
+        if workers > 1 or owner:
+            extract_zip_parallel(filepath, extract_to, max(workers, 1), names, owner)
+        return True
+
+    frames = lz4_frames(filepath) if fmt == 'lz4' and workers > 1 else None
+    if frames:
+        logging.info(f"Decompressing {len(frames)} frames of {filepath} with {workers} workers")
+        with ParallelFrameReader(filepath, frames, workers) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar_ref:
+                extract_tar_stream(tar_ref, extract_to, workers, include, owner=owner)
+        return True
+
+    with open(filepath, 'rb') as raw:
+        with open_tar_reader(raw, fmt) as tar_stream:
+            with tarfile.open(fileobj=tar_stream, mode='r|') as tar_ref:
+                if workers > 1 or owner:
+                    extract_tar_stream(tar_ref, extract_to, max(workers, 1), include, owner=owner)
+                else:
+                    members = (member for member in tar_ref if member.name.startswith(tuple(include))) if include else None
+                    tar_ref.extractall(extract_to, members=members)
+    return True
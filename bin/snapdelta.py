@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import snaparchive
+import snapmetrics
+
+# pointer to the newest archive of the incremental chain
+HEAD_FILE = 'incremental-head.json'
+
+
+def manifest_path(archive: str) -> str:
+    return f'{archive}.manifest.json'
+
+
+def load_manifest(archive: str) -> dict:
+    with open(manifest_path(archive), 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(archive: str, manifest: dict) -> None:
+    tmp_path = f'{manifest_path(archive)}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(archive))
+
+
+def get_head(snapshots_dir: str) -> dict:
+    """
+    Returns the head of the incremental chain.
+
+    :param snapshots_dir: Directory containing the snapshots.
+    :return: Dictionary with the head 'archive' name and chain 'depth', or None.
+    """
+    head_file = os.path.join(snapshots_dir, HEAD_FILE)
+    if not os.path.exists(head_file):
+        return None
+    with open(head_file, 'r') as f:
+        head = json.load(f)
+    if not os.path.exists(manifest_path(os.path.join(snapshots_dir, head['archive']))):
+        logging.warning(f"Manifest for incremental head {head['archive']} is missing")
+        return None
+    return head
+
+
+def set_head(snapshots_dir: str, archive: str, depth: int) -> None:
+    head_file = os.path.join(snapshots_dir, HEAD_FILE)
+    with open(f'{head_file}.tmp', 'w') as f:
+        json.dump({'archive': os.path.basename(archive), 'depth': depth}, f)
+    os.replace(f'{head_file}.tmp', head_file)
+
+
+def scan(directories: list, exclude_patterns: list) -> dict:
+    """
+    Stats every file that would be included in a snapshot.
+
+    :param directories: List of directories to include.
+    :param exclude_patterns: List of patterns to exclude.
+    :return: Dictionary of arcname to (file_path, size, mtime_ns, stat_result).
+    """
+    files = {}
+    for file_path, arcname, st in snaparchive.iter_files(directories, exclude_patterns):
+        files[arcname] = (file_path, st.st_size, st.st_mtime_ns, st)
+    return files
+
+
+def create(snapshots_dir: str, identifier: str, directories: list, exclude_patterns: list,
+           workers: int = 1, full_every: int = 12, codec=None) -> str:
+    """
+    Creates an incremental snapshot. Files whose size and mtime match the previous
+    manifest are skipped, everything else is written to a delta-<id>.tar.lz4 archive
+    together with the list of deleted files. A full snapshot with a manifest is
+    taken when there is no chain yet or the chain reached full_every deltas.
+
+    :param snapshots_dir: Directory to save the snapshot in.
+    :param identifier: Identifier (block height) of the snapshot.
+    :param directories: List of directories to include.
+    :param exclude_patterns: List of patterns to exclude.
+    :param workers: Number of compression threads.
+    :param full_every: Maximum number of deltas on top of a full snapshot.
+    :param codec: Codec to compress the archive with, defaults to lz4.
+    :return: Path of the created archive.
+    """
+    extension = codec.extension if codec else '.tar.lz4'
+    head = get_head(snapshots_dir)
+    current = scan(directories, exclude_patterns)
+
+    if head and head['depth'] < full_every:
+        parent = load_manifest(os.path.join(snapshots_dir, head['archive']))
+        previous = parent['files']
+        changed = [
+            arcname for arcname, (_, size, mtime_ns, _) in current.items()
+            if arcname not in previous or previous[arcname][0] != size or previous[arcname][1] != mtime_ns
+        ]
+        deleted = sorted(set(previous) - set(current))
+        archive = os.path.join(snapshots_dir, f'delta-{identifier}{extension}')
+        manifest = {'type': 'delta', 'parent': head['archive'], 'deleted': deleted}
+        depth = head['depth'] + 1
+        logging.info(f"Compressing {len(changed)} changed files ({len(deleted)} deleted) to {archive}")
+    else:
+        previous = {}
+        changed = list(current)
+        archive = os.path.join(snapshots_dir, f'snapshot-{identifier}{extension}')
+        manifest = {'type': 'full', 'parent': None, 'deleted': []}
+        depth = 0
+        logging.info(f"Compressing full incremental base to {archive}")
+
+    digests = {}
+    snapmetrics.expect('source_bytes', sum(current[arcname][1] for arcname in changed))
+    snaparchive.compress_files(archive, ((current[arcname][0], arcname, current[arcname][3]) for arcname in changed), workers, digests,
+                            sidecar=True, codec=codec)
+
+    manifest['archive'] = os.path.basename(archive)
+    manifest['created_at'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    manifest['files'] = {
+        arcname: [size, mtime_ns, digests[arcname] if arcname in digests else previous[arcname][2]]
+        for arcname, (_, size, mtime_ns, _) in current.items()
+    }
+    write_manifest(archive, manifest)
+    set_head(snapshots_dir, archive, depth)
+    return archive
+
+
+def is_delta(archive: str) -> bool:
+    return os.path.basename(archive).startswith('delta-')
+
+
+def resolve_chain(archive: str, fetch=None) -> list:
+    """
+    Collects the archives an incremental snapshot is rebuilt from.
+
+    :param archive: Path of the delta archive.
+    :param fetch: Optional callable that makes an archive name available locally
+                  (together with its manifest) and returns its path.
+    :return: List of (path, manifest) tuples from the full base up to the archive,
+             or None if a manifest is missing.
+    """
+    directory = os.path.dirname(archive)
+    chain = []
+    name = os.path.basename(archive)
+    while name:
+        path = fetch(name) if fetch else os.path.join(directory, name)
+        if not os.path.exists(manifest_path(path)):
+            logging.error(f"Manifest for {name} not found, cannot rebuild incremental chain")
+            return None
+        manifest = load_manifest(path)
+        chain.append((path, manifest))
+        name = manifest.get('parent')
+    return list(reversed(chain))
+
+
+def extract_chain(archive: str, extract_to: str, fetch=None, workers: int = 1, journal=None, owner: tuple = None) -> bool:
+    """
+    Restores a delta by extracting its base snapshot and every delta up to it.
+
+    :param archive: Path of the delta archive to restore.
+    :param extract_to: Directory to extract the snapshots to.
+    :param fetch: Optional callable that makes an archive name available locally
+                  (together with its manifest) and returns its path.
+    :param workers: Number of threads decompressing and writing each archive.
+    :param journal: Optional snaparchive.RestoreJournal, archives completed before an
+                    interruption are skipped.
+    :param owner: Optional (uid, gid) every extracted path is given.
+    :return: True if the chain was successfully extracted, False otherwise.
+    """
+    chain = resolve_chain(archive, fetch)
+    if chain is None:
+        return False
+
+    for path, manifest in chain:
+        if journal and journal.completed(path):
+            continue
+        for arcname in manifest.get('deleted', []):
+            target = os.path.join(extract_to, arcname)
+            if os.path.lexists(target):
+                os.remove(target)
+        logging.info(f"Extracting {manifest['type']} snapshot {path} to {extract_to}")
+        if not snaparchive.extract_file(path, extract_to, workers=workers, journal=journal, owner=owner):
+            return False
+    return True
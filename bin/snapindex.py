@@ -0,0 +1,261 @@
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import contextlib
+import snapdelta
+import chunkstore
+import snaparchive
+
+# metadata of every snapshot in snapshots_dir, newest last
+INDEX_FILE = 'snapshots-index.json'
+LOCK_FILE = '.snapshots-index.lock'
+
+NAME_PATTERN = re.compile(r'^(snapshot|delta)-(?P<id>.+?)(?P<ext>\.tar\.\w+|\.json)$')
+
+
+@contextlib.contextmanager
+def locked(snapshots_dir: str):
+    """
+    Serialises read-modify-write cycles on the index between concurrent
+    create and prune runs sharing the snapshots volume.
+    """
+    os.makedirs(snapshots_dir, exist_ok=True)
+    with open(os.path.join(snapshots_dir, LOCK_FILE), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def parse_height(identifier: str) -> int:
+    return int(identifier) if identifier.isdigit() else None
+
+
+def file_checksum(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(16 * 1024 * 1024)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def entry_files(snapshots_dir: str, name: str, identifier: str, kind: str, extension: str) -> list:
+    """
+    Returns the files belonging to a snapshot, relative to snapshots_dir.
+    The first file is the one restored.
+    """
+    if kind == 'chunked':
+        candidates = [name, os.path.join(chunkstore.MANIFESTS_DIR, f'wasm-{identifier}.json')]
+    else:
+        wasm = f'wasm-{identifier}{extension}'
+        candidates = [name, os.path.basename(snapdelta.manifest_path(name)), os.path.basename(snaparchive.sidecar_path(name)),
+                      wasm, os.path.basename(snaparchive.sidecar_path(wasm))]
+    return [candidates[0]] + [fn for fn in candidates[1:] if os.path.exists(os.path.join(snapshots_dir, fn))]
+
+
+def make_entry(snapshots_dir: str, name: str, chain_id: str = None, checksum: str = None, created_at: str = None) -> dict:
+    """
+    Builds the index entry of a snapshot.
+
+    :param snapshots_dir: Directory containing the snapshots.
+    :param name: Snapshot archive or chunk store manifest, relative to snapshots_dir.
+    :param chain_id: Chain id the snapshot was taken from.
+    :param checksum: sha256 of the archive.
+    :param created_at: Creation time, defaults to now.
+    :return: Dictionary with the snapshot metadata.
+    """
+    match = NAME_PATTERN.match(os.path.basename(name))
+    identifier = match.group('id')
+    path = os.path.join(snapshots_dir, name)
+    if chunkstore.is_manifest(name):
+        kind, parent = 'chunked', None
+    elif snapdelta.is_delta(name):
+        kind, parent = 'delta', snapdelta.load_manifest(path)['parent']
+    else:
+        kind, parent = 'full', None
+    files = entry_files(snapshots_dir, name, identifier, kind, match.group('ext'))
+    return {
+        'name': name,
+        'id': identifier,
+        'height': parse_height(identifier),
+        'kind': kind,
+        'parent': parent,
+        'chain_id': chain_id,
+        'size': sum(os.path.getsize(os.path.join(snapshots_dir, fn)) for fn in files),
+        'checksum': checksum,
+        'created_at': created_at or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'files': files,
+    }
+
+
+def scan(snapshots_dir: str) -> list:
+    """
+    Rebuilds the index from the files in snapshots_dir, used when there is no index
+    yet or it is out of date. Checksums are not computed for existing snapshots.
+    """
+    names = []
+    for extension in snaparchive.ARCHIVE_EXTENSIONS:
+        names += [os.path.basename(fn) for fn in glob.glob(os.path.join(snapshots_dir, f'snapshot-*{extension}'))]
+        names += [os.path.basename(fn) for fn in glob.glob(os.path.join(snapshots_dir, f'delta-*{extension}'))
+                  if os.path.exists(snapdelta.manifest_path(fn))]
+    names += [os.path.join(chunkstore.MANIFESTS_DIR, os.path.basename(fn))
+              for fn in glob.glob(os.path.join(snapshots_dir, chunkstore.MANIFESTS_DIR, 'snapshot-*.json'))]
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(snapshots_dir, name)))
+
+    entries = []
+    for name in names:
+        mtime = os.path.getmtime(os.path.join(snapshots_dir, name))
+        entries.append(make_entry(snapshots_dir, name, created_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(mtime))))
+    logging.info(f"Indexed {len(entries)} snapshots in {snapshots_dir}")
+    return entries
+
+
+def load(snapshots_dir: str) -> list:
+    """
+    Returns the index entries of snapshots_dir, oldest first. The index is rebuilt
+    when it is missing or references a snapshot that no longer exists.
+    """
+    index_file = os.path.join(snapshots_dir, INDEX_FILE)
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            entries = json.load(f)['snapshots']
+        if all(os.path.exists(os.path.join(snapshots_dir, entry['name'])) for entry in entries):
+            return entries
+        logging.warning(f"Snapshot index {index_file} is out of date, rebuilding it")
+    if not os.path.isdir(snapshots_dir):
+        return []
+    entries = scan(snapshots_dir)
+    save(snapshots_dir, entries)
+    return entries
+
+
+def save(snapshots_dir: str, entries: list) -> None:
+    index_file = os.path.join(snapshots_dir, INDEX_FILE)
+    with open(f'{index_file}.tmp', 'w') as f:
+        json.dump({'version': 1, 'snapshots': entries}, f, indent=2)
+    os.replace(f'{index_file}.tmp', index_file)
+
+
+def add(snapshots_dir: str, name: str, chain_id: str = None, checksum: str = None) -> dict:
+    """
+    Records a newly created snapshot in the index.
+
+    :param snapshots_dir: Directory containing the snapshots.
+    :param name: Snapshot archive or chunk store manifest, relative to snapshots_dir.
+    :param chain_id: Chain id the snapshot was taken from.
+    :param checksum: sha256 of the archive, computed when not given.
+    :return: The new index entry.
+    """
+    checksum = checksum or file_checksum(os.path.join(snapshots_dir, name))
+    entry = make_entry(snapshots_dir, name, chain_id, checksum)
+    with locked(snapshots_dir):
+        entries = [e for e in load(snapshots_dir) if e['name'] != name]
+        entries.append(entry)
+        save(snapshots_dir, entries)
+    return entry
+
+
+def latest(snapshots_dir: str) -> dict:
+    entries = load(snapshots_dir)
+    return entries[-1] if entries else None
+
+
+def find(snapshots_dir: str, height: int) -> dict:
+    """
+    Returns the newest snapshot taken at the given height, or None.
+    """
+    for entry in reversed(load(snapshots_dir)):
+        if entry['height'] == int(height):
+            return entry
+    return None
+
+
+def select(entries: list, keep_last: int = 0, keep_every: int = 0, max_bytes: int = 0) -> list:
+    """
+    Applies the retention policies to the index entries.
+
+    A snapshot is kept when it is one of the keep_last newest snapshots or its height
+    is a multiple of keep_every. When neither policy is set every snapshot is kept.
+    max_bytes then drops the oldest kept snapshots until the total size fits, always
+    keeping the newest one. Bases of kept incremental snapshots are never dropped.
+
+    :param entries: Index entries, oldest first.
+    :param keep_last: Number of newest snapshots to keep, 0 to disable.
+    :param keep_every: Keep every snapshot whose height is a multiple of this, 0 to disable.
+    :param max_bytes: Maximum total size of the kept snapshots, 0 to disable.
+    :return: Entries to delete.
+    """
+    if keep_last or keep_every:
+        kept = set(e['name'] for e in entries[-keep_last:]) if keep_last else set()
+        if keep_every:
+            kept.update(e['name'] for e in entries if e['height'] is not None and e['height'] % keep_every == 0)
+    else:
+        kept = set(e['name'] for e in entries)
+    if entries:
+        kept.add(entries[-1]['name'])
+
+    by_archive = {os.path.basename(e['name']): e for e in entries}
+
+    def chain(name: str) -> set:
+        """Names of a snapshot and of the bases it is restored from."""
+        names = set()
+        entry = by_archive.get(os.path.basename(name))
+        while entry and entry['name'] not in names:
+            names.add(entry['name'])
+            entry = by_archive.get(entry['parent']) if entry['parent'] else None
+        return names
+
+    def required() -> set:
+        return set().union(*(chain(name) for name in kept))
+
+    if max_bytes:
+        for entry in entries[:-1]:
+            if sum(e['size'] for e in entries if e['name'] in required()) <= max_bytes:
+                break
+            # a base can only go together with the deltas built on top of it
+            group = set(e['name'] for e in entries if entry['name'] in chain(e['name']))
+            if entries[-1]['name'] not in group:
+                kept.difference_update(group)
+
+    names = required()
+    return [e for e in entries if e['name'] not in names]
+
+
+def prune(snapshots_dir: str, keep_last: int = 0, keep_every: int = 0, max_bytes: int = 0, dry_run: bool = False) -> list:
+    """
+    Deletes the snapshots dropped by the retention policies and garbage collects
+    chunks no longer referenced by the chunk store.
+
+    :param snapshots_dir: Directory containing the snapshots.
+    :param keep_last: Number of newest snapshots to keep, 0 to disable.
+    :param keep_every: Keep every snapshot whose height is a multiple of this, 0 to disable.
+    :param max_bytes: Maximum total size of the kept snapshots, 0 to disable.
+    :param dry_run: Only log what would be deleted.
+    :return: Entries that were deleted.
+    """
+    with locked(snapshots_dir):
+        entries = load(snapshots_dir)
+        removed = select(entries, keep_last, keep_every, max_bytes)
+        for entry in removed:
+            logging.info(f"{'Would delete' if dry_run else 'Deleting'} snapshot {entry['name']} ({entry['size']} bytes)")
+            if dry_run:
+                continue
+            for fn in entry['files']:
+                path = os.path.join(snapshots_dir, fn)
+                if os.path.exists(path):
+                    os.remove(path)
+        if not dry_run:
+            save(snapshots_dir, [e for e in entries if e not in removed])
+
+    if not dry_run and any(e['kind'] == 'chunked' for e in removed):
+        chunkstore.gc(snapshots_dir)
+    return removed
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+# seconds between two progress lines
+PROGRESS_INTERVAL = 10
+
+PREFIX = 'cosmos_snapshot'
+
+logger = logging.getLogger('snapmetrics')
+
+
+class Metrics:
+    """
+    Counters and phase timings of one snapshot create or restore run. Counters may
+    be updated from worker threads, progress and the final summary are logged as
+    single-line JSON and optionally written as a Prometheus textfile.
+    """
+
+    def __init__(self, action: str = None, textfile: str = None):
+        self.action = action
+        self.textfile = textfile
+        self.started = time.monotonic()
+        self.counters = {}
+        self.phases = {}
+        self.totals = {}
+        self.current_phase = None
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def add(self, counter: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+            report = counter in self.totals and time.monotonic() - self._last_report >= PROGRESS_INTERVAL
+            if report:
+                self._last_report = time.monotonic()
+        if report:
+            self.report_progress(counter)
+
+    def expect(self, counter: str, total: int) -> None:
+        """
+        Sets the expected final value of a counter, progress lines with a rate and
+        an ETA are then logged while it grows.
+        """
+        with self._lock:
+            self.totals[counter] = self.counters.get(counter, 0) + total
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase, phases with the same name are summed.
+        """
+        previous, self.current_phase = self.current_phase, name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + seconds
+            self.current_phase = previous
+            self.log('phase', phase=name, seconds=round(seconds, 3))
+
+    def log(self, event: str, **fields) -> None:
+        logger.info(json.dumps({'event': event, 'action': self.action, **fields}))
+
+    def report_progress(self, counter: str) -> None:
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            value = self.counters.get(counter, 0)
+            total = self.totals.get(counter)
+        rate = value / elapsed if elapsed else 0
+        eta = (total - value) / rate if total and rate else None
+        self.log('progress', phase=self.current_phase, counter=counter, value=value, total=total,
+                 rate=round(rate, 1), eta_seconds=round(eta) if eta is not None else None)
+        self.write_textfile()
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            counters = dict(self.counters)
+            phases = dict(self.phases)
+        rates = {f'{name}_per_second': round(value / elapsed, 1) for name, value in counters.items()
+                 if elapsed and not name.endswith('_seconds')}
+        if counters.get('archive_bytes'):
+            rates['compression_ratio'] = round(counters.get('source_bytes', 0) / counters['archive_bytes'], 3)
+        return {'seconds': round(elapsed, 3), 'counters': counters, 'phases': phases, 'rates': rates}
+
+    def finish(self) -> dict:
+        summary = self.summary()
+        self.log('summary', **summary)
+        self.write_textfile()
+        return summary
+
+    def write_textfile(self) -> None:
+        """
+        Writes the metrics in the Prometheus text format, e.g. for the node_exporter
+        textfile collector. The file is replaced atomically.
+        """
+        if not self.textfile:
+            return
+        summary = self.summary()
+        labels = f'action="{self.action}"'
+        lines = [
+            f'# TYPE {PREFIX}_duration_seconds gauge',
+            f'{PREFIX}_duration_seconds{{{labels}}} {summary["seconds"]}',
+            f'# TYPE {PREFIX}_phase_seconds gauge',
+        ]
+        lines += [f'{PREFIX}_phase_seconds{{{labels},phase="{name}"}} {value:.3f}' for name, value in summary['phases'].items()]
+        for name, value in sorted(summary['counters'].items()):
+            lines += [f'# TYPE {PREFIX}_{name} gauge', f'{PREFIX}_{name}{{{labels}}} {value}']
+        if 'compression_ratio' in summary['rates']:
+            lines += [f'# TYPE {PREFIX}_compression_ratio gauge',
+                      f'{PREFIX}_compression_ratio{{{labels}}} {summary["rates"]["compression_ratio"]}']
+        lines += [f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge', f'{PREFIX}_last_run_timestamp_seconds{{{labels}}} {time.time():.0f}']
+        try:
+            os.makedirs(os.path.dirname(self.textfile) or '.', exist_ok=True)
+            with open(f'{self.textfile}.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(f'{self.textfile}.tmp', self.textfile)
+        except OSError as e:
+            logging.warning(f"Failed to write metrics to {self.textfile}: {e}")
+
+
+class MeteredFile:
+    """
+    Wraps a file object and counts the bytes and seconds spent in read and write,
+    which tells whether a run is bound by the disk or network on that side.
+    Tallies are kept locally and added to the metrics every FLUSH_BYTES and on close.
+    """
+    FLUSH_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, fileobj, name: str):
+        self._fileobj = fileobj
+        self._name = name
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _count(self, size: int, start: float) -> None:
+        self._seconds += time.monotonic() - start
+        self._bytes += size
+        if self._bytes >= self.FLUSH_BYTES:
+            self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.monotonic()
+        data = self._fileobj.read(size)
+        self._count(len(data), start)
+        return data
+
+    def write(self, data) -> int:
+        start = time.monotonic()
+        written = self._fileobj.write(data)
+        self._count(len(data), start)
+        return written
+
+    def flush(self) -> None:
+        self._fileobj.flush()
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        """
+        Adds the tallies to the metrics, the wrapped file is left open.
+        """
+        add(f'{self._name}_seconds', self._seconds)
+        add(f'{self._name}_bytes', self._bytes)
+        self._bytes = 0
+        self._seconds = 0.0
+
+
+current = Metrics()
+
+
+def start(action: str, textfile: str = None) -> Metrics:
+    """
+    Starts collecting the metrics of a new run.
+    """
+    global current
+    current = Metrics(action, textfile)
+    return current
+
+
+def add(counter: str, value: float = 1) -> None:
+    current.add(counter, value)
+
+
+def expect(counter: str, total: int) -> None:
+    current.expect(counter, total)
+
+
+def phase(name: str):
+    return current.phase(name)
+
+
+def finish() -> dict:
+    return current.finish()
@@ -9,26 +9,45 @@ import cosmprund
 import shutil
 import zipfile
 import tarfile
-import lz4.frame
 import initversion
 import logging
 import glob
 import subprocess
 import statesync
+import fcntl
 import tempfile
+import httpclient
+import snapdelta
+import chunkstore
+import snapindex
+import snapmetrics
+import stat
 from rpcstatus import RpcStatus
+from snaparchive import (CODECS, Codec, Lz4Codec, RangeReader, RestoreJournal, VerifyingReader, compress_files,
+                         detect_format, extract_file, extract_members, extract_tar_stream, file_format, format_from_name,
+                         get_codec, iter_files, load_sidecar, open_tar_reader, probe_url, read_index, read_range,
+                         verify_file, write_sidecar)
 
+# leveldb/rocksdb never modify table files once written, so they can be hardlinked
+IMMUTABLE_SUFFIXES = ('.sst', '.ldb')
+# ioctl that shares the extents of a file on btrfs/xfs
+FICLONE = 0x40049409
 
-def download_file(url: str, destination: str) -> None:
+# a restore records its progress in this file next to the data directory
+JOURNAL_FILE = 'restore-journal.json'
+
+
+def download_file(url: str, destination: str, connections: int = 16) -> None:
     """
     Downloads a file from a URL and saves it to a destination using aria2c.
 
     :param url: URL to download the file from.
     :param destination: Destination to save the downloaded file.
+    :param connections: Number of parallel connections aria2c may open.
     """
     with tempfile.TemporaryDirectory() as tmpdirname:
         fn = os.path.basename(destination)
-        subprocess.run(['aria2c', '-s16', '-x16', '-d', tmpdirname, '-o', fn, url])
+        subprocess.run(['aria2c', f'-s{connections}', f'-x{connections}', '-d', tmpdirname, '-o', fn, url])
         tmpfile = os.path.join(tmpdirname, fn)
         try:
             os.makedirs(os.path.dirname(destination), exist_ok=True)
@@ -37,6 +56,45 @@ def download_file(url: str, destination: str) -> None:
             pass
 
 
+def stream_extract(url: str, extract_to: str, connections: int = 16, workers: int = 1, sidecar: dict = None,
+                   journal=None, owner: tuple = None) -> bool:
+    """
+    Downloads, decompresses and extracts an archive in a single pass.
+
+    :param url: URL of a tarball, compressed with any supported codec.
+    :param extract_to: Directory to extract the archive to.
+    :param connections: Number of parallel range requests.
+    :param workers: Number of threads writing the extracted files.
+    :param sidecar: Optional checksums every downloaded chunk is verified against.
+    :param journal: Optional RestoreJournal, members extracted before an interruption
+                    are downloaded again but not rewritten.
+    :param owner: Optional (uid, gid) every extracted path is given.
+    :return: True if the archive was successfully extracted, False otherwise.
+    """
+    try:
+        with RangeReader(url, connections) as reader:
+            fmt = detect_format(read_range(url, 0, 512)) if reader.ranged else format_from_name(url)
+            if fmt in (None, 'zip'):
+                logging.error("Unsupported file format for streaming")
+                return False
+            snapmetrics.expect('downloaded_bytes', reader.size)
+            state = journal.checkpoint(url) if journal else None
+            skip_to = state['tar_offset'] if state else 0
+            if skip_to:
+                logging.info(f"Resuming {url}, skipping members before offset {skip_to}")
+            source = VerifyingReader(reader, sidecar) if sidecar else reader
+            with open_tar_reader(source, fmt) as tar_stream:
+                with tarfile.open(fileobj=tar_stream, mode='r|') as tar_ref:
+                    checkpoint = (lambda offset: journal.update(url, {'tar_offset': offset})) if journal else None
+                    extract_tar_stream(tar_ref, extract_to, workers, checkpoint=checkpoint, skip_to=skip_to, owner=owner)
+            if sidecar:
+                source.finish()
+    except IOError as e:
+        logging.error(f"Failed to stream {url}: {e}")
+        return False
+    return True
+
+
 def remove_first_directory(full_path: str) -> str:
     """
     Removes the first directory from a given path.
@@ -49,62 +107,54 @@ def remove_first_directory(full_path: str) -> str:
     return relative_path
 
 
-def exclude_function(tarinfo: tarfile.TarInfo, exclude_patterns: list) -> tarfile.TarInfo:
+def compress_lz4(filename: str, directories_to_tar: list, exclude_patterns: list, workers: int = 1, indexed: bool = False,
+                 sidecar: bool = False, codec: Codec = None) -> bool:
     """
-    Checks if a file should be excluded from a tarball.
-
-    :param tarinfo: TarInfo object representing the file to check.
-    :param exclude_patterns: List of patterns to exclude.
-    :return: The TarInfo object if it should not be excluded, otherwise None.
-    """
-    for pattern in exclude_patterns:
-        if tarinfo.name.startswith(pattern):
-            return None
-    return tarinfo
-
-
-def compress_lz4(filename: str, directories_to_tar: list, exclude_patterns: list) -> None:
-    """
-    Creates a tarball of the given directories and compresses it using LZ4.
+    Creates a tarball of the given directories and compresses it, using LZ4 by default.
 
     :param filename: Name of the file to create.
     :param directories_to_tar: List of directories to include in the tarball.
     :param exclude_patterns: List of patterns to exclude from the tarball.
+    :param workers: Number of compression threads, more than 1 writes a multi-frame archive.
+    :param indexed: Write a seekable archive with a trailing member index.
+    :param sidecar: Save the checksums of the archive next to it.
+    :param codec: Codec to compress with, defaults to lz4.
+    :return: True if the archive was written with a member index, False otherwise.
     """
-    with lz4.frame.open(filename, mode='wb') as lz4_file:
-        with tarfile.open(fileobj=lz4_file, mode='w|') as tar:
-            for directory in directories_to_tar:
-                for root, dirs, files in os.walk(directory):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        tar_info = tar.gettarinfo(file_path, arcname=remove_first_directory(file_path))
-                        if exclude_function(tar_info, exclude_patterns):
-                            with open(file_path, 'rb') as file_obj:
-                                tar.addfile(tar_info, file_obj)
-
-
-def extract_file(filepath: str, extract_to: str) -> bool:
+    # the scan is collected first, like snapdelta.scan, so the progress has a total and an ETA
+    files = list(iter_files(directories_to_tar, exclude_patterns))
+    snapmetrics.expect('source_bytes', sum(st.st_size for _, _, st in files if stat.S_ISREG(st.st_mode)))
+    return compress_files(filename, files, workers, indexed=indexed, sidecar=sidecar, codec=codec)
+
+
+def list_members(source: str, connections: int = 16) -> list:
     """
-    Extracts a file to a given directory.
+    Lists the members of an archive, instantly for seekable archives. Others are
+    read through, remote ones streamed without saving them.
 
-    :param filepath: Path to the file to extract.
-    :param extract_to: Directory to extract the file to.
-    :return: True if the file was successfully extracted, False otherwise.
+    :param source: Path or URL of the archive.
+    :param connections: Number of parallel range requests for remote archives.
+    :return: List of member names.
     """
-    if filepath.endswith(('.zip', '.tar.gz', '.tar.lz4')):
-        if filepath.endswith('.zip'):
-            with zipfile.ZipFile(filepath, 'r') as zip_ref:
-                zip_ref.extractall(extract_to)
-        elif filepath.endswith('.tar.gz'):
-            with tarfile.open(filepath, 'r:gz') as tar_ref:
-                tar_ref.extractall(extract_to)
-        elif filepath.endswith('.tar.lz4'):
-            with lz4.frame.open(filepath, 'rb') as lz4_ref:
-                with tarfile.open(fileobj=lz4_ref) as tar_ref:
-                    tar_ref.extractall(extract_to)
-        return True
-    logging.error("Unsupported file format")
-    return False
+    index = read_index(source)
+    if index is not None:
+        return sorted(index['members'], key=lambda name: index['members'][name][0])
+    if source.startswith(('http://', 'https://')):
+        raw = RangeReader(source, connections)
+        fmt = detect_format(read_range(source, 0, 512)) if raw.ranged else format_from_name(source)
+    else:
+        path = source[7:] if source.startswith('file://') else source
+        fmt = file_format(path)
+        if fmt == 'zip':
+            with zipfile.ZipFile(path, 'r') as zip_ref:
+                return zip_ref.namelist()
+        raw = open(path, 'rb')
+    with raw:
+        if fmt in (None, 'zip'):
+            raise IOError(f"Cannot list the members of {source}, unsupported format")
+        with open_tar_reader(raw, fmt) as tar_stream:
+            with tarfile.open(fileobj=tar_stream, mode='r|') as tar_ref:
+                return [member.name for member in tar_ref]
 
 
 def get_snapshot_block_height(data_dir):
@@ -139,49 +189,138 @@ def get_block_height(data_dir):
     return time.strftime("%Y%m%d-%H%M%S")
 
 
-def create_snapshot(snapshots_dir: str, data_dir: str, cosmprund_enabled: bool = False) -> None:
+def reflink_or_copy(src: str, dst: str) -> None:
+    """
+    Copies a file, sharing its extents with the source where the filesystem supports it.
+    """
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def stage_tree(src: str, dst: str) -> None:
+    """
+    Creates a point-in-time copy of a directory tree. Immutable table files are
+    hardlinked, everything else is reflinked or copied.
+
+    :param src: Directory to stage.
+    :param dst: Staging directory to create, must be on the same filesystem for hardlinks.
+    """
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            src_file = os.path.join(root, file)
+            dst_file = os.path.join(target_root, file)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+                continue
+            if file.endswith(IMMUTABLE_SUFFIXES):
+                try:
+                    os.link(src_file, dst_file)
+                    continue
+                except OSError:
+                    pass
+            reflink_or_copy(src_file, dst_file)
+
+
+def stage_snapshot(data_dir: str, staging_dir: str) -> str:
+    """
+    Stages the data directory and the wasm directory next to it for a live snapshot.
+
+    :param data_dir: Data directory of the stopped node.
+    :param staging_dir: Directory to stage the snapshot in.
+    :return: The staged data directory.
+    """
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staged_data_dir = os.path.join(staging_dir, os.path.basename(data_dir))
+    logging.info(f"Staging {data_dir} to {staged_data_dir}")
+    stage_tree(data_dir, staged_data_dir)
+
+    outside_wasm_dir = os.path.join(os.path.dirname(data_dir), 'wasm')
+    if os.path.exists(outside_wasm_dir):
+        logging.info(f"Staging {outside_wasm_dir} to {staging_dir}")
+        stage_tree(outside_wasm_dir, os.path.join(staging_dir, 'wasm'))
+    return staged_data_dir
+
+
+def create_snapshot(snapshots_dir: str, data_dir: str, cosmprund_enabled: bool = False, workers: int = 1,
+                    incremental: bool = False, full_every: int = 12, chunked: bool = False, indexed: bool = False,
+                    identifier: str = None, chain_id: str = None, codec: Codec = None) -> None:
     """
     Creates a snapshot of the given directories.
 
     :param snapshots_dir: Directory to save the snapshot in.
     :param data_dir: Directory containing the data to include in the snapshot.
-    :param inside_wasm_dir: Directory containing the inside wasm data to include in the snapshot.
-    :param outside_wasm_dir: Directory containing the outside wasm data to include in the snapshot.
+    :param cosmprund_enabled: Prune the data directory before compressing.
+    :param workers: Number of compression threads used for each archive.
+    :param incremental: Only archive files changed since the previous snapshot.
+    :param full_every: Number of incremental snapshots between two full snapshots.
+    :param chunked: Store the snapshot in the deduplicating chunk store instead of archives.
+    :param indexed: Write a seekable snapshot, the wasm directory is then restored from it
+                    with `restore --include` instead of a separate wasm archive.
+    :param identifier: Identifier of the snapshot, looked up from data_dir if not given.
+    :param chain_id: Chain id recorded in the snapshot index.
+    :param codec: Codec to compress the archives with, defaults to lz4.
     """
+    identifier = identifier or get_block_height(data_dir)
 
     if cosmprund_enabled:
-        cosmprund.main(data_dir)
+        with snapmetrics.phase('prune'):
+            cosmprund.main(argparse.Namespace(data_dir=data_dir))
 
     inside_wasm_dir = os.path.join(data_dir, 'wasm')
     outside_wasm_dir = os.path.join(os.path.dirname(data_dir), 'wasm')
 
+    codec = codec or Lz4Codec()
     os.makedirs(snapshots_dir, exist_ok=True)
-    identifier = get_block_height(data_dir)
-    snapshot_file = f'{snapshots_dir}/snapshot-{identifier}.tar.lz4'
-    wasm_file = f'{snapshots_dir}/wasm-{identifier}.tar.lz4'
+    snapshot_file = f'{snapshots_dir}/snapshot-{identifier}{codec.extension}'
+    wasm_file = f'{snapshots_dir}/wasm-{identifier}{codec.extension}'
 
     if os.path.exists(outside_wasm_dir):
-        logging.info(f"Compressing {data_dir} and {outside_wasm_dir} to {snapshot_file}")
-        compress_lz4(snapshot_file, [data_dir, outside_wasm_dir], ['wasm/wasm/cache'])
-        logging.info(f"Compressing {outside_wasm_dir} to {wasm_file}")
-        compress_lz4(wasm_file, [outside_wasm_dir], ['wasm/wasm/cache'])
-        # wasm_latest = f'{snapshots_dir}/wasm-latest.tar.lz4'
-        # link_overwrite(wasm_file, wasm_latest)
+        snapshot_dirs, snapshot_excludes = [data_dir, outside_wasm_dir], ['wasm/wasm/cache']
+        wasm_dirs, wasm_excludes = [outside_wasm_dir], ['wasm/wasm/cache']
     elif os.path.exists(inside_wasm_dir):
-        logging.info(f"Compressing {data_dir} and {inside_wasm_dir} to {snapshot_file}")
-        compress_lz4(snapshot_file, [data_dir], ['data/wasm/cache'])
-        logging.info(f"Compressing {inside_wasm_dir} to {wasm_file}")
-        compress_lz4(wasm_file, [inside_wasm_dir], ['wasm/wasm/cache'])
+        snapshot_dirs, snapshot_excludes = [data_dir], ['data/wasm/cache']
+        wasm_dirs, wasm_excludes = [inside_wasm_dir], ['wasm/wasm/cache']
+    else:
+        snapshot_dirs, snapshot_excludes = [data_dir], []
+        wasm_dirs, wasm_excludes = [], []
+
+    if chunked:
+        with snapmetrics.phase('chunk'):
+            manifest_file = chunkstore.store(snapshots_dir, f'snapshot-{identifier}', snapshot_dirs, snapshot_excludes, workers)
+            if wasm_dirs:
+                chunkstore.store(snapshots_dir, f'wasm-{identifier}', wasm_dirs, wasm_excludes, workers)
+        snapindex.add(snapshots_dir, os.path.relpath(manifest_file, snapshots_dir), chain_id)
+        return
+
+    # tar and compression run as one pipeline, the time spent reading the source and
+    # writing the archive is reported separately by the source_* and archive_* counters
+    with snapmetrics.phase('compress'):
+        if incremental:
+            # deltas are never indexed, the wasm directory still gets its own archive
+            snapshot_file = snapdelta.create(snapshots_dir, identifier, snapshot_dirs, snapshot_excludes, workers, full_every, codec)
+            indexed = False
+        else:
+            logging.info(f"Compressing {' and '.join(snapshot_dirs)} to {snapshot_file} with {codec.name}")
+            indexed = compress_lz4(snapshot_file, snapshot_dirs, snapshot_excludes, workers, indexed, sidecar=True, codec=codec)
+
+        if wasm_dirs and not indexed:
+            logging.info(f"Compressing {wasm_dirs[0]} to {wasm_file}")
+            compress_lz4(wasm_file, wasm_dirs, wasm_excludes, workers, sidecar=True, codec=codec)
         # wasm_latest = f'{snapshots_dir}/wasm-latest.tar.lz4'
         # link_overwrite(wasm_file, wasm_latest)
-    else:
-        logging.info(f"Compressing {data_dir} to {snapshot_file}")
-        compress_lz4(snapshot_file, [data_dir], [])
 
     # always create a snapshot-latest.tar.lz4 link (but not wasm)
     # snapshot_latest = f'{snapshots_dir}/snapshot-latest.tar.lz4'
     # link_overwrite(snapshot_file, snapshot_latest)
 
+    snapindex.add(snapshots_dir, os.path.basename(snapshot_file), chain_id, load_sidecar(snapshot_file)['sha256'])
+
 
 def link_overwrite(src_file: str, dst_file: str) -> None:
     """
@@ -195,70 +334,174 @@ def link_overwrite(src_file: str, dst_file: str) -> None:
     os.symlink(src_file, dst_file)
 
 
-def find_latest_snapshot(snapshots_dir):
-    # Create a list of snapshot files in the given directory
-    snapshot_files = glob.glob(os.path.join(snapshots_dir, 'snapshot-*.tar.lz4'))
-    
-    # Filter out directories if any
-    snapshot_files = [file for file in snapshot_files if os.path.isfile(file)]
+def find_latest_snapshot(snapshots_dir, height=None):
+    """
+    Looks up the latest snapshot, or the one taken at the given height, in the snapshot index.
 
-    if not snapshot_files:
-        logging.error(f"No Snapshot files found in {snapshots_dir}")
-        return None  # If no files found, return None
+    :param snapshots_dir: Directory containing the snapshots.
+    :param height: Optional block height of the snapshot.
+    :return: Path of the snapshot archive or manifest, or None.
+    """
+    entry = snapindex.find(snapshots_dir, height) if height else snapindex.latest(snapshots_dir)
+    if not entry:
+        logging.error(f"No Snapshot files found in {snapshots_dir}" + (f" at height {height}" if height else ""))
+        return None
+    return os.path.join(snapshots_dir, entry['name'])
 
-    # Get the latest file based on modification time
-    latest_file = max(snapshot_files, key=os.path.getmtime)
-    return latest_file
 
-def restore_snapshot(snapshot_url: str, snapshots_dir: str, chain_home: str) -> int:
+def restore_snapshot(snapshot_url: str, snapshots_dir: str, chain_home: str, stream: bool = False, connections: int = 16,
+                     include: list = None, workers: int = 1, height: int = None, reset=None) -> int:
     """
     Restores a snapshot from a given URL.
 
+    Archives are verified against their sidecar checksums before anything is extracted,
+    so a truncated or corrupt download fails before the existing data is reset. Extracted
+    files are given the owner of chain_home as they are written.
+
     :param snapshot_url: URL of the snapshot to restore.
     :param snapshots_dir: Directory containing the snapshots.
     :param chain_home: Directory to extract the snapshot to.
+    :param stream: Extract remote snapshots while downloading instead of saving them first.
+    :param connections: Number of parallel connections used to download the snapshot.
+    :param include: Optional list of path prefixes to restore instead of the whole snapshot.
+    :param workers: Number of threads decompressing and writing the snapshot.
+    :param height: Restore the local snapshot taken at this height instead of the latest one.
+    :param reset: Optional callable clearing the existing data, called right before extracting.
+                  It is skipped when an interrupted restore of the same snapshot is resumed.
     :return: 0 if the snapshot was successfully restored, 1 otherwise.
     """
-    
-    if not snapshot_url:
-        snapfn = find_latest_snapshot(snapshots_dir)
-        snapfile = os.path.join(snapshots_dir, snapfn)
-        snapshot_url = f'file://{snapfile}'
-        if not snapfn:
-            logging.error(f"No Snapshot file found")
-            return 1
-    elif snapshot_url.startswith('file://'):
-        snapfn = os.path.basename(snapshot_url.split('?')[0]) 
-        snapfile = snapshot_url[7:]
-    else:
-        logging.info(f"Downloading snapshot from {snapshot_url}")
-        snapfn = os.path.basename(snapshot_url.split('?')[0]) 
-        if not snapfn.startswith('snapshot-'):
-            snapfn = f'snapshot-{snapfn}'
-        snapfile = os.path.join(snapshots_dir, snapfn)
-        if not os.path.exists(snapfile):
-            download_file(snapshot_url, snapfile)
-        # snapshot_latest = f'{snapshots_dir}/snapshot-latest.tar.lz4'
-        # link_overwrite(snapfile, snapshot_latest)
-
-    logging.info(f"Extracting {snapfile} to {chain_home}")
-    if not extract_file(snapfile, chain_home):
-        return 1
-
-    # Get the owner and group of the chain_home directory
-    stat_info = os.stat(chain_home)
-    uid = stat_info.st_uid
-    gid = stat_info.st_gid
+    extracted = False
+
+    # Get the owner and group of the chain_home directory, every extracted path gets them
+    owner = None
+    if os.path.isdir(chain_home):
+        stat_info = os.stat(chain_home)
+        owner = (stat_info.st_uid, stat_info.st_gid)
+
+    # local incremental chains are read in place, remote ones downloaded archive by archive
+    fetch = None
+    journal = None
+    reset = reset or (lambda: None)
+    checked = set()
+
+    def start(source: str) -> None:
+        """Resets the data unless an interrupted restore of the same snapshot can be continued."""
+        nonlocal journal
+        if include:
+            reset()
+            return
+        journal = RestoreJournal(os.path.join(chain_home, JOURNAL_FILE), source)
+        if journal.resumable:
+            logging.info(f"Resuming interrupted restore of {source}, keeping the existing data")
+        else:
+            reset()
+            journal.begin()
+
+    def verified(path: str, url: str = None) -> str:
+        """Downloads path from url if it is missing and checks it against its sidecar."""
+        if path in checked:
+            return path
+        if url and not os.path.exists(path):
+            with snapmetrics.phase('download'):
+                download_file(url, path, connections)
+            snapmetrics.add('downloaded_bytes', os.path.getsize(path))
+        sidecar = load_sidecar(path)
+        if sidecar is None and url:
+            sidecar = load_sidecar(url)
+            if sidecar:
+                write_sidecar(path, sidecar)
+        with snapmetrics.phase('verify'):
+            valid = verify_file(path, sidecar)
+        if not valid:
+            if url:
+                # download again on the next attempt
+                os.remove(path)
+            raise IOError(f"{path} does not match its checksums")
+        checked.add(path)
+        return path
 
-    # Change the owner and group of the extracted files
-    # chown -R does not thow error for shared dir
     try:
-        # Running the chown command using subprocess
-        subprocess.call(['chown', '-R', f'{uid}:{gid}', chain_home],
-             stderr=subprocess.DEVNULL
-        )
-    except subprocess.CalledProcessError as e:
-        logging.error(f"An error occurred while changing ownership: {e}")
+        if not snapshot_url:
+            snapfn = find_latest_snapshot(snapshots_dir, height)
+            if not snapfn:
+                logging.error("No Snapshot file found")
+                return 1
+            snapfile = os.path.join(snapshots_dir, snapfn)
+            snapshot_url = f'file://{snapfile}'
+        elif snapshot_url.startswith('file://'):
+            snapfn = os.path.basename(snapshot_url.split('?')[0]) 
+            snapfile = snapshot_url[7:]
+        elif chunkstore.is_manifest(snapshot_url):
+            # the data is only reset once every chunk is known to be available,
+            # chunks are verified against their content hash as they are fetched
+            with snapmetrics.phase('extract'):
+                if not chunkstore.restore(snapshot_url, chain_home, connections, owner, reset):
+                    return 1
+            extracted = True
+        elif include and extract_members(snapshot_url, chain_home, include, connections, owner):
+            extracted = True
+        elif stream and not snapdelta.is_delta(snapshot_url.split('?')[0]):
+            sidecar = load_sidecar(snapshot_url)
+            if sidecar:
+                _, size, _ = probe_url(httpclient.session(), snapshot_url)
+                if size and size != sidecar['size']:
+                    logging.error(f"{snapshot_url} is {size} bytes, expected {sidecar['size']}")
+                    return 1
+            else:
+                logging.warning(f"No checksums for {snapshot_url}, streaming without verification")
+            start(f"{snapshot_url.split('?')[0]}:{sidecar['sha256'] if sidecar else ''}")
+            logging.info(f"Streaming snapshot from {snapshot_url} to {chain_home}")
+            with snapmetrics.phase('stream'):
+                if not stream_extract(snapshot_url, chain_home, connections, workers, sidecar, journal, owner):
+                    return 1
+            extracted = True
+        else:
+            logging.info(f"Downloading snapshot from {snapshot_url}")
+            snapfn = os.path.basename(snapshot_url.split('?')[0]) 
+            if not snapfn.startswith(('snapshot-', 'delta-')):
+                snapfn = f'snapshot-{snapfn}'
+            snapfile = verified(os.path.join(snapshots_dir, snapfn), snapshot_url)
+
+            # archives and manifests of an incremental chain live next to each other
+            base_url = snapshot_url.split('?')[0].rsplit('/', 1)[0]
+
+            def fetch_archive(name: str) -> str:
+                manifest = os.path.basename(snapdelta.manifest_path(name))
+                if not os.path.exists(os.path.join(snapshots_dir, manifest)):
+                    download_file(f'{base_url}/{manifest}', os.path.join(snapshots_dir, manifest), connections)
+                return verified(os.path.join(snapshots_dir, name), f'{base_url}/{name}')
+            fetch = fetch_archive
+            # snapshot_latest = f'{snapshots_dir}/snapshot-latest.tar.lz4'
+            # link_overwrite(snapfile, snapshot_latest)
+
+        if not extracted and chunkstore.is_manifest(snapfile):
+            with snapmetrics.phase('extract'):
+                if not chunkstore.restore(snapfile, chain_home, connections, owner, reset):
+                    return 1
+        elif not extracted and snapdelta.is_delta(snapfile):
+            chain = snapdelta.resolve_chain(snapfile, fetch)
+            if chain is None:
+                return 1
+            for path, _ in chain:
+                verified(path)
+            start(f'{os.path.basename(snapfile)}:{os.path.getsize(snapfile)}')
+            logging.info(f"Rebuilding incremental snapshot {snapfile} in {chain_home}")
+            with snapmetrics.phase('extract'):
+                if not snapdelta.extract_chain(snapfile, chain_home, fetch, workers, journal, owner):
+                    return 1
+        elif not extracted:
+            verified(snapfile)
+            start(f'{os.path.basename(snapfile)}:{os.path.getsize(snapfile)}')
+            logging.info(f"Extracting {snapfile} to {chain_home}")
+            with snapmetrics.phase('extract'):
+                if not extract_file(snapfile, chain_home, include, workers, journal, owner):
+                    return 1
+    except IOError as e:
+        logging.error(f"Failed to restore snapshot: {e}")
+        return 1
+
+    if journal:
+        journal.clear()
 
     initversion.main(cvutils.get_ctx())
     return 0
@@ -290,6 +533,22 @@ def wait_for_sync(ctx, sleep_time=30, max_retries=None):
         retries += 1
 
 
+def prune_snapshots(ctx: dict) -> list:
+    """
+    Applies the configured retention policies to the snapshots directory.
+
+    :param ctx: Context dictionary with the snapshot_keep_last, snapshot_keep_every
+                and snapshot_max_bytes policies, 0 disables a policy.
+    :return: Index entries of the deleted snapshots.
+    """
+    keep_last = int(ctx.get("snapshot_keep_last"))
+    keep_every = int(ctx.get("snapshot_keep_every"))
+    max_bytes = int(ctx.get("snapshot_max_bytes"))
+    if not (keep_last or keep_every or max_bytes):
+        return []
+    return snapindex.prune(ctx.get("snapshots_dir"), keep_last, keep_every, max_bytes)
+
+
 def main(args: argparse.Namespace) -> int:
     """
     Main function to create or restore a snapshot.
@@ -299,16 +558,72 @@ def main(args: argparse.Namespace) -> int:
     """
     ctx = cvutils.get_ctx(args)
 
+    if args.action == 'list':
+        source = ctx.get("snapshot_url") or find_latest_snapshot(ctx.get("snapshots_dir"), ctx.get("snapshot_height"))
+        if not source:
+            return 1
+        try:
+            names = list_members(source, int(ctx.get("snapshot_connections")))
+        except IOError as e:
+            logging.error(f"Failed to list {source}: {e}")
+            return 1
+        for name in names:
+            print(name)
+        return 0
+
+    if args.action == 'prune':
+        prune_snapshots(ctx)
+        return 0
+
+    if args.action in ('create', 'restore'):
+        snapmetrics.start(args.action, ctx.get("snapshot_metrics_file"))
+
     if args.action == 'create':
         if ctx.get("statesync_snapshot"):
             statesync.main(ctx)
             wait_for_sync(ctx)
+        workers = int(ctx.get("snapshot_workers")) if ctx.get("snapshot_parallel") else 1
+        level = ctx.get("snapshot_level")
+        codec = get_codec(ctx.get("snapshot_codec"), int(level) if level is not None else None, int(ctx.get("snapshot_window_log")))
+        data_dir = ctx.get("data_dir")
+        live = ctx.get("snapshot_live")
+        identifier = None
         cvcontrol.stop_process('cosmovisor')
-        create_snapshot(ctx.get("snapshots_dir"), ctx.get("data_dir"), ctx.get("cosmprund_enabled"))
+        if live:
+            # only keep the node down while taking the point-in-time copy
+            try:
+                identifier = get_block_height(data_dir)
+                with snapmetrics.phase('stage'):
+                    data_dir = stage_snapshot(data_dir, ctx.get("snapshot_staging_dir"))
+            finally:
+                # the node comes back even if staging failed
+                cvcontrol.start_process('cosmovisor')
+        try:
+            create_snapshot(ctx.get("snapshots_dir"), data_dir, ctx.get("cosmprund_enabled"), workers,
+                            ctx.get("snapshot_incremental"), int(ctx.get("snapshot_full_every")), ctx.get("snapshot_chunkstore"),
+                            ctx.get("snapshot_indexed"), identifier, ctx.get("chain_id"), codec)
+        finally:
+            if live:
+                shutil.rmtree(ctx.get("snapshot_staging_dir"), ignore_errors=True)
+        with snapmetrics.phase('retention'):
+            prune_snapshots(ctx)
+        snapmetrics.finish()
+        if live:
+            return 0
     elif args.action == 'restore':
         cvcontrol.stop_process('cosmovisor')
-        cvutils.unsafe_reset_all(ctx)
-        restore_snapshot(ctx.get("snapshot_url"), ctx.get("snapshots_dir"), ctx.get("chain_home"))
+        # a partial restore adds to the existing data instead of replacing it,
+        # a full one only resets the data once the snapshot has been verified
+        reset = None if args.include else lambda: cvutils.unsafe_reset_all(ctx)
+        result = restore_snapshot(ctx.get("snapshot_url"), ctx.get("snapshots_dir"), ctx.get("chain_home"),
+                                  ctx.get("snapshot_stream"), int(ctx.get("snapshot_connections")), args.include,
+                                  int(ctx.get("snapshot_workers")), ctx.get("snapshot_height"), reset)
+        snapmetrics.finish()
+        if result:
+            # the node must not run on partial data, the restore journal lets the
+            # next attempt continue over it as long as nothing else changed it
+            logging.error("Restore failed, not starting cosmovisor")
+            return result
     else:
         raise ValueError(f"Unsupported action: {args.action}")
 
@@ -320,7 +635,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description='Load data from image snapshot.')
-    parser.add_argument('action', type=str, choices=['create', 'restore'], help='Action to perform (create or restore)')
+    parser.add_argument('action', type=str, choices=['create', 'restore', 'list', 'prune'], help='Action to perform (create, restore, list or prune)')
     parser.add_argument('-u', '--snapshot-url', dest="snapshot_url", type=str, help='URL of the snapshot')
     parser.add_argument('-s', '--snapshots-dir', dest="snapshots_dir", type=str, help='Directory to save snapshots')
     parser.add_argument('-c', '--chain-home', dest="chain_home", type=str, help='Directory to extract snapshots')
@@ -328,6 +643,22 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--cosmprund-enable', dest="cosmprund_enabled", action='store_true', help='Enable cosmprund')
     parser.add_argument('-x', '--cosmprund-disable', dest="cosmprund_enabled", action='store_false', help='Disable cosmprund')
     parser.add_argument('--statesync', dest="statesync_snapshot", action='store_true', help='Enable statesync before snapshot')
+    parser.add_argument('--live', dest="snapshot_live", action='store_true', help='Restart cosmovisor right after staging and compress the staged copy')
+    parser.add_argument('--parallel', dest="snapshot_parallel", action='store_true', help='Compress snapshot blocks on a worker pool')
+    parser.add_argument('-w', '--workers', dest="snapshot_workers", type=int, help='Maximum number of compression workers')
+    parser.add_argument('--incremental', dest="snapshot_incremental", action='store_true', help='Only archive files changed since the previous snapshot')
+    parser.add_argument('--chunkstore', dest="snapshot_chunkstore", action='store_true', help='Store snapshots in the deduplicating chunk store')
+    parser.add_argument('--codec', dest="snapshot_codec", choices=list(CODECS), help='Compression codec of new snapshots')
+    parser.add_argument('--level', dest="snapshot_level", type=int, help='Compression level of new snapshots')
+    parser.add_argument('--indexed', dest="snapshot_indexed", action='store_true', help='Write a seekable snapshot with a member index')
+    parser.add_argument('-i', '--include', dest="include", action='append', help='Only restore members under this path prefix (repeatable)')
+    parser.add_argument('--height', dest="snapshot_height", type=int, help='Restore or list the local snapshot taken at this height')
+    parser.add_argument('--keep-last', dest="snapshot_keep_last", type=int, help='Number of newest snapshots to keep')
+    parser.add_argument('--keep-every', dest="snapshot_keep_every", type=int, help='Keep snapshots whose height is a multiple of this')
+    parser.add_argument('--max-bytes', dest="snapshot_max_bytes", type=int, help='Maximum total size of the kept snapshots')
+    parser.add_argument('--metrics-file', dest="snapshot_metrics_file", type=str, help='Write Prometheus metrics of the run to this textfile')
+    parser.add_argument('--stream', dest="snapshot_stream", action='store_true', help='Extract remote snapshots while downloading')
+    parser.add_argument('--connections', dest="snapshot_connections", type=int, help='Parallel connections used to download snapshots')
 
     args = parser.parse_args()
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import os
-import requests
+import httpclient
 import shutil
 import time
 import tomlkit
@@ -30,7 +30,7 @@ def get_statesync_params(ctx, latest_height):
     logging.info(f"Latest height: {latest_height}")
     logging.info(f"Trust height: {trust_height}")
 
-    trust_block_raw = requests.get(f"http://{rpc_address}/block?height={trust_height}").json()
+    trust_block_raw = httpclient.get(f"http://{rpc_address}/block?height={trust_height}").json()
     trust_block = trust_block_raw.get('result', trust_block_raw)
     trust_hash = trust_block["block_id"]["hash"]
     logging.info(f"Trust hash: {trust_hash}")
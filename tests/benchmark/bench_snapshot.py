@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the snapshot pipeline on synthetic chain data.
+
+Generates a data_dir shaped like a real chain (sst tables, large blockstore files,
+a wasm directory with an excluded cache and many small files), then creates and
+restores snapshots for every codec and worker count. Each case runs in its own
+process so peak RSS and open file descriptors can be measured.
+
+    python tests/benchmark/bench_snapshot.py run --scale small --codecs lz4,zstd --workers 1,4 -o new.json
+    python tests/benchmark/bench_snapshot.py compare old.json new.json --threshold 10
+
+The file is not named test_* on purpose, pytest does not collect it.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+
+BIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'bin'))
+
+MIB = 1024 * 1024
+
+# file counts and sizes of the generated trees
+SCALES = {
+    'tiny': {'sst_files': 20, 'sst_size': 1 * MIB, 'block_files': 2, 'block_size': 8 * MIB,
+             'small_files': 2000, 'wasm_files': 5},
+    'small': {'sst_files': 100, 'sst_size': 2 * MIB, 'block_files': 4, 'block_size': 32 * MIB,
+              'small_files': 20000, 'wasm_files': 20},
+    'large': {'sst_files': 1000, 'sst_size': 8 * MIB, 'block_files': 8, 'block_size': 512 * MIB,
+              'small_files': 1000000, 'wasm_files': 200},
+}
+
+# seconds between two samples of the open file descriptors of a case
+FD_SAMPLE_INTERVAL = 0.05
+
+
+def chain_like_bytes(rng: random.Random, size: int) -> bytes:
+    """
+    Returns data that compresses roughly like leveldb tables, random key/value
+    blocks interleaved with repeated runs.
+    """
+    parts = []
+    while size > 0:
+        random_len = min(size, rng.randint(1024, 8192))
+        parts.append(rng.randbytes(random_len))
+        size -= random_len
+        repeat_len = min(size, rng.randint(1024, 8192))
+        parts.append(bytes([rng.randint(0, 255)]) * repeat_len)
+        size -= repeat_len
+    return b''.join(parts)
+
+
+def generate_tree(root: str, sst_files: int, sst_size: int, block_files: int, block_size: int,
+                  small_files: int, wasm_files: int, seed: int = 1) -> str:
+    """
+    Generates a chain home with a data and a wasm directory, reusing an existing
+    tree generated with the same parameters.
+
+    :return: Path of the data directory.
+    """
+    params = dict(sst_files=sst_files, sst_size=sst_size, block_files=block_files, block_size=block_size,
+                  small_files=small_files, wasm_files=wasm_files, seed=seed)
+    marker = os.path.join(root, 'tree.json')
+    data_dir = os.path.join(root, 'home', 'data')
+    if os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == params:
+                return data_dir
+    shutil.rmtree(root, ignore_errors=True)
+    logging.info(f"Generating synthetic chain data in {root}")
+
+    rng = random.Random(seed)
+    app_db = os.path.join(data_dir, 'application.db')
+    os.makedirs(app_db)
+    for i in range(sst_files):
+        with open(os.path.join(app_db, f'{i:06d}.sst'), 'wb') as f:
+            f.write(chain_like_bytes(rng, sst_size))
+    for name in ['CURRENT', 'LOCK', 'LOG', 'MANIFEST-000001']:
+        with open(os.path.join(app_db, name), 'wb') as f:
+            f.write(rng.randbytes(256))
+
+    blockstore = os.path.join(data_dir, 'blockstore.db')
+    os.makedirs(blockstore)
+    for i in range(block_files):
+        with open(os.path.join(blockstore, f'{i:06d}.ldb'), 'wb') as f:
+            for _ in range(block_size // (4 * MIB)):
+                f.write(chain_like_bytes(rng, 4 * MIB))
+
+    for i in range(small_files):
+        directory = os.path.join(data_dir, 'tx_index.db', f'{i // 1000:04d}')
+        if i % 1000 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f'{i:08d}.log'), 'wb') as f:
+            f.write(rng.randbytes(rng.randint(256, 4096)))
+
+    wasm_dir = os.path.join(root, 'home', 'wasm', 'wasm')
+    os.makedirs(os.path.join(wasm_dir, 'state', 'wasm'))
+    os.makedirs(os.path.join(wasm_dir, 'cache', 'modules'))
+    for i in range(wasm_files):
+        blob = chain_like_bytes(rng, rng.randint(256 * 1024, 2 * MIB))
+        with open(os.path.join(wasm_dir, 'state', 'wasm', f'{i:064x}'), 'wb') as f:
+            f.write(blob)
+        # compiled modules are excluded from snapshots
+        with open(os.path.join(wasm_dir, 'cache', 'modules', f'{i:064x}.module'), 'wb') as f:
+            f.write(blob)
+
+    with open(os.path.join(data_dir, 'priv_validator_state.json'), 'w') as f:
+        f.write('{"height": "0", "round": 0, "step": 0}')
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return data_dir
+
+
+def tree_size(directory: str) -> tuple:
+    files = 0
+    size = 0
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def run_case(op: str, codec: str, workers: int, data_dir: str, snapshots_dir: str, restore_dir: str) -> dict:
+    """
+    Runs a single create or restore in the current process.
+    """
+    sys.path.insert(0, BIN_DIR)
+    import snapshot
+    import snapmetrics
+
+    snapmetrics.start(op)
+    if op == 'create':
+        shutil.rmtree(snapshots_dir, ignore_errors=True)
+        snapshot.create_snapshot(snapshots_dir, data_dir, workers=workers, identifier='1000',
+                                 codec=snapshot.get_codec(codec))
+    else:
+        shutil.rmtree(restore_dir, ignore_errors=True)
+        archive = snapshot.find_latest_snapshot(snapshots_dir)
+        if not snapshot.extract_file(archive, restore_dir, workers=workers):
+            raise RuntimeError(f"Failed to extract {archive}")
+    return snapmetrics.current.summary()
+
+
+def count_fds(pid: int) -> int:
+    try:
+        return len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        return 0
+
+
+def measure_case(op: str, codec: str, workers: int, data_dir: str, snapshots_dir: str, restore_dir: str) -> dict:
+    """
+    Runs a case in a child process and measures its wall time, peak RSS and
+    peak number of open file descriptors.
+    """
+    command = [sys.executable, os.path.abspath(__file__), 'case', '--op', op, '--codec', codec,
+               '--workers', str(workers), '--data-dir', data_dir, '--snapshots-dir', snapshots_dir,
+               '--restore-dir', restore_dir]
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    peak_fds = 0
+    done = threading.Event()
+
+    def sample_fds():
+        nonlocal peak_fds
+        while not done.is_set():
+            peak_fds = max(peak_fds, count_fds(process.pid))
+            done.wait(FD_SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample_fds, daemon=True)
+    sampler.start()
+    output = process.stdout.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    done.set()
+    sampler.join()
+    seconds = time.monotonic() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{op} with {codec} and {workers} workers failed")
+
+    summary = json.loads(output)
+    counters = summary['counters']
+    if op == 'create':
+        processed, files = counters.get('source_bytes', 0), counters.get('files', 0)
+    else:
+        # the sequential extract path does not count extracted files
+        files, processed = tree_size(restore_dir)
+    archive_bytes = sum(os.path.getsize(os.path.join(snapshots_dir, fn)) for fn in os.listdir(snapshots_dir)
+                        if fn.startswith('snapshot-') and not fn.endswith('.json'))
+    return {
+        'op': op,
+        'codec': codec,
+        'workers': workers,
+        'seconds': round(seconds, 3),
+        'bytes': processed,
+        'files': files,
+        'mib_per_second': round(processed / MIB / seconds, 2),
+        'files_per_second': round(files / seconds, 1),
+        'archive_bytes': archive_bytes,
+        'compression_ratio': round(processed / archive_bytes, 3) if archive_bytes else None,
+        'peak_rss_kib': rusage.ru_maxrss,
+        'peak_fds': peak_fds,
+        'phases': summary['phases'],
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BIN_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> int:
+    params = dict(SCALES[args.scale])
+    for key in params:
+        if getattr(args, key, None) is not None:
+            params[key] = getattr(args, key)
+    workdir = os.path.abspath(args.workdir)
+    data_dir = generate_tree(os.path.join(workdir, 'tree'), **params)
+    files, size = tree_size(os.path.dirname(data_dir))
+
+    cases = []
+    for codec in args.codecs.split(','):
+        for workers in [int(w) for w in args.workers.split(',')]:
+            snapshots_dir = os.path.join(workdir, 'snapshots')
+            restore_dir = os.path.join(workdir, 'restore')
+            for op in ['create', 'restore']:
+                result = measure_case(op, codec, workers, data_dir, snapshots_dir, restore_dir)
+                logging.info(f"{op:8} {codec:7} workers={workers:<3} {result['mib_per_second']:8.1f} MiB/s "
+                             f"{result['files_per_second']:9.1f} files/s rss={result['peak_rss_kib']} KiB fds={result['peak_fds']}")
+                cases.append(result)
+            shutil.rmtree(restore_dir, ignore_errors=True)
+
+    results = {
+        'commit': git_commit(),
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'tree': {**params, 'files': files, 'bytes': size},
+        'cases': cases,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Wrote results to {args.output}")
+    return 0
+
+
+def compare(args: argparse.Namespace) -> int:
+    """
+    Compares two result files, a case regresses when its throughput drops or its
+    peak RSS grows by more than the threshold.
+    """
+    with open(args.baseline, 'r') as f:
+        baseline = {(c['op'], c['codec'], c['workers']): c for c in json.load(f)['cases']}
+    with open(args.current, 'r') as f:
+        current = json.load(f)['cases']
+
+    regressions = 0
+    print(f"{'case':28} {'MiB/s':>18} {'change':>8} {'peak RSS KiB':>22} {'change':>8}")
+    for case in current:
+        key = (case['op'], case['codec'], case['workers'])
+        old = baseline.get(key)
+        name = f"{case['op']} {case['codec']} w={case['workers']}"
+        if old is None:
+            print(f"{name:28} {case['mib_per_second']:>18} {'new':>8}")
+            continue
+        speed = (case['mib_per_second'] - old['mib_per_second']) / old['mib_per_second'] * 100 if old['mib_per_second'] else 0
+        rss = (case['peak_rss_kib'] - old['peak_rss_kib']) / old['peak_rss_kib'] * 100 if old['peak_rss_kib'] else 0
+        regressed = speed < -args.threshold or rss > args.threshold
+        regressions += regressed
+        print(f"{name:28} {old['mib_per_second']:>8} -> {case['mib_per_second']:<7} {speed:+7.1f}% "
+              f"{old['peak_rss_kib']:>10} -> {case['peak_rss_kib']:<9} {rss:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark snapshot create and restore on synthetic chain data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark matrix')
+    run_parser.add_argument('--scale', choices=list(SCALES), default='small', help='Size of the generated tree')
+    run_parser.add_argument('--codecs', default='lz4', help='Comma separated codecs, e.g. lz4,lz4-hc,zstd')
+    run_parser.add_argument('--workers', default=f'1,{os.cpu_count()}', help='Comma separated worker counts')
+    run_parser.add_argument('--workdir', default=os.path.join('/tmp', 'bench-snapshot'), help='Directory for the tree and archives')
+    run_parser.add_argument('-o', '--output', default='bench-results.json', help='File to write the results to')
+    for key in SCALES['tiny']:
+        run_parser.add_argument(f"--{key.replace('_', '-')}", dest=key, type=int, help=f'Override {key} of the scale')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('baseline', help='Results of the reference commit')
+    compare_parser.add_argument('current', help='Results to check')
+    compare_parser.add_argument('--threshold', type=float, default=10, help='Allowed change in percent')
+
+    case_parser = subparsers.add_parser('case', help=argparse.SUPPRESS)
+    case_parser.add_argument('--op', choices=['create', 'restore'], required=True)
+    case_parser.add_argument('--codec', required=True)
+    case_parser.add_argument('--workers', type=int, required=True)
+    case_parser.add_argument('--data-dir', required=True)
+    case_parser.add_argument('--snapshots-dir', required=True)
+    case_parser.add_argument('--restore-dir', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'case':
+        # results go to stdout, everything else to the log on stderr
+        logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+        summary = run_case(args.op, args.codec, args.workers, args.data_dir, args.snapshots_dir, args.restore_dir)
+        print(json.dumps(summary))
+        return 0
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == 'run':
+        return run(args)
+    return compare(args)
+
+
+if __name__ == "__main__":
+    exit(main())
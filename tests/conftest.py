@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import pytest
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'bin')))
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """
+    Starts local HTTP servers that are shut down after the test.
+
+    Call it with a handler class, or with a do_GET(handler) function and optional
+    handler class attributes, e.g. protocol_version='HTTP/1.1'. Returns the base URL.
+    """
+    servers = []
+
+    def start(handler, **attributes):
+        if not isinstance(handler, type):
+            handler = type('Handler', (QuietHandler,), {'do_GET': handler, **attributes})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def rpc_status(tmp_path):
+    """
+    Builds RpcStatus objects of a node with the given id and height.
+    """
+    import rpcstatus
+
+    def make(id, height, catching_up=False):
+        status_file = tmp_path / f'status-{id}.json'
+        status_file.write_text(json.dumps({'result': {
+            'node_info': {'id': id, 'listen_addr': 'tcp://0.0.0.0:26656'},
+            'sync_info': {'latest_block_height': str(height), 'catching_up': catching_up},
+        }}))
+        return rpcstatus.RpcStatus(f'file://{status_file}')
+
+    return make
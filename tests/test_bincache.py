@@ -0,0 +1,64 @@
+import os
+import glob
+import yaml
+import pytest
+import hashlib
+import bincache
+import cvutils
+
+
+def test_binary_cache_downloads_each_release_once(tmp_path, http_server):
+    binaries = {f'/gaiad-v{i}': os.urandom(1024 * 1024) for i in range(3)}
+    requests_seen = []
+
+    def serve_release(handler):
+        requests_seen.append(handler.path)
+        handler.send_response(200)
+        handler.end_headers()
+        handler.wfile.write(binaries[handler.path.split('?')[0]])
+
+    base = http_server(serve_release)
+    cache_dir = str(tmp_path / 'cache')
+    url = lambda path: f'{base}{path}?checksum=sha256:{hashlib.sha256(binaries[path]).hexdigest()}'
+    for pod in ['pod-a', 'pod-b']:
+        target = tmp_path / pod / 'upgrades' / 'v0' / 'bin' / 'gaiad'
+        cvutils.download_file(url('/gaiad-v0'), str(target), cache_dir=cache_dir)
+        assert target.read_bytes() == binaries['/gaiad-v0']
+    assert len(requests_seen) == 1
+    assert os.path.samefile(tmp_path / 'pod-a' / 'upgrades' / 'v0' / 'bin' / 'gaiad',
+                            tmp_path / 'pod-b' / 'upgrades' / 'v0' / 'bin' / 'gaiad')
+
+    corrupt = f'{base}/gaiad-v1?checksum=sha256:{"0" * 64}'
+    with pytest.raises(IOError):
+        cvutils.download_file(corrupt, str(tmp_path / 'pod-a' / 'v1' / 'gaiad'), cache_dir=cache_dir)
+    assert not (tmp_path / 'pod-a' / 'v1' / 'gaiad').exists()
+
+    for i in [1, 2]:
+        cvutils.download_file(url(f'/gaiad-v{i}'), str(tmp_path / 'pod-a' / f'v{i}' / 'gaiad'),
+                              cache_dir=cache_dir, cache_max_bytes=2 * 1024 * 1024)
+    cached = os.listdir(os.path.join(cache_dir, bincache.ENTRIES_DIR))
+    assert sorted(cached) == sorted(hashlib.sha256(binaries[f'/gaiad-v{i}']).hexdigest() for i in [1, 2])
+    assert (tmp_path / 'pod-a' / 'upgrades' / 'v0' / 'bin' / 'gaiad').read_bytes() == binaries['/gaiad-v0']
+
+
+@pytest.mark.parametrize('checksum', ['sha256:00', 'sha512:' + 'a' * 128, 'a' * 64, 'sha256:' + 'g' * 64, 'sha256:'])
+def test_malformed_checksum_is_rejected(tmp_path, checksum):
+    assert bincache.parse_checksum('https://example.com/gaiad') is None
+    assert bincache.parse_checksum(f'https://example.com/gaiad?checksum=sha256:{"AB" * 32}') == 'ab' * 32
+    with pytest.raises(ValueError):
+        bincache.parse_checksum(f'https://example.com/gaiad?checksum={checksum}')
+    target = tmp_path / 'bin' / 'gaiad'
+    with pytest.raises(ValueError):
+        cvutils.download_file(f'http://127.0.0.1:9/gaiad?checksum={checksum}', str(target))
+    assert not target.exists()
+
+
+@pytest.mark.parametrize('upgrades_yml', sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'chains', '*', 'upgrades.yml'))))
+def test_upgrades_checksums_parse(upgrades_yml):
+    with open(upgrades_yml) as f:
+        codebase_data = yaml.safe_load(f)
+    urls = list(codebase_data.get('libraries') or [])
+    for version in codebase_data.get('versions') or []:
+        urls.extend((version.get('binaries') or {}).values())
+    for url in urls:
+        bincache.parse_checksum(url)
@@ -0,0 +1,62 @@
+import os
+import pytest
+import tarfile
+import threading
+import cvutils
+
+
+def test_download_files_concurrently_with_retries(tmp_path, http_server):
+    lock = threading.Lock()
+    state = {'active': 0, 'peak': 0, 'failed': set()}
+
+    def flaky(handler):
+        with lock:
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            fail = handler.path not in state['failed']
+            state['failed'].add(handler.path)
+        try:
+            # every file fails once before it is served
+            handler.send_response(503 if fail else 200)
+            handler.end_headers()
+            if not fail:
+                threading.Event().wait(0.05)
+                handler.wfile.write(handler.path.encode())
+        finally:
+            with lock:
+                state['active'] -= 1
+
+    base = http_server(flaky)
+    downloads = [(f'{base}/lib{i}.so', str(tmp_path / 'lib' / f'lib{i}.so')) for i in range(8)]
+    cvutils.download_files(downloads, max_workers=8, max_per_host=3, backoff=0.01)
+    for i in range(8):
+        assert (tmp_path / 'lib' / f'lib{i}.so').read_bytes() == f'/lib{i}.so'.encode()
+    assert 1 < state['peak'] <= 3
+
+
+def test_download_file_extracts_tarball_from_stream(tmp_path, http_server):
+    binary = os.urandom(3 * 1024 * 1024)
+    tarball = tmp_path / 'release.tar.gz'
+    (tmp_path / 'release' / 'bin').mkdir(parents=True)
+    (tmp_path / 'release' / 'bin' / 'gaiad').write_bytes(binary)
+    (tmp_path / 'release' / 'README').write_text('readme')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        tar.add(tmp_path / 'release', arcname='release')
+
+    def serve_tarball(handler):
+        handler.send_response(200)
+        handler.end_headers()
+        handler.wfile.write(tarball.read_bytes())
+
+    base = http_server(serve_tarball)
+    target = tmp_path / 'upgrades' / 'v1' / 'bin' / 'gaiad'
+    cvutils.download_file(f'{base}/release.tar.gz', str(target))
+    assert target.read_bytes() == binary
+    assert os.listdir(target.parent) == ['gaiad']
+
+    # a checksum that does not match leaves nothing behind
+    target = tmp_path / 'upgrades' / 'v2' / 'bin' / 'gaiad'
+    with pytest.raises(IOError):
+        cvutils.download_file(f'{base}/release.tar.gz?checksum=sha256:{"0" * 64}', str(target))
+    assert not target.exists()
+    assert os.listdir(target.parent) == []
@@ -0,0 +1,31 @@
+import httpclient
+
+
+def test_httpclient_reuses_connections_and_retries(monkeypatch, http_server):
+    monkeypatch.setattr(httpclient, 'BACKOFF', 0.01)
+    monkeypatch.setattr(httpclient, '_sessions', {})
+    ports = []
+
+    def keep_alive(handler):
+        ports.append(handler.client_address[1])
+        body = b'{"ok": true}'
+        # the first request is rejected as if the endpoint were overloaded
+        handler.send_response(503 if len(ports) == 1 else 200)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    base = http_server(keep_alive, protocol_version='HTTP/1.1')
+    try:
+        for _ in range(3):
+            response = httpclient.get(f'{base}/status')
+            assert response.json() == {'ok': True}
+        assert len(ports) == 4
+        assert len(set(ports)) == 1
+        # status probes are not retried
+        ports.clear()
+        assert httpclient.get(f'{base}/status', retries=0).status_code == 503
+        assert len(ports) == 1
+    finally:
+        httpclient.close()
+    assert httpclient.JitteredRetry(backoff_factor=0.5).get_backoff_time() == 0
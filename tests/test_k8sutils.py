@@ -0,0 +1,132 @@
+import json
+import time
+import threading
+import k8sutils
+
+
+def test_peer_discovery_is_concurrent_and_bounded_by_deadline(monkeypatch, rpc_status):
+    services = {
+        'sync': [('sync-0', 26657), ('sync-1', 26657)],
+        'read': [('read-0', 26657)],
+        'archive': [('dead-0', 26657)],
+    }
+    hosts = {'sync-0': ['10.0.0.1'], 'sync-1': ['10.0.0.2'], 'read-0': ['10.0.0.1', '10.0.0.3'], 'dead-0': ['10.0.0.9']}
+
+    def resolve_srv(chain, domain, type, lifetime):
+        time.sleep(0.2)
+        if type not in services:
+            raise Exception("NXDOMAIN")
+        return services[type]
+
+    def resolve_a(target, lifetime):
+        time.sleep(0.2)
+        return hosts[target]
+
+    def probe_status(hostport):
+        if hostport.startswith('10.0.0.9'):
+            time.sleep(10)
+        time.sleep(0.2)
+        return rpc_status(f"id{hostport.split(':')[0][-1]}", 1000)
+
+    monkeypatch.setattr(k8sutils, 'resolve_srv', resolve_srv)
+    monkeypatch.setattr(k8sutils, 'resolve_a', resolve_a)
+    monkeypatch.setattr(k8sutils, 'probe_status', probe_status)
+
+    start = time.monotonic()
+    peers = list(k8sutils.get_service_peers('cosmoshub', 'svc.cluster.local', max_workers=16, deadline=4))
+    # serially this would take 5 srv + 4 a + 4 probes, plus the dead endpoint
+    assert time.monotonic() - start < 6
+    # duplicate endpoints are probed once, the dead one is left out
+    assert peers == ['id1@10.0.0.1:26656', 'id2@10.0.0.2:26656', 'id3@10.0.0.3:26656']
+
+    addresses = list(k8sutils.get_service_rpc_addresses('cosmoshub', 'svc.cluster.local', deadline=4))
+    assert addresses == ['10.0.0.1:26657', '10.0.0.2:26657', '10.0.0.3:26657', '10.0.0.9:26657']
+
+
+def test_add_persistent_peers_ranks_and_replaces_stale_peers(tmp_path, monkeypatch, rpc_status):
+    candidates = [
+        ('10.0.0.1:26657', rpc_status('far', 1000), 0.050),
+        ('10.0.0.2:26657', rpc_status('near', 999), 0.002),
+        ('10.0.0.3:26657', rpc_status('syncing', 500, True), 0.001),
+        ('10.0.0.4:26657', rpc_status('lagging', 800), 0.001),
+        ('10.0.0.5:26657', rpc_status('slow', 1000), 0.200),
+        # same node behind another service, only its best entry counts
+        ('10.0.0.6:26657', rpc_status('near', 999), 0.030),
+    ]
+    assert k8sutils.rank_peers(candidates, limit=2) == ['near@10.0.0.2:26656', 'far@10.0.0.1:26656']
+    assert k8sutils.rank_peers(candidates, limit=10, max_lag=1000) == [
+        'near@10.0.0.2:26656', 'far@10.0.0.1:26656', 'slow@10.0.0.5:26656', 'lagging@10.0.0.4:26656']
+
+    config_toml = tmp_path / 'config.toml'
+    config_toml.write_text('[p2p]\npersistent_peers = "static@1.2.3.4:26656,stale@10.0.0.9:26656"\n')
+    state_file = tmp_path / 'k8s-peers.json'
+    state_file.write_text(json.dumps({'peers': ['stale@10.0.0.9:26656']}))
+    monkeypatch.setattr(k8sutils, 'discover', lambda *args: candidates)
+    ctx = {'config_toml': str(config_toml), 'peers_state_file': str(state_file), 'chain_name': 'cosmoshub',
+           'domain': 'svc.cluster.local', 'peer_limit': '3', 'peer_max_lag': '100'}
+
+    for _ in range(2):
+        k8sutils.add_persistent_peers(ctx)
+        assert 'persistent_peers = "static@1.2.3.4:26656,near@10.0.0.2:26656,far@10.0.0.1:26656,slow@10.0.0.5:26656"' in config_toml.read_text()
+    assert json.loads(state_file.read_text())['peers'] == ['near@10.0.0.2:26656', 'far@10.0.0.1:26656', 'slow@10.0.0.5:26656']
+
+
+def test_cluster_height_is_cached_across_views(tmp_path, monkeypatch, rpc_status):
+    scans = []
+    cluster = [('10.0.0.1:26657', rpc_status('a', 1000), 0.01), ('10.0.0.2:26657', rpc_status('b', 5000, True), 0.01)]
+    monkeypatch.setattr(k8sutils, 'discover', lambda *args: scans.append(args) or cluster)
+    state_file = str(tmp_path / 'cluster-height.json')
+
+    # two views sharing a state file stand for two probe processes of a pod
+    first = k8sutils.ClusterHeight('cosmoshub', 'svc.cluster.local', ttl=60, state_file=state_file)
+    second = k8sutils.ClusterHeight('cosmoshub', 'svc.cluster.local', ttl=60, state_file=state_file)
+    assert first.height() == 1000
+    assert second.height() == 1000
+    assert first.height() == 1000
+    assert len(scans) == 1
+
+    cluster.append(('10.0.0.3:26657', rpc_status('c', 1200), 0.01))
+    expired = k8sutils.ClusterHeight('cosmoshub', 'svc.cluster.local', ttl=0, state_file=state_file)
+    assert expired.height() == 1200
+    assert len(scans) == 2
+
+    monkeypatch.setattr(k8sutils, '_cluster_heights', {('cosmoshub', 'svc.cluster.local'): first})
+    node = rpc_status('self', 900)
+    assert not node.is_behind('cosmoshub', 'svc.cluster.local')
+    assert node.is_behind('cosmoshub', 'svc.cluster.local', lag=10)
+    assert not rpc_status('syncing', 10, True).is_behind('cosmoshub', 'svc.cluster.local')
+    assert len(scans) == 2
+
+    # only long running callers keep the view fresh in the background
+    started = []
+    monkeypatch.setattr(k8sutils.ClusterHeight, 'start', lambda view: started.append(view) or view)
+    view = k8sutils.cluster_height('osmosis', 'svc.cluster.local', ttl=5)
+    assert started == [] and view.ttl == 5
+    assert k8sutils.cluster_height('osmosis', 'svc.cluster.local', background=True) is view
+    assert started == [view]
+
+
+def test_cluster_height_reads_do_not_wait_for_scan(tmp_path, monkeypatch, rpc_status):
+    scanning, release = threading.Event(), threading.Event()
+    cluster = [('10.0.0.1:26657', rpc_status('a', 1000), 0.01)]
+
+    def discover(*args):
+        if scanning.is_set():
+            release.wait(5)
+        scanning.set()
+        return cluster
+
+    monkeypatch.setattr(k8sutils, 'discover', discover)
+    view = k8sutils.ClusterHeight('cosmoshub', 'svc.cluster.local', ttl=0.1, state_file=str(tmp_path / 'height.json'))
+    assert view.height() == 1000
+    time.sleep(0.2)
+    # the background refresh is stuck in its scan, a read keeps the previous height
+    view.start()
+    time.sleep(0.2)
+    reader = threading.Thread(target=lambda: cluster.append(view.height()))
+    reader.start()
+    reader.join(1)
+    assert not reader.is_alive() and cluster[-1] == 1000
+    # the daemon thread never scans again once the test is over
+    view.ttl = 1e9
+    release.set()
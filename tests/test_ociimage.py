@@ -0,0 +1,105 @@
+import io
+import os
+import gzip
+import base64
+import json
+import hashlib
+import tarfile
+import ociimage
+
+
+def write_oci_layout(layout, layers):
+    blobs = layout / 'blobs' / 'sha256'
+    blobs.mkdir(parents=True)
+
+    def add_blob(data):
+        digest = hashlib.sha256(data).hexdigest()
+        (blobs / digest).write_bytes(data)
+        return f'sha256:{digest}'
+
+    descriptors = []
+    for members in layers:
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                if isinstance(content, str):
+                    info.type, info.linkname = tarfile.SYMTYPE, content
+                    tar.addfile(info)
+                else:
+                    info.size, info.mode = len(content), 0o755
+                    tar.addfile(info, io.BytesIO(content))
+        descriptors.append({'mediaType': 'application/vnd.oci.image.layer.v1.tar+gzip',
+                            'digest': add_blob(gzip.compress(buffer.getvalue()))})
+    manifest = add_blob(json.dumps({'schemaVersion': 2, 'mediaType': 'application/vnd.oci.image.manifest.v1+json',
+                                    'config': {}, 'layers': descriptors}).encode())
+    index = {'schemaVersion': 2, 'manifests': [
+        {'mediaType': 'application/vnd.oci.image.manifest.v1+json', 'digest': manifest,
+         'platform': {'os': 'linux', 'architecture': 'amd64'}, 'annotations': {'org.opencontainers.image.ref.name': 'v1'}}]}
+    (layout / 'index.json').write_text(json.dumps(index))
+    (layout / 'oci-layout').write_text('{"imageLayoutVersion": "1.0.0"}')
+
+
+def test_oci_image_extract_follows_symlinks_across_layers(tmp_path):
+    binary = os.urandom(64 * 1024)
+    write_oci_layout(tmp_path / 'layout', [
+        [('usr/local/bin/kava-0.17', binary), ('usr/local/bin/kava-old', b'old')],
+        [('usr/bin/kava', '../local/bin/kava-0.17'), ('usr/local/bin/.wh.kava-old', b'')],
+        [('etc/motd', b'hello'), ('usr/bin/stale', '/usr/local/bin/kava-old')],
+    ])
+
+    destination = tmp_path / 'upgrades' / 'v1' / 'bin'
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}:v1", 'kava', str(destination)) is True
+    assert (destination / 'kava').read_bytes() == binary
+    assert os.access(destination / 'kava', os.X_OK)
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}", 'stale', str(destination)) is False
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}", 'missing', str(destination)) is False
+    assert ociimage.parse_reference('docker://ghcr.io/terra-money/kava:0.17.7') == ('ghcr.io', 'terra-money/kava', '0.17.7')
+    assert ociimage.parse_reference('docker://alpine') == ('registry-1.docker.io', 'library/alpine', 'latest')
+
+
+def test_oci_image_extract_honours_directory_and_opaque_whiteouts(tmp_path):
+    write_oci_layout(tmp_path / 'layout', [
+        [('opt/old/bin/gaiad-old', b'old'), ('opt/cache/gaiad', b'stale'), ('opt/cache/gaiad-v2', b'v2')],
+        [('opt/.wh.old', b''), ('opt/cache/.wh..wh..opq', b''), ('opt/cache/gaiad-v2', b'new'),
+         ('usr/bin/gaiad', '/opt/cache/gaiad')],
+    ])
+
+    destination = tmp_path / 'bin'
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}", 'gaiad-old', str(destination)) is False
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}", 'gaiad', str(destination)) is False
+    # the opaque directory keeps the files of its own layer
+    assert ociimage.extract(f"oci:{tmp_path / 'layout'}", 'gaiad-v2', str(destination)) is True
+    assert (destination / 'gaiad-v2').read_bytes() == b'new'
+
+
+def test_registry_uses_credentials_of_the_auth_file(tmp_path, monkeypatch, http_server):
+    auth_file = tmp_path / 'auth.json'
+    auth_file.write_text(json.dumps({'auths': {
+        'registry.example.com': {'auth': base64.b64encode(b'wrong:wrong').decode()},
+        'https://registry.example.com/org': {'auth': base64.b64encode(b'bot:secret').decode()},
+    }}))
+    monkeypatch.setenv('REGISTRY_AUTH_FILE', str(auth_file))
+    basic = 'Basic ' + base64.b64encode(b'bot:secret').decode()
+
+    def serve_registry(handler):
+        if handler.path.startswith('/token'):
+            ok = handler.headers.get('Authorization') == basic
+            body = json.dumps({'token': 'private-token'} if ok else {}).encode()
+            handler.send_response(200 if ok else 401)
+        elif handler.headers.get('Authorization') == 'Bearer private-token':
+            body = json.dumps({'schemaVersion': 2, 'layers': []}).encode()
+            handler.send_response(200)
+        else:
+            body = b''
+            handler.send_response(401)
+            handler.send_header('WWW-Authenticate', f'Bearer realm="http://{handler.headers["Host"]}/token",'
+                                                    f'service="registry.example.com",scope="repository:org/private:pull"')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    registry = ociimage.Registry('registry.example.com', 'org/private')
+    registry.base_url = f'{http_server(serve_registry)}/v2/org/private'
+    assert registry.manifest('v1') == {'schemaVersion': 2, 'layers': []}
+    assert ociimage.registry_credentials('docker.io', 'library/alpine') is None
@@ -0,0 +1,40 @@
+import os
+import hashlib
+import cvutils
+import provisioner
+
+
+def test_provisioner_stages_next_upgrade_near_its_height(tmp_path, http_server):
+    binary = os.urandom(1024)
+
+    def serve_binary(handler):
+        handler.send_response(200)
+        handler.end_headers()
+        handler.wfile.write(binary)
+
+    base = http_server(serve_binary)
+    upgrades_yml = tmp_path / 'upgrades.yml'
+    upgrades_yml.write_text(f"""
+daemon_name: gaiad
+versions:
+  - name: v1
+    height: 1
+    binaries:
+      linux/amd64: {base}/v1
+  - name: v2
+    height: 5000
+    binaries:
+      linux/amd64: {base}/v2?checksum=sha256:{hashlib.sha256(binary).hexdigest()}
+""")
+    ctx = cvutils.set_cosmovisor_dir({
+        'upgrades_yaml_path': str(upgrades_yml), 'arch': 'linux/amd64', 'daemon_name': 'gaiad',
+        'provision_distance': 1000,
+    }, str(tmp_path / 'cosmovisor'))
+    binary_file = tmp_path / 'cosmovisor' / 'upgrades' / 'v2' / 'bin' / 'gaiad'
+    assert provisioner.provision(ctx, 3000) is None
+    assert not binary_file.exists()
+    assert provisioner.provision(ctx, 4200)['name'] == 'v2'
+    assert provisioner.provision(ctx, 4300) is None
+    assert binary_file.read_bytes() == binary
+    assert not (tmp_path / 'cosmovisor' / 'upgrades' / 'v1').exists()
+    assert provisioner.next_upgrade(ctx, 5000) is None
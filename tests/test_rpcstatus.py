@@ -0,0 +1,29 @@
+import json
+import pytest
+import rpcstatus
+
+
+def test_rpc_status_reads_fields_lazily(tmp_path):
+    status_file = tmp_path / 'status.json'
+    status_file.write_text(json.dumps({'jsonrpc': '2.0', 'id': -1, 'result': {
+        'node_info': {'id': 'abc', 'listen_addr': 'tcp://0.0.0.0:26656', 'moniker': 'node-0', 'other': {'tx_index': 'on'}},
+        'sync_info': {'latest_block_height': '1234', 'earliest_block_height': '1', 'catching_up': False},
+        'validator_info': {'pub_key': {'type': 'tendermint/PubKeyEd25519'}, 'voting_power': '0'},
+    }}))
+    status = rpcstatus.RpcStatus(f'file://{status_file}')
+
+    assert status.node_info.id == 'abc'
+    assert status.node_info.moniker == 'node-0'
+    assert status.node_info.other.tx_index == 'on'
+    assert status.sync_info.latest_block_height == '1234'
+    assert status.validator_info.pub_key.type == 'tendermint/PubKeyEd25519'
+    assert status.node_info is status.node_info
+    assert not status.is_catching_up()
+    assert status.to_dict()['id'] == -1
+    with pytest.raises(AttributeError):
+        status.sync_info.missing
+    # like the other fields, a missing typed field is an AttributeError, so getattr defaults work
+    del status.to_dict()['result']['sync_info']['earliest_block_height']
+    assert getattr(status.sync_info, 'earliest_block_height', None) is None
+    with pytest.raises(AttributeError):
+        status.missing
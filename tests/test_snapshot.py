@@ -1,13 +1,21 @@
+import io
+import argparse
 import os
-import sys
 import pytest
+import json
 import hashlib
 import lz4.frame
 import tarfile
+import stat
+import time
+import threading
+import subprocess
+import sys
+from http.server import BaseHTTPRequestHandler
 from unittest.mock import patch
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'bin')))
 import snapshot
+import snaparchive
 
 def get_sha256_of_file(file_path):
     sha256_hash = hashlib.sha256()
@@ -55,10 +63,10 @@ def test_remove_first_directory():
     assert snapshot.remove_first_directory(full_path) == expected_result
 
 # Define your test cases
-@patch('os.walk')
+@patch('os.scandir')
 @patch('lz4.frame.open')
 @patch('tarfile.open')
-def test_compress_lz4_with_mocks(mock_tarfile_open, mock_lz4_open, mock_os_walk):
+def test_compress_lz4_with_mocks(mock_tarfile_open, mock_lz4_open, mock_os_scandir):
     # Arrange (Set up any necessary test data or context)
     filename = 'test.tar.lz4'
     directories_to_tar = [os.path.dirname(__file__)]
@@ -69,7 +77,7 @@ def test_compress_lz4_with_mocks(mock_tarfile_open, mock_lz4_open, mock_os_walk)
 
     # Assert (Check the expected interactions with mocks)
     # Here you can use assertions to verify that the function called the mocked dependencies as expected
-    mock_os_walk.assert_called_with(os.path.dirname(__file__))
+    mock_os_scandir.assert_called_with(os.path.dirname(__file__))
     mock_lz4_open.assert_called_with('test.tar.lz4', mode='wb')
     mock_tarfile_open.assert_called_with(fileobj=mock_lz4_open.return_value.__enter__.return_value, mode='w|')
 
@@ -85,7 +93,7 @@ def test_extract_zip_file(temp_test_directory):
     extract_to = temp_test_directory
 
     # Act
-    result = snapshot.extract_file(zip_file_path, extract_to)
+    result = snaparchive.extract_file(zip_file_path, extract_to)
 
     # Assert
     assert result is True
@@ -99,7 +107,7 @@ def test_extract_tar_gz_file(temp_test_directory):
     extract_to = temp_test_directory
 
     # Act
-    result = snapshot.extract_file(tar_gz_file_path, extract_to)
+    result = snaparchive.extract_file(tar_gz_file_path, extract_to)
 
     # Assert
     assert result is True
@@ -113,7 +121,7 @@ def test_extract_tar_lz4_file(temp_test_directory):
     extract_to = temp_test_directory
 
     # Act
-    result = snapshot.extract_file(tar_lz4_file_path, extract_to)
+    result = snaparchive.extract_file(tar_lz4_file_path, extract_to)
 
     # Assert
     assert result is True
@@ -127,8 +135,539 @@ def test_extract_unsupported_file_format(temp_test_directory, caplog):
     extract_to = temp_test_directory
 
     # Act
-    result = snapshot.extract_file(unsupported_file_path, extract_to)
+    result = snaparchive.extract_file(unsupported_file_path, extract_to)
 
     # Assert
     assert result is False
     assert "Unsupported file format" in caplog.text  # Check if the expected error message is logged
+
+def test_parallel_lz4_writer_multiple_frames(tmp_path):
+    data = os.urandom(1024) * 10
+    archive = tmp_path / 'blocks.lz4'
+
+    with open(archive, 'wb') as raw_file:
+        with snaparchive.ParallelLz4Writer(raw_file, workers=2, block_size=1000) as writer:
+            writer.write(data[:2500])
+            writer.write(data[2500:])
+
+    raw = archive.read_bytes()
+    assert raw.count(b'\x04\x22\x4d\x18') >= 11  # one frame per block
+    with lz4.frame.open(archive, 'rb') as lz4_file:
+        assert lz4_file.read() == data
+
+def test_compress_lz4_parallel_roundtrip(tmp_path):
+    source = tmp_path / 'src' / 'data'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.sst').write_bytes(os.urandom(64 * 1024))
+    (source / 'sub' / 'b.log').write_text('hello')
+    archive = str(tmp_path / 'snapshot.tar.lz4')
+
+    snapshot.compress_lz4(archive, [str(source)], [], workers=4)
+
+    with lz4.frame.open(archive, 'rb') as lz4_file:
+        with tarfile.open(fileobj=lz4_file) as tar:
+            names = sorted(os.path.basename(name) for name in tar.getnames())
+    assert names == ['a.sst', 'b.log']
+
+# Serve files from tests/data with HTTP range support
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    directory = os.path.join(os.path.dirname(__file__), 'data')
+
+    def _body(self):
+        with open(os.path.join(self.directory, self.path.lstrip('/')), 'rb') as f:
+            return f.read()
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self._body())))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        body = self._body()
+        start, end = self.headers['Range'].split('=')[1].split('-')
+        # suffix ranges, e.g. bytes=-16 for the footer of an indexed archive
+        start, end = (len(body) - int(end), len(body) - 1) if not start else (int(start), int(end))
+        chunk = body[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(chunk)))
+        self.send_header('Content-Range', f'bytes {start}-{start + len(chunk) - 1}/{len(body)}')
+        self.end_headers()
+        self.wfile.write(chunk)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def range_server(http_server):
+    return http_server(RangeRequestHandler)
+
+def test_stream_extract_tar_lz4(range_server, temp_test_directory):
+    result = snapshot.stream_extract(f'{range_server}/test.tar.lz4', temp_test_directory, connections=4)
+
+    assert result is True
+    assert 'chains' in os.listdir(temp_test_directory)
+
+class NoHeadRequestHandler(RangeRequestHandler):
+    # like presigned GET URLs, which are not valid for HEAD
+    def do_HEAD(self):
+        self.send_response(403)
+        self.end_headers()
+
+
+def test_stream_extract_without_head(http_server, temp_test_directory):
+    url = f'{http_server(NoHeadRequestHandler)}/test.tar.lz4'
+    with snaparchive.RangeReader(url, connections=2) as reader:
+        assert reader.ranged and reader.size == os.path.getsize(os.path.join(os.path.dirname(__file__), 'data', 'test.tar.lz4'))
+    assert snapshot.stream_extract(url, temp_test_directory, connections=4) is True
+    assert 'chains' in os.listdir(temp_test_directory)
+
+
+def test_list_members_streams_remote_archive(range_server):
+    local = snapshot.list_members(os.path.join(os.path.dirname(__file__), 'data', 'test.tar.lz4'))
+    assert local and snapshot.list_members(f'{range_server}/test.tar.lz4', connections=2) == local
+
+def test_extract_members_fetches_only_the_member_span(tmp_path, http_server):
+    home = tmp_path / 'home'
+    (home / 'wasm' / 'wasm').mkdir(parents=True)
+    (home / 'data').mkdir()
+    (home / 'wasm' / 'wasm' / 'contract.wasm').write_bytes(b'\0asm')
+    (home / 'data' / '000001.ldb').write_bytes(os.urandom(24 * 1024 * 1024))
+    snapshot.compress_lz4(str(tmp_path / 'snapshot.tar.lz4'), [str(home / 'wasm'), str(home / 'data')], [], indexed=True)
+
+    fetched = []
+
+    class ArchiveHandler(RangeRequestHandler):
+        directory = str(tmp_path)
+
+        def do_GET(self):
+            start, end = self.headers['Range'].split('=')[1].split('-')
+            if start:
+                fetched.append(int(end) - int(start) + 1)
+            super().do_GET()
+
+    url = f'{http_server(ArchiveHandler)}/snapshot.tar.lz4'
+    assert snaparchive.extract_members(url, str(tmp_path / 'restore'), ['wasm/'], connections=4)
+    assert (tmp_path / 'restore' / 'wasm' / 'wasm' / 'contract.wasm').read_bytes() == b'\0asm'
+    # the wasm member sits in the first 4 MiB frame, the data behind it is not downloaded
+    assert sum(fetched) < 2 * snaparchive.LZ4_BLOCK_SIZE
+
+def test_range_reader_reassembles_in_order(range_server):
+    expected = open(os.path.join(os.path.dirname(__file__), 'data', 'test.tar.gz'), 'rb').read()
+
+    with snaparchive.RangeReader(f'{range_server}/test.tar.gz', connections=3, chunk_size=1000) as reader:
+        assert reader.ranged
+        assert reader.read(10) + reader.read() == expected
+
+def test_incremental_snapshot_chain(tmp_path):
+    data_dir = tmp_path / 'home' / 'data'
+    (data_dir / 'application.db').mkdir(parents=True)
+    (data_dir / 'application.db' / '000001.ldb').write_bytes(b'immutable')
+    (data_dir / 'application.db' / 'MANIFEST').write_text('v1')
+    (data_dir / 'old.log').write_text('removed later')
+    snapshots_dir = str(tmp_path / 'snapshots')
+
+    snapshot.create_snapshot(snapshots_dir, str(data_dir), incremental=True)
+    (data_dir / 'application.db' / '000002.ldb').write_bytes(b'new table')
+    (data_dir / 'application.db' / 'MANIFEST').write_text('version two')
+    (data_dir / 'old.log').unlink()
+    snapshot.create_snapshot(snapshots_dir, str(data_dir), incremental=True)
+
+    delta = snapshot.find_latest_snapshot(snapshots_dir)
+    assert os.path.basename(delta).startswith('delta-')
+    with lz4.frame.open(delta, 'rb') as lz4_file:
+        with tarfile.open(fileobj=lz4_file) as tar:
+            assert sorted(os.path.basename(name) for name in tar.getnames()) == ['000002.ldb', 'MANIFEST']
+
+    restore_to = tmp_path / 'restore'
+    assert snapshot.snapdelta.extract_chain(delta, str(restore_to))
+    restored = {p.name: p for p in restore_to.rglob('*') if p.is_file()}
+    assert sorted(restored) == ['000001.ldb', '000002.ldb', 'MANIFEST']
+    assert restored['MANIFEST'].read_text() == 'version two'
+
+def test_chunkstore_deduplicates_and_restores(tmp_path):
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / '000001.ldb').write_bytes(os.urandom(300 * 1024))
+    (data_dir / 'empty').write_bytes(b'')
+    (data_dir / 'snapshots' / 'metadata.db').mkdir(parents=True)
+    os.symlink('000001.ldb', data_dir / 'latest.ldb')
+    snapshots_dir = str(tmp_path / 'snapshots')
+
+    first = snapshot.chunkstore.store(snapshots_dir, 'snapshot-100', [str(data_dir)], [])
+    chunks_after_first = list((tmp_path / 'snapshots' / 'chunks').rglob('*'))
+    second = snapshot.chunkstore.store(snapshots_dir, 'snapshot-200', [str(data_dir)], [])
+    assert list((tmp_path / 'snapshots' / 'chunks').rglob('*')) == chunks_after_first
+
+    restore_to = tmp_path / 'restore'
+    assert snapshot.chunkstore.restore(second, str(restore_to))
+    restored = {p.name: p for p in restore_to.rglob('*') if p.is_file()}
+    assert restored['000001.ldb'].read_bytes() == (data_dir / '000001.ldb').read_bytes()
+    assert restored['empty'].read_bytes() == b''
+    assert os.readlink(restore_to / 'data' / 'latest.ldb') == '000001.ldb'
+    assert (restore_to / 'data' / 'snapshots' / 'metadata.db').is_dir()
+
+    os.remove(first)
+    # a store in progress holds back gc, its chunks have no manifest yet
+    with snapshot.chunkstore.locked(snapshots_dir):
+        collector = threading.Thread(target=snapshot.chunkstore.gc, args=(snapshots_dir,))
+        collector.start()
+        collector.join(0.2)
+        assert collector.is_alive()
+    collector.join()
+    assert list((tmp_path / 'snapshots' / 'chunks').rglob('*')) == chunks_after_first
+    os.remove(second)
+    assert snapshot.chunkstore.gc(snapshots_dir) > 0
+
+def test_chunkstore_restore_checks_chunks_before_reset(tmp_path):
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / '000001.ldb').write_bytes(os.urandom(1024))
+    snapshots_dir = tmp_path / 'snapshots'
+    manifest = snapshot.chunkstore.store(str(snapshots_dir), 'snapshot-100', [str(data_dir)], [])
+    for chunk in (snapshots_dir / 'chunks').rglob('*'):
+        if chunk.is_file():
+            chunk.unlink()
+
+    resets = []
+    assert snapshot.restore_snapshot(f'file://{manifest}', str(snapshots_dir), str(tmp_path / 'home'),
+                                     reset=lambda: resets.append(True)) == 1
+    assert resets == []
+
+def test_indexed_snapshot_partial_restore(tmp_path):
+    home = tmp_path / 'home'
+    (home / 'data' / 'application.db').mkdir(parents=True)
+    (home / 'wasm' / 'wasm').mkdir(parents=True)
+    (home / 'data' / 'application.db' / '000001.ldb').write_bytes(os.urandom(200 * 1024))
+    (home / 'wasm' / 'wasm' / 'contract.wasm').write_bytes(b'\0asm')
+    archive = str(tmp_path / 'snapshot.tar.lz4')
+
+    snapshot.compress_lz4(archive, [str(home / 'data'), str(home / 'wasm')], [], indexed=True)
+
+    # still a standard lz4 stream
+    with lz4.frame.open(archive, 'rb') as lz4_file:
+        with tarfile.open(fileobj=lz4_file) as tar:
+            assert len(tar.getnames()) == 2
+
+    names = snapshot.list_members(archive)
+    assert [os.path.basename(name) for name in names] == ['000001.ldb', 'contract.wasm']
+
+    wasm_prefix = os.path.dirname(os.path.dirname(names[1]))
+    restore_to = tmp_path / 'restore'
+    assert snaparchive.extract_file(archive, str(restore_to), include=[wasm_prefix])
+    restored = [p.name for p in restore_to.rglob('*') if p.is_file()]
+    assert restored == ['contract.wasm']
+
+def test_indexed_snapshot_falls_back_to_wasm_archive(tmp_path):
+    pytest.importorskip('zstandard')
+    home = tmp_path / 'home'
+    (home / 'data').mkdir(parents=True)
+    (home / 'wasm' / 'wasm').mkdir(parents=True)
+    (home / 'data' / '000001.ldb').write_bytes(os.urandom(1024))
+    (home / 'wasm' / 'wasm' / 'contract.wasm').write_bytes(b'\0asm')
+    snapshots_dir = tmp_path / 'snapshots'
+
+    # zstd archives cannot be indexed, so the wasm directory is published on its own
+    snapshot.create_snapshot(str(snapshots_dir), str(home / 'data'), indexed=True, identifier='1000',
+                             codec=snaparchive.get_codec('zstd'))
+    assert snaparchive.read_index(str(snapshots_dir / 'snapshot-1000.tar.zst')) is None
+    assert snaparchive.extract_file(str(snapshots_dir / 'wasm-1000.tar.zst'), str(tmp_path / 'restore'))
+    assert (tmp_path / 'restore' / 'wasm' / 'wasm' / 'contract.wasm').read_bytes() == b'\0asm'
+
+@pytest.mark.parametrize('archive_name', ['test.zip', 'test.tar.gz', 'test.tar.lz4'])
+def test_extract_file_parallel_fixtures(archive_name, temp_test_directory):
+    archive = os.path.join(os.path.dirname(__file__), 'data', archive_name)
+
+    assert snaparchive.extract_file(archive, temp_test_directory, workers=4) is True
+    assert 'chains' in os.listdir(temp_test_directory)
+
+def test_extract_file_parallel_multi_frame(tmp_path):
+    source = tmp_path / 'src' / 'data'
+    source.mkdir(parents=True)
+    for i in range(8):
+        (source / f'{i:06d}.ldb').write_bytes(os.urandom(1024 * 1024 + i))
+    archive = str(tmp_path / 'snapshot.tar.lz4')
+    snapshot.compress_lz4(archive, [str(source)], [], workers=2)
+
+    assert len(snaparchive.lz4_frames(archive)) > 1
+    restore_to = tmp_path / 'restore'
+    assert snaparchive.extract_file(archive, str(restore_to), workers=4) is True
+    for restored in restore_to.rglob('*.ldb'):
+        assert restored.read_bytes() == (source / restored.name).read_bytes()
+    assert len(list(restore_to.rglob('*.ldb'))) == 8
+
+def test_extract_tar_stream_links_and_directory_attrs(tmp_path, monkeypatch):
+    archive = str(tmp_path / 'snapshot.tar.lz4')
+    with lz4.frame.open(archive, mode='wb') as lz4_file:
+        with tarfile.open(fileobj=lz4_file, mode='w|') as tar:
+            directory = tarfile.TarInfo('data/readonly')
+            directory.type, directory.mode, directory.mtime = tarfile.DIRTYPE, 0o555, 1000
+            tar.addfile(directory)
+            for name, data in [('data/readonly/000001.ldb', b'table'), ('data/LOCK', b'lock')]:
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+            link = tarfile.TarInfo('data/LOCK.link')
+            link.type, link.linkname = tarfile.LNKTYPE, 'data/LOCK'
+            tar.addfile(link)
+
+    # a slow pool still has the link target queued when the link is read
+    write_member = snaparchive.write_member
+    monkeypatch.setattr(snaparchive, 'write_member', lambda *args: (time.sleep(0.2), write_member(*args)))
+    restore_to = tmp_path / 'restore'
+    assert snaparchive.extract_file(archive, str(restore_to), workers=4) is True
+
+    assert (restore_to / 'data' / 'LOCK.link').read_bytes() == b'lock'
+    assert os.path.samefile(restore_to / 'data' / 'LOCK.link', restore_to / 'data' / 'LOCK')
+    assert (restore_to / 'data' / 'readonly' / '000001.ldb').read_bytes() == b'table'
+    st = os.stat(restore_to / 'data' / 'readonly')
+    assert stat.S_IMODE(st.st_mode) == 0o555 and st.st_mtime == 1000
+    os.chmod(restore_to / 'data' / 'readonly', 0o755)
+
+def test_stage_snapshot_links_immutable_files(tmp_path):
+    data_dir = tmp_path / 'home' / 'data'
+    (data_dir / 'application.db').mkdir(parents=True)
+    (data_dir / 'application.db' / '000001.ldb').write_bytes(b'table')
+    (data_dir / 'application.db' / 'MANIFEST-000002').write_bytes(b'manifest')
+    (tmp_path / 'home' / 'wasm').mkdir()
+    (tmp_path / 'home' / 'wasm' / 'contract.wasm').write_bytes(b'wasm')
+
+    staged = snapshot.stage_snapshot(str(data_dir), str(tmp_path / 'staging'))
+    (data_dir / 'application.db' / 'MANIFEST-000002').write_bytes(b'changed')
+
+    assert os.path.samefile(os.path.join(staged, 'application.db', '000001.ldb'), data_dir / 'application.db' / '000001.ldb')
+    with open(os.path.join(staged, 'application.db', 'MANIFEST-000002'), 'rb') as f:
+        assert f.read() == b'manifest'
+    files = {path: arcname for path, arcname, st in snaparchive.iter_files([staged, str(tmp_path / 'staging' / 'wasm')], [])}
+    assert sorted(files.values()) == ['data/application.db/000001.ldb', 'data/application.db/MANIFEST-000002', 'wasm/contract.wasm']
+
+def test_snapshot_retention_keeps_delta_bases(tmp_path):
+    snapshots_dir = str(tmp_path)
+    (tmp_path / 'wasm-2000.tar.lz4').write_bytes(b'w')
+    for height in [1000, 1500, 2000]:
+        (tmp_path / f'snapshot-{height}.tar.lz4').write_bytes(b'x' * 100)
+        snapshot.snapindex.add(snapshots_dir, f'snapshot-{height}.tar.lz4', 'test-1')
+    (tmp_path / 'delta-2100.tar.lz4').write_bytes(b'd' * 10)
+    snapshot.snapdelta.write_manifest(str(tmp_path / 'delta-2100.tar.lz4'), {'parent': 'snapshot-1500.tar.lz4'})
+    snapshot.snapindex.add(snapshots_dir, 'delta-2100.tar.lz4', 'test-1')
+
+    assert snapshot.find_latest_snapshot(snapshots_dir) == str(tmp_path / 'delta-2100.tar.lz4')
+    assert snapshot.snapindex.find(snapshots_dir, 2000)['files'] == ['snapshot-2000.tar.lz4', 'wasm-2000.tar.lz4']
+
+    removed = snapshot.snapindex.prune(snapshots_dir, keep_last=1, keep_every=1000)
+    assert [e['name'] for e in removed] == []
+    removed = snapshot.snapindex.prune(snapshots_dir, keep_last=1)
+    assert [e['name'] for e in removed] == ['snapshot-1000.tar.lz4', 'snapshot-2000.tar.lz4']
+    assert not (tmp_path / 'wasm-2000.tar.lz4').exists()
+
+    removed = snapshot.snapindex.prune(snapshots_dir, max_bytes=50)
+    assert removed == []
+    assert [e['name'] for e in snapshot.snapindex.load(snapshots_dir)] == ['snapshot-1500.tar.lz4', 'delta-2100.tar.lz4']
+
+def test_restore_verifies_sidecar_before_reset(tmp_path):
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / '000001.ldb').write_bytes(os.urandom(64 * 1024))
+    snapshots_dir = tmp_path / 'snapshots'
+    snapshot.create_snapshot(str(snapshots_dir), str(data_dir), identifier='1000')
+
+    archive = snapshots_dir / 'snapshot-1000.tar.lz4'
+    sidecar = snaparchive.load_sidecar(str(archive))
+    assert sidecar['sha256'] == get_sha256_of_file(archive)
+    assert sidecar['size'] == archive.stat().st_size
+
+    with open(archive, 'r+b') as f:
+        f.truncate(sidecar['size'] - 100)
+    resets = []
+    result = snapshot.restore_snapshot(f'file://{archive}', str(snapshots_dir), str(tmp_path / 'restore'),
+                                       reset=lambda: resets.append(True))
+    assert result == 1
+    assert resets == []
+
+def test_stream_extract_fails_on_bad_chunk(range_server, temp_test_directory):
+    path = os.path.join(os.path.dirname(__file__), 'data', 'test.tar.lz4')
+    with open(path, 'rb') as f, open(os.devnull, 'wb') as null:
+        writer = snaparchive.HashingWriter(null, chunk_size=512)
+        writer.write(f.read())
+    sidecar = writer.sidecar()
+    assert snapshot.stream_extract(f'{range_server}/test.tar.lz4', temp_test_directory, 4, sidecar=sidecar) is True
+
+    sidecar['chunks'][1] = '0' * 64
+    assert snapshot.stream_extract(f'{range_server}/test.tar.lz4', temp_test_directory, 4, sidecar=sidecar) is False
+
+@pytest.mark.parametrize('codec', ['lz4-hc', 'zstd', 'gzip'])
+def test_codec_roundtrip_detected_by_magic(codec, tmp_path):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / '000001.ldb').write_bytes(os.urandom(256 * 1024) * 4)
+    snapshots_dir = tmp_path / 'snapshots'
+    snapshot.create_snapshot(str(snapshots_dir), str(data_dir), workers=2, identifier='1000',
+                             codec=snaparchive.get_codec(codec, window_log=20))
+
+    archive = snapshot.find_latest_snapshot(str(snapshots_dir))
+    assert archive.endswith(snaparchive.get_codec(codec).extension)
+    # restore relies on the magic bytes, not on the extension
+    renamed = str(tmp_path / 'snapshot.bin')
+    os.rename(archive, renamed)
+    assert snaparchive.file_format(renamed) == {'lz4-hc': 'lz4'}.get(codec, codec)
+    restore_to = tmp_path / 'restore'
+    assert snaparchive.extract_file(renamed, str(restore_to)) is True
+    assert (restore_to / 'data' / '000001.ldb').read_bytes() == (data_dir / '000001.ldb').read_bytes()
+
+@pytest.mark.parametrize('codec', ['lz4', 'gzip'])
+def test_restore_resumes_from_journal(codec, tmp_path, monkeypatch):
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    for i in range(12):
+        (data_dir / f'{i:06d}.ldb').write_bytes(os.urandom(1024 * 1024))
+    snapshots_dir = tmp_path / 'snapshots'
+    snapshot.create_snapshot(str(snapshots_dir), str(data_dir), workers=2, identifier='1000',
+                             codec=snaparchive.get_codec(codec))
+    archive = snapshot.find_latest_snapshot(str(snapshots_dir))
+    monkeypatch.setattr(snaparchive, 'CHECKPOINT_BYTES', 1024 * 1024)
+    chain_home = tmp_path / 'restore'
+
+    write_member = snaparchive.write_member
+    written = []
+    def interrupted(path, *args):
+        if len(written) == 8:
+            raise RuntimeError('killed')
+        written.append(path)
+        write_member(path, *args)
+    monkeypatch.setattr(snaparchive, 'write_member', interrupted)
+    with pytest.raises(RuntimeError):
+        snapshot.restore_snapshot(f'file://{archive}', str(snapshots_dir), str(chain_home), workers=2)
+    with open(chain_home / snapshot.JOURNAL_FILE) as f:
+        state = json.load(f)['archives'][os.path.basename(archive)]
+    assert state['tar_offset'] > 0
+    if codec == 'lz4':
+        assert state['frame'] > 0
+
+    written.clear()
+    monkeypatch.setattr(snaparchive, 'write_member', lambda path, *args: (written.append(path), write_member(path, *args)))
+    monkeypatch.setattr(snapshot.initversion, 'main', lambda ctx: None)
+    resets = []
+    assert snapshot.restore_snapshot(f'file://{archive}', str(snapshots_dir), str(chain_home), workers=2,
+                                     reset=lambda: resets.append(True)) == 0
+    assert resets == []
+    assert len(written) < 12
+    for i in range(12):
+        assert (chain_home / 'data' / f'{i:06d}.ldb').read_bytes() == (data_dir / f'{i:06d}.ldb').read_bytes()
+    assert not (chain_home / snapshot.JOURNAL_FILE).exists()
+
+def test_snapshot_metrics_textfile(tmp_path, caplog, monkeypatch):
+    data_dir = tmp_path / 'home' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / '000001.ldb').write_bytes(b'\0' * 1024 * 1024)
+    textfile = tmp_path / 'metrics' / 'snapshot.prom'
+
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: (scanned.append(path), scandir(path))[1])
+
+    caplog.set_level('INFO')
+    snapshot.snapmetrics.start('create', str(textfile))
+    snapshot.create_snapshot(str(tmp_path / 'snapshots'), str(data_dir), identifier='1000')
+    # create reports progress against the size of the source, taken from its only scan
+    assert snapshot.snapmetrics.current.totals['source_bytes'] == 1024 * 1024
+    assert scanned.count(str(data_dir)) == 1
+    summary = snapshot.snapmetrics.finish()
+
+    assert summary['counters']['files'] == 1
+    assert summary['counters']['source_bytes'] == 1024 * 1024
+    assert summary['rates']['compression_ratio'] > 1
+    assert 'compress' in summary['phases']
+    events = [json.loads(r.message) for r in caplog.records if r.name == 'snapmetrics']
+    assert [e['event'] for e in events] == ['phase', 'summary']
+    metrics = textfile.read_text()
+    assert 'cosmos_snapshot_phase_seconds{action="create",phase="compress"}' in metrics
+    assert 'cosmos_snapshot_files{action="create"} 1' in metrics
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='changing owners requires root')
+@pytest.mark.parametrize('workers', [1, 2])
+def test_restore_sets_owner_while_extracting(tmp_path, monkeypatch, workers):
+    data_dir = tmp_path / 'home' / 'data'
+    (data_dir / 'application.db').mkdir(parents=True)
+    for i in range(4):
+        (data_dir / 'application.db' / f'{i:06d}.sst').write_bytes(os.urandom(64 * 1024))
+    snapshots_dir = tmp_path / 'snapshots'
+    snapshot.create_snapshot(str(snapshots_dir), str(data_dir), identifier='1000')
+    archive = snapshot.find_latest_snapshot(str(snapshots_dir))
+
+    chain_home = tmp_path / 'restore'
+    chain_home.mkdir()
+    os.chown(chain_home, 1234, 2345)
+    monkeypatch.setattr(snapshot.initversion, 'main', lambda ctx: None)
+    snapshot.snapmetrics.start('restore')
+    assert snapshot.restore_snapshot(f'file://{archive}', str(snapshots_dir), str(chain_home), workers=workers) == 0
+    assert 'chown' not in snapshot.snapmetrics.finish()['phases']
+    paths = [os.path.join(root, name) for root, dirs, files in os.walk(chain_home) for name in dirs + files]
+    assert len(paths) == 6
+    for path in paths:
+        assert (os.lstat(path).st_uid, os.lstat(path).st_gid) == (1234, 2345)
+
+def test_iter_files_prunes_excluded_directories(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    for path in ['wasm/wasm/state/contract.wasm', 'wasm/wasm/cache/modules/contract.module',
+                 'wasm/wasm/cachefile', 'wasm/debug.log', 'wasm/wasm/state/LOCK']:
+        (home / path).parent.mkdir(parents=True, exist_ok=True)
+        (home / path).write_bytes(b'x' * 10)
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: (scanned.append(path), scandir(path))[1])
+
+    files = list(snaparchive.iter_files([str(home / 'wasm')], ['wasm/wasm/cache/', '*.log', 'wasm/*/LOCK']))
+    assert sorted(arcname for path, arcname, st in files) == ['wasm/wasm/cachefile', 'wasm/wasm/state/contract.wasm']
+    assert all(st.st_size == 10 for path, arcname, st in files)
+    assert str(home / 'wasm' / 'wasm' / 'cache') not in scanned
+
+
+def test_exclude_function_compiles_patterns_once():
+    snaparchive.cached_excludes.cache_clear()
+    patterns = ['wasm/wasm/cache/', '*.log']
+    names = ['wasm/wasm/cache/module', 'data/debug.log', 'data/000001.ldb']
+    kept = [name for name in names if snaparchive.exclude_function(tarfile.TarInfo(name), patterns)]
+    assert kept == ['data/000001.ldb']
+    assert snaparchive.cached_excludes.cache_info().misses == 1
+
+def test_load_sidecar_treats_forbidden_as_missing(http_server):
+    requested = []
+
+    def do_GET(handler):
+        requested.append(handler.path)
+        handler.send_response(403)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+
+    url = f'{http_server(do_GET)}/snapshot-100.tar.lz4?X-Amz-Signature=abc'
+    assert snaparchive.load_sidecar(url) is None
+    assert requested == ['/snapshot-100.tar.lz4.sha256.json']
+
+
+def test_skip_past_end_raises_and_journal_ignores_query(tmp_path):
+    import io
+    with pytest.raises(IOError):
+        snaparchive.skip_bytes(io.BytesIO(b'short'), 100)
+
+    journal = snaparchive.RestoreJournal(str(tmp_path / 'journal.json'), 'snapshot-100')
+    journal.update('https://bucket/snapshot-100.tar.lz4?X-Amz-Signature=old', {'tar_offset': 512})
+    resumed = snaparchive.RestoreJournal(str(tmp_path / 'journal.json'), 'snapshot-100')
+    assert resumed.checkpoint('https://bucket/snapshot-100.tar.lz4?X-Amz-Signature=new') == {'tar_offset': 512}
+
+def test_failed_restore_does_not_start_node(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(snapshot.cvcontrol, 'stop_process', lambda name: calls.append(('stop', name)))
+    monkeypatch.setattr(snapshot.cvcontrol, 'start_process', lambda name: calls.append(('start', name)))
+    monkeypatch.setattr(snapshot, 'restore_snapshot', lambda *args: 1)
+    args = argparse.Namespace(action='restore', include=None, snapshots_dir=str(tmp_path / 'snapshots'),
+                              chain_home=str(tmp_path / 'home'), data_dir=str(tmp_path / 'home' / 'data'))
+
+    assert snapshot.main(args) == 1
+    assert calls == [('stop', 'cosmovisor')]
+
+def test_archive_helpers_do_not_import_snapshot():
+    code = 'import sys, snapdelta, chunkstore, snapindex; sys.exit("snapshot" in sys.modules)'
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(snapshot.__file__))
+    assert subprocess.run([sys.executable, '-c', code], env=env).returncode == 0